@@ -0,0 +1,192 @@
+"""Generate synthetic git repositories and matching stacktraces.
+
+The repository is written with ``git fast-import`` using fixed dates and a
+seeded random number generator, so the same options always produce the same
+commits (and SHAs).
+
+Usage::
+
+    python -m benchmarks.generate --commits 2000 --files 5000 /tmp/bench-repo
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import subprocess
+
+LANGUAGES = ("python", "java", "javascript")
+
+# 2016-07-19, so generated repos don't depend on the current time
+START_DATE = 1468963088
+
+
+class Config(object):
+    """Scale of a generated repository."""
+
+    def __init__(self, commits=200, files=500, lines=60, patch_size=8, files_per_commit=3, rename_rate=0.05, seed=0):
+        self.commits = commits
+        self.files = files
+        self.lines = lines
+        self.patch_size = patch_size
+        self.files_per_commit = files_per_commit
+        self.rename_rate = rename_rate
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def _path(language, i):
+    if language == "python":
+        return "app/pkg%d/module%d.py" % (i % 50, i)
+    if language == "java":
+        return "src/main/java/com/example/pkg%d/Class%d.java" % (i % 50, i)
+    return "web/app/comp%d/file%d.js" % (i % 50, i)
+
+
+def _code_line(rng, language, i):
+    name = "value%d_%d" % (i, rng.randint(0, 10**6))
+    if language == "python":
+        return "    %s = compute(%s, %d)" % (name, name[:-1] or "x", rng.randint(0, 1000))
+    if language == "java":
+        return "        int %s = compute(%d);" % (name, rng.randint(0, 1000))
+    return "    const %s = compute(%d);" % (name, rng.randint(0, 1000))
+
+
+class _File(object):
+    def __init__(self, language, path, lines):
+        self.language = language
+        self.path = path
+        self.lines = lines
+
+
+def _data(content):
+    data = content.encode("utf-8")
+    return b"data %d\n%s\n" % (len(data), data)
+
+
+def generate_repo(path, config):
+    """Create a git repository in path and return its generated files.
+
+    The first commit adds config.files files, each following commit modifies
+    config.files_per_commit of them and occasionally renames one.
+    """
+    rng = random.Random(config.seed)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    subprocess.check_call(["git", "init", "-q", path])
+
+    files = []
+    for i in range(config.files):
+        language = LANGUAGES[i % len(LANGUAGES)]
+        lines = [_code_line(rng, language, n) for n in range(config.lines)]
+        files.append(_File(language, _path(language, i), lines))
+
+    stream = []
+    author = "Bench Mark <bench@example.com>"
+    for number in range(config.commits + 1):
+        date = START_DATE + number * 60
+        if number == 0:
+            message = "Initial import"
+            changed = files
+        else:
+            message = "Change %d\n\nDifferential Revision: https://example.com/D%d" % (number, number)
+            changed = rng.sample(files, min(config.files_per_commit, len(files)))
+        stream.append(b"commit refs/heads/master\n")
+        stream.append(("author %s %d +0000\ncommitter %s %d +0000\n" % (author, date, author, date)).encode())
+        stream.append(_data(message))
+        for f in changed:
+            if number:
+                if rng.random() < config.rename_rate:
+                    old_path = f.path
+                    f.path = f.path.replace(os.path.basename(f.path), "r%d_%s" % (number, os.path.basename(f.path)))
+                    stream.append(('R "%s" "%s"\n' % (old_path, f.path)).encode())
+                for n in range(config.patch_size):
+                    position = rng.randrange(len(f.lines))
+                    if rng.random() < 0.5:
+                        f.lines[position] = _code_line(rng, f.language, position)
+                    else:
+                        f.lines.insert(position, _code_line(rng, f.language, position))
+            stream.append(('M 100644 inline "%s"\n' % f.path).encode())
+            stream.append(_data("\n".join(f.lines) + "\n"))
+        stream.append(b"\n")
+
+    process = subprocess.Popen(["git", "fast-import", "--quiet"], stdin=subprocess.PIPE, cwd=path)
+    process.communicate(b"".join(stream))
+    if process.returncode != 0:
+        raise Exception("git fast-import failed")
+    subprocess.check_call(["git", "checkout", "-q", "-f", "master"], cwd=path)
+    return files
+
+
+def _python_trace(frames):
+    result = "Traceback (most recent call last):\n"
+    for f, line_number in frames:
+        result += '  File "/srv/%s", line %d, in handler\n' % (f.path, line_number)
+        result += "    %s\n" % f.lines[line_number - 1].strip()
+    return result + "ValueError: benchmark\n"
+
+
+def _java_trace(frames):
+    result = "java.lang.IllegalStateException: benchmark\n"
+    for f, line_number in frames:
+        package_path, filename = os.path.split(f.path.split("src/main/java/", 1)[1])
+        class_name = filename.split(".")[0]
+        result += "\tat %s.%s.handle(%s:%d)\n" % (package_path.replace("/", "."), class_name, filename, line_number)
+    return result
+
+
+def _javascript_trace(frames):
+    result = "TypeError: benchmark\n"
+    for f, line_number in frames:
+        result += "\tat handler (webpack:///srv/%s:%d:12)\n" % (f.path, line_number)
+    return result
+
+
+def generate_traces(files, frames=20, seed=0):
+    """Return a {language: trace} dictionary of traces through files."""
+    rng = random.Random(seed)
+    formatters = {"python": _python_trace, "java": _java_trace, "javascript": _javascript_trace}
+    traces = {}
+    for language in LANGUAGES:
+        candidates = [f for f in files if f.language == language]
+        chosen = [rng.choice(candidates) for i in range(frames)]
+        traces[language] = formatters[language]([(f, rng.randint(1, len(f.lines))) for f in chosen])
+    return traces
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic repository and stacktraces.")
+    parser.add_argument("path", help="directory to create the repository in")
+    parser.add_argument("--commits", type=int, default=200, help="number of commits after the initial import")
+    parser.add_argument("--files", type=int, default=500, help="number of files")
+    parser.add_argument("--lines", type=int, default=60, help="initial lines per file")
+    parser.add_argument("--patch-size", type=int, default=8, help="lines changed per file per commit")
+    parser.add_argument("--files-per-commit", type=int, default=3, help="files changed per commit")
+    parser.add_argument("--rename-rate", type=float, default=0.05, help="chance a changed file is renamed")
+    parser.add_argument("--frames", type=int, default=20, help="frames per generated stacktrace")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = Config(
+        commits=args.commits,
+        files=args.files,
+        lines=args.lines,
+        patch_size=args.patch_size,
+        files_per_commit=args.files_per_commit,
+        rename_rate=args.rename_rate,
+        seed=args.seed,
+    )
+    files = generate_repo(args.path, config)
+    traces = generate_traces(files, frames=args.frames, seed=args.seed)
+    for language, trace in traces.items():
+        with open(os.path.join(args.path, "%s.trace" % language), "w") as f:
+            f.write(trace)
+    print(json.dumps(config.as_dict(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Time each phase of a lookup against a synthetic repository.
+
+Generates a temporary repository with benchmarks.generate and removes it
+afterwards (or reuses one made by its command line, passed with ``--repo``),
+then times parse_trace, files_touched, files, _lookup_files, pickaxe and the
+full lookup_stacktrace for a Python, Java and JavaScript trace. Every phase
+is run ``--repeat`` times with all caches cleared, and its duration, peak
+Python memory and git usage are written out as JSON, so runs can be
+compared to catch regressions.
+
+Usage::
+
+    python -m benchmarks.run --commits 2000 --files 5000 --output results.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks import generate
+from git_stacktrace import api
+from git_stacktrace import git
+from git_stacktrace import stats
+
+
+def clear_caches():
+    git.tree_cache.clear()
+    git._commit_trees.clear()
+    git._commit_info_cache.clear()
+
+
+def measure(fn, repeat):
+    """Run fn repeat times and return its timings, peak memory and git usage."""
+    durations = []
+    git_commands = 0
+    for i in range(repeat):
+        clear_caches()
+        with stats.collect() as run_stats:
+            start = time.perf_counter()
+            fn()
+            durations.append(time.perf_counter() - start)
+        git_commands = run_stats.git.git_commands
+    # tracemalloc slows down allocations a lot, so memory is measured by a run that isn't timed
+    clear_caches()
+    tracemalloc.start()
+    fn()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "min": min(durations),
+        "median": statistics.median(durations),
+        "max": max(durations),
+        "peak_memory": peak_memory,
+        "git_commands": git_commands,
+    }
+
+
+def _lookup_files(traceback, git_range):
+    git_files = git.path_index(git_range)
+    paths = sorted(api._match_files(git_files, traceback))
+    commit_files = git.files_touched(git_range, paths=paths)
+    results = api.result.Results()
+    api._lookup_files(commit_files, traceback, results, git.PatchStore(git_range, paths=paths))
+
+
+def _pickaxe(traceback, git_range):
+    api._match_files(git.path_index(git_range), traceback)
+    for line in traceback.lines:
+        if line.code:
+            git.pickaxe(line.code, git_range, line.git_filename)
+
+
+def _pickaxe_patches(traceback, git_range):
+    paths = sorted(api._match_files(git.path_index(git_range), traceback))
+    patches = git.PatchStore(git_range, paths=paths)
+    for line in traceback.lines:
+        if line.code:
+            git.pickaxe(line.code, git_range, line.git_filename, patches=patches)
+
+
+def run_benchmarks(repo, traces, repeat):
+    """Return {phase: {language: measurement}} for the repository in repo."""
+    cwd = os.getcwd()
+    os.chdir(repo)
+    try:
+        root = git.run_command("git", "rev-list", "--max-parents=0", "HEAD")
+        git_range = "%s..HEAD" % root
+        results = {}
+        for language, trace in sorted(traces.items()):
+            traceback = api.parse_trace(trace)
+            phases = {
+                "parse_trace": lambda: api.parse_trace(trace),
+                "files_touched": lambda: git.files_touched(git_range),
+                "files": lambda: git.files(git_range),
+                "_lookup_files": lambda: _lookup_files(api.parse_trace(trace), git_range),
+                "pickaxe": lambda: _pickaxe(api.parse_trace(trace), git_range),
+                "pickaxe_patches": lambda: _pickaxe_patches(api.parse_trace(trace), git_range),
+                "lookup_stacktrace": lambda: api.lookup_stacktrace(api.parse_trace(trace), git_range),
+            }
+            if not any(line.code for line in traceback.lines):
+                # Only python traces have code to run pickaxe on
+                del phases["pickaxe"]
+                del phases["pickaxe_patches"]
+            for name, fn in phases.items():
+                print("%s %s" % (language, name), file=sys.stderr)
+                results.setdefault(name, {})[language] = measure(fn, repeat)
+        return results
+    finally:
+        os.chdir(cwd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark git-stacktrace against a synthetic repository.")
+    parser.add_argument("--repo", help="existing repository created by benchmarks.generate")
+    parser.add_argument("--commits", type=int, default=200, help="number of commits after the initial import")
+    parser.add_argument("--files", type=int, default=500, help="number of files")
+    parser.add_argument("--lines", type=int, default=60, help="initial lines per file")
+    parser.add_argument("--patch-size", type=int, default=8, help="lines changed per file per commit")
+    parser.add_argument("--files-per-commit", type=int, default=3, help="files changed per commit")
+    parser.add_argument("--rename-rate", type=float, default=0.05, help="chance a changed file is renamed")
+    parser.add_argument("--frames", type=int, default=20, help="frames per generated stacktrace")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="times to run each phase")
+    parser.add_argument("--output", help="write results to this file instead of stdout")
+    args = parser.parse_args()
+
+    config = generate.Config(
+        commits=args.commits,
+        files=args.files,
+        lines=args.lines,
+        patch_size=args.patch_size,
+        files_per_commit=args.files_per_commit,
+        rename_rate=args.rename_rate,
+        seed=args.seed,
+    )
+    if args.repo:
+        repo = args.repo
+        traces = {}
+        for language in generate.LANGUAGES:
+            with open(os.path.join(repo, "%s.trace" % language)) as f:
+                traces[language] = f.read()
+        results = run_benchmarks(repo, traces, args.repeat)
+    else:
+        # Use benchmarks.generate to create a repository to run against more than once
+        repo = tempfile.mkdtemp(prefix="git-stacktrace-bench-")
+        try:
+            print("Generating repository in %s" % repo, file=sys.stderr)
+            files = generate.generate_repo(repo, config)
+            traces = generate.generate_traces(files, frames=args.frames, seed=args.seed)
+            results = run_benchmarks(repo, traces, args.repeat)
+        finally:
+            shutil.rmtree(repo, ignore_errors=True)
+
+    output = {
+        "config": config.as_dict() if not args.repo else {"repo": os.path.abspath(repo)},
+        "frames": args.frames,
+        "repeat": args.repeat,
+        "python": platform.python_version(),
+        "git": git.run_command("git", "--version"),
+        "results": results,
+    }
+    data = json.dumps(output, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
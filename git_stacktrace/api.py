@@ -13,41 +13,58 @@ Example usage::
         if "Smith" in r.author
             print("")
             print(r)
+
+To look up every stacktrace in a log file::
+
+    with open("app.log") as f:
+        for traceback in api.extract_tracebacks(f):
+            results = api.lookup_stacktrace(traceback, git_range)
 """
 
+import collections
+import concurrent.futures
 import logging
 
 from git_stacktrace import git
 from git_stacktrace import result
 from git_stacktrace import parse_trace
+from git_stacktrace import stats
 
 log = logging.getLogger(__name__)
 
-# So we can call api.parse_trace
+# So we can call api.parse_trace and api.extract_tracebacks
+extract_tracebacks = parse_trace.extract_tracebacks
 parse_trace = parse_trace.parse_trace
 
 
-def _longest_filename(matches):
-    """find longest match by number of '/'."""
-    return max(matches, key=lambda filename: len(filename.split("/")))
-
-
-def _lookup_files(commit_files, git_files, traceback, results):
-    """Populate results and line.git_filename."""
+def _match_files(git_files, traceback):
+    """Populate line.git_filename and return the set of files found."""
+    found = set()
+    for line in traceback.lines:
+        git_filename = traceback.longest_file_match(line.trace_filename, git_files)
+        if git_filename:
+            line.git_filename = git_filename
+            found.add(git_filename)
+    return found
+
+
+def _lookup_files(commit_files, traceback, results, patches=None):
+    """Populate results with the commits that touched each line's git_filename."""
+    by_path = git.files_by_path(commit_files)
+    # The lines of a file are matched against each commit's patch together
+    lines_by_file = collections.OrderedDict()
     for line in traceback.lines:
-        matches = traceback.file_match(line.trace_filename, git_files)
-        if matches:
-            git_file = _longest_filename(matches)
-            for commit, file_list in commit_files.items():
-                if git_file in file_list:
-                    git_file = file_list[file_list.index(git_file)]
-                    line.git_filename = git_file.filename
-                    line_number = None
-                    if git.line_match(commit, line):
-                        line_number = line.line_number
-                    results.get_result(commit).add_file(git_file, line_number)
-            if line.git_filename is None:
-                line.git_filename = _longest_filename(matches)
+        if line.git_filename:
+            lines_by_file.setdefault(line.git_filename, []).append(line)
+    for filename, lines in lines_by_file.items():
+        line_numbers = [line.line_number for line in lines]
+        for commit, git_file in by_path.get(filename, ()):
+            matched = git.lines_match(commit, filename, line_numbers, patches=patches)
+            for line in lines:
+                line_number = None
+                if line.line_number in matched:
+                    line_number = line.line_number
+                results.get_result(commit).add_file(git_file, line_number)
 
 
 def convert_since(since, branch=None):
@@ -75,7 +92,55 @@ def valid_range(git_range):
     return git.valid_range(git_range)
 
 
-def lookup_stacktrace(traceback, git_range, fast=False):
+def resolve_range(git_range):
+    """Resolve the revisions in a range to commit SHAs
+
+    The result names the same commits for as long as the repository isn't
+    rewritten, even if the branches in git_range move.
+
+    :param git_range: range of commits, such as 'ab9f71a..origin/master'
+    :type git_range: str
+    :rtype: str
+    """
+    return git.resolve_range(git_range)
+
+
+def _range_history(git_range, index, paths=None):
+    """Return (commit_files, patches) for git_range, from index when possible.
+
+    If reading from git, only history for paths is read.
+    """
+    if index is not None:
+        try:
+            indexed_range = index.lookup_range(git_range)
+        except Exception:
+            # If this fails, fall back to git
+            if log.isEnabledFor(logging.DEBUG):
+                log.exception("history index failed")
+        else:
+            if indexed_range is not None:
+                return indexed_range.files_touched(), indexed_range
+    if paths is None:
+        return git.files_touched(git_range), git.PatchStore(git_range)
+    commit_files, paths = git.path_history(git_range, paths)
+    return commit_files, git.PatchStore(git_range, paths=paths)
+
+
+def _pickaxe(code, filename, git_range, patches):
+    try:
+        return git.pickaxe(code, git_range, filename, patches=patches)
+    except Exception:
+        # If this fails, move on
+        if log.isEnabledFor(logging.DEBUG):
+            log.exception("pickaxe failed")
+        return []
+
+
+def _no_progress(phase, done, total):
+    pass
+
+
+def lookup_stacktrace(traceback, git_range, fast=False, index=None, jobs=1, progress=None):
     """Lookup to see what commits in git_range could have caused the stacktrace.
 
     Pass in a stacktrace object and returns a results object.
@@ -86,28 +151,105 @@ def lookup_stacktrace(traceback, git_range, fast=False):
     :type git_range: str
     :param fast: If True, don't run pickaxe if cannot find the file in git.
     :type fast: bool
-    :returns: results
+    :param index: If set, answer from this history index instead of reading the range from git.
+    :type index: git_stacktrace.index.HistoryIndex
+    :param jobs: Number of lines to run pickaxe on at the same time.
+    :type jobs: int
+    :param progress: If set, called with (phase, done, total) as the lookup goes through its phases.
+    :type progress: callable
+    :returns: results, with the git_stacktrace.stats.Stats of the lookup as results.stats
     :rtype: git_stacktrace.result.Results
     """
-    results = result.Results()
+    return lookup_stacktraces([traceback], git_range, fast=fast, index=index, jobs=jobs, progress=progress)[0]
 
-    commit_files = git.files_touched(git_range)
-    git_files = git.files(git_range)
-    _lookup_files(commit_files, git_files, traceback, results)
 
-    for line in traceback.lines:
-        commits = []
-        if line.code and not (line.git_filename is None and fast is True):
-            try:
-                commits = git.pickaxe(line.code, git_range, line.git_filename)
-            except Exception:
-                # If this fails, move on
-                if log.isEnabledFor(logging.DEBUG):
-                    log.exception("pickaxe failed")
-                continue
-        for commit, line_removed in commits:
-            if line_removed is True:
-                results.get_result(commit).lines_removed.add(line.code)
-            if line_removed is False:
-                results.get_result(commit).lines_added.add(line.code)
-    return results
+def lookup_stacktraces(tracebacks, git_range, fast=False, index=None, jobs=1, progress=None):
+    """Lookup the commits in git_range that could have caused each of the stacktraces.
+
+    Same as calling lookup_stacktrace for each traceback, but the files and
+    history of git_range are only read once, and a line of code that appears
+    in several stacktraces is only searched for once.
+
+    :param tracebacks: Traceback objects
+    :type tracebacks: list of git_stacktrace.parse_trace.Traceback
+    :param git_range: git commit range
+    :type git_range: str
+    :param fast: If True, don't run pickaxe if cannot find the file in git.
+    :type fast: bool
+    :param index: If set, answer from this history index instead of reading the range from git.
+    :type index: git_stacktrace.index.HistoryIndex
+    :param jobs: Number of lines to run pickaxe on at the same time.
+    :type jobs: int
+    :param progress: If set, called with (phase, done, total) as the lookup goes through its phases.
+    :type progress: callable
+    :returns: one results per traceback, in the same order, sharing the Stats of the lookup
+    :rtype: list of git_stacktrace.result.Results
+    """
+    if stats.current() is None:
+        with stats.collect():
+            return lookup_stacktraces(tracebacks, git_range, fast=fast, index=index, jobs=jobs, progress=progress)
+
+    if progress is None:
+        progress = _no_progress
+    all_results = []
+    for traceback in tracebacks:
+        results = result.Results()
+        results.stats = stats.current()
+        all_results.append(results)
+
+    progress("files", 0, 1)
+    with stats.phase("files"):
+        git_files = git.path_index(git_range)
+    stats.record_count("tree_files", len(git_files))
+    progress("match_files", 0, 1)
+    with stats.phase("match_files"):
+        paths = set()
+        for traceback in tracebacks:
+            paths.update(_match_files(git_files, traceback))
+        paths = sorted(paths)
+    stats.record_count("trace_files", len(paths))
+    progress("files_touched", 0, 1)
+    with stats.phase("files_touched"):
+        # Only ask git about the files in the stacktraces
+        commit_files, patches = _range_history(git_range, index, paths)
+    stats.record_count("commits", len(commit_files))
+    progress("line_match", 0, 1)
+    with stats.phase("line_match"):
+        for traceback, results in zip(tracebacks, all_results):
+            _lookup_files(commit_files, traceback, results, patches)
+
+    # Each (code, filename) is only searched for once, however many lines share it
+    queries = []
+    for traceback in tracebacks:
+        for line in traceback.lines:
+            if line.code and not (line.git_filename is None and fast is True):
+                queries.append((line.code, line.git_filename))
+    queries = list(collections.OrderedDict.fromkeys(queries))
+    progress("pickaxe", 0, len(queries))
+    with stats.phase("pickaxe"):
+        if jobs > 1 and len(queries) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = [
+                    stats.run_in_context(executor, _pickaxe, code, filename, git_range, patches)
+                    for code, filename in queries
+                ]
+                for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                    progress("pickaxe", done, len(queries))
+                found = [future.result() for future in futures]
+        else:
+            found = []
+            for code, filename in queries:
+                found.append(_pickaxe(code, filename, git_range, patches))
+                progress("pickaxe", len(found), len(queries))
+    found = dict(zip(queries, found))
+
+    # Add results in the same order as the lines, whichever pickaxe finished first
+    for traceback, results in zip(tracebacks, all_results):
+        for line in traceback.lines:
+            for commit, line_removed in found.get((line.code, line.git_filename), ()):
+                if line_removed is True:
+                    results.get_result(commit).lines_removed.add(line.code)
+                if line_removed is False:
+                    results.get_result(commit).lines_added.add(line.code)
+    stats.record_count("results", sum(len(results.results) for results in all_results))
+    return all_results
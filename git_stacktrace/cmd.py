@@ -1,15 +1,97 @@
 from __future__ import print_function
 
 import argparse
+import json
 import logging
+import multiprocessing
+import multiprocessing.pool
 import os
 import select
 import sys
 
 import git_stacktrace
 from git_stacktrace import api
+from git_stacktrace import git
+from git_stacktrace import index
+from git_stacktrace import jobs
 from git_stacktrace import server
-from wsgiref.simple_server import make_server
+from git_stacktrace import stats
+
+# State of --batch, set before the workers are forked so they share it
+_batch = {}
+
+
+def _batch_history():
+    """Return what the lookups of this process read the range from.
+
+    A worker forked from the process that ran run_batch opens the history
+    index again, a SQLite connection can't be used across a fork.
+    """
+    if _batch["index_path"] is not None and _batch["pid"] != os.getpid():
+        _batch["history"] = index.HistoryIndex(_batch["index_path"])
+        _batch["pid"] = os.getpid()
+    return _batch["history"]
+
+
+def _batch_lookup(item):
+    """Look up one record of a --batch file and return its JSON result and the as_dict() of its Stats."""
+    number, line = item
+    record_id = number
+    with stats.collect() as lookup_stats:
+        try:
+            record = json.loads(line)
+            if isinstance(record, dict):
+                record_id = record.get("id", number)
+                trace = record.get("trace")
+            else:
+                trace = record
+            traceback = api.parse_trace(trace)
+            results = api.lookup_stacktrace(traceback, _batch["git_range"], fast=_batch["fast"], index=_batch_history())
+            output = {"id": record_id, "errors": None, "commits": results.get_sorted_results_by_dict()}
+        except Exception as e:
+            output = {"id": record_id, "errors": str(e), "commits": []}
+    return json.dumps(output, default=server.json_serial), lookup_stats.as_dict()
+
+
+def run_batch(batch_file, git_range, fast=False, jobs=1, output=None, history_index=None):
+    """Look up every trace in batch_file and write one JSON result per line to output.
+
+    batch_file has one JSON record per line, either a trace or an object
+    with a "trace" and an optional "id" (the line number by default).
+    Results are written as soon as each trace is done, so not in input order.
+
+    If history_index is passed in, the range is read from it instead of git.
+    The Stats of every lookup are added to the Stats being collected, if any.
+    """
+    output = output or sys.stdout
+    # Read everything the lookups share once, before forking
+    if history_index is not None:
+        # Only missing commits are added, so the workers only have to read the index
+        _batch["history"] = history_index
+        _batch["index_path"] = history_index.path
+        commits = list(history_index.lookup_range(git_range).files_touched())
+    else:
+        _batch["history"] = git.RangeHistory(git_range)
+        _batch["index_path"] = None
+        commits = list(_batch["history"].files_touched())
+    _batch["pid"] = os.getpid()
+    _batch["git_range"] = git_range
+    _batch["fast"] = fast
+    git.path_index(git_range)
+    git.prefetch_commit_info(commits)
+
+    if jobs > 1 and "fork" in multiprocessing.get_all_start_methods():
+        pool = multiprocessing.get_context("fork").Pool(jobs)
+    else:
+        pool = multiprocessing.pool.ThreadPool(max(jobs, 1))
+    items = ((number, line) for number, line in enumerate(batch_file, 1) if line.strip())
+    batch_stats = stats.current()
+    with pool:
+        for result, lookup_stats in pool.imap_unordered(_batch_lookup, items):
+            print(result, file=output)
+            output.flush()
+            if batch_stats is not None:
+                batch_stats.merge(lookup_stats)
 
 
 def main():
@@ -25,12 +107,54 @@ def main():
         "--server", action="store_true", help="start a " "webserver to visually interact with git-stacktrace"
     )
     parser.add_argument("--port", default=os.environ.get("GIT_STACKTRACE_PORT", 8080), type=int, help="Server port")
+    parser.add_argument(
+        "--workers",
+        default=os.environ.get("GIT_STACKTRACE_WORKERS", 4),
+        type=int,
+        help="Number of requests the server handles at once",
+    )
+    parser.add_argument(
+        "--cache-size",
+        default=128,
+        type=int,
+        help="Number of lookup results the server keeps for repeated stacktraces, 0 to disable",
+    )
+    parser.add_argument(
+        "--max-jobs",
+        default=16,
+        type=int,
+        help="Number of lookups that can be queued or running on the server's /jobs endpoint",
+    )
     parser.add_argument(
         "-f",
         "--fast",
         action="store_true",
         help="Speed things up by not running " "pickaxe if the file for a line of code cannot be found",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=1,
+        type=int,
+        help="Number of lines of code to run pickaxe on in parallel, or of traces with --batch",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        type=argparse.FileType("r"),
+        help="Read one JSON trace per line from FILE ('-' for stdin) and print one JSON result per line",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="Keep an index of commit history and file listings in .git/ and look commits up in it",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=sorted(git.BACKENDS),
+        default=os.environ.get("GIT_STACKTRACE_BACKEND", git.SubprocessBackend.name),
+        help="Read history by running git (subprocess), or from the object files in process (objects)",
+    )
     parser.add_argument(
         "-b",
         "--branch",
@@ -44,15 +168,27 @@ def main():
         version="%s version %s" % (os.path.split(sys.argv[0])[-1], git_stacktrace.__version__),
     )
     parser.add_argument("-d", "--debug", action="store_true", help="Enable debug logging")
+    parser.add_argument(
+        "--stats", action="store_true", help="Print timings and git usage of each step of the lookup to stderr"
+    )
     args = parser.parse_args()
 
     logging.basicConfig(format="%(name)s:%(funcName)s:%(lineno)s: %(message)s")
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
+    git.set_backend(args.backend)
+
+    history_index = None
+    if args.index:
+        history_index = index.HistoryIndex()
+        git.tree_cache.directory = index.tree_cache_path()
 
     if args.server:
-        print("Starting httpd on port %s..." % args.port)
-        httpd = make_server("", args.port, server.application)
+        server.history_index = history_index
+        server.result_cache.max_size = args.cache_size
+        server.job_queue = jobs.JobQueue(workers=args.workers, max_pending=args.max_jobs)
+        print("Starting httpd on port %s with %d workers..." % (args.port, args.workers))
+        httpd = server.make_server("", args.port, server.application, workers=args.workers)
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
@@ -72,21 +208,33 @@ def main():
         print("Found no commits in '%s'" % git_range)
         sys.exit(1)
 
+    if args.batch:
+        with stats.collect() as lookup_stats:
+            run_batch(args.batch, git_range, fast=args.fast, jobs=args.jobs, history_index=history_index)
+        if args.stats:
+            print(lookup_stats, file=sys.stderr)
+        return
+
     if not select.select([sys.stdin], [], [], 0.0)[0]:
         raise Exception("No input found in stdin")
     blob = sys.stdin.readlines()
-    traceback = api.parse_trace(blob)
+    with stats.collect() as lookup_stats:
+        traceback = api.parse_trace(blob)
+
+        print(traceback)
 
-    print(traceback)
+        results = api.lookup_stacktrace(traceback, git_range, fast=args.fast, index=history_index, jobs=args.jobs)
 
-    results = api.lookup_stacktrace(traceback, git_range, fast=args.fast)
+        for r in results.get_sorted_results():
+            print("")
+            print(r)
 
-    for r in results.get_sorted_results():
-        print("")
-        print(r)
+        if len(results.get_sorted_results()) == 0:
+            print("No matches found")
 
-    if len(results.get_sorted_results()) == 0:
-        print("No matches found")
+    if args.stats:
+        print("", file=sys.stderr)
+        print(lookup_stats, file=sys.stderr)
 
 
 if __name__ == "__main__":
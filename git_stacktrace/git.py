@@ -1,16 +1,31 @@
 from __future__ import print_function
 
+import abc
+import atexit
+import bisect
 import collections
 import datetime
+import heapq
+import logging
 import re
 import subprocess
 import sys
 import shlex
 import os
+import tempfile
+import threading
+import time
 
 import whatthepatch
 
+from git_stacktrace import objects
+from git_stacktrace import paths
+from git_stacktrace import stats
+
+log = logging.getLogger(__name__)
+
 SHA1_REGEX = re.compile(r"\b[0-9a-f]{40}\b")
+EMPTY_BLOB = "e69de29bb2d1d6434b8b29ae775ad8c2e48c5391"
 
 CommitInfo = collections.namedtuple("CommitInfo", ["summary", "subject", "body", "url", "author", "date"])
 
@@ -34,6 +49,14 @@ class GitFile(object):
             raise Exception("Invalid git file state: %s" % state)
         self.state = state
 
+    @classmethod
+    def from_raw(cls, line):
+        """Create a GitFile from a line of git log --raw output."""
+        split_line = line.split("\t")
+        filename = split_line[-1]
+        state = split_line[0].split(" ")[-1][0]
+        return cls(filename, state)
+
     def __repr__(self):
         return self.filename
 
@@ -53,10 +76,12 @@ def run_command_status(*argv, **kwargs):
     newenv["LANG"] = "C"
     newenv["LANGUAGE"] = "C"
     newenv.update(kwargs)
+    start = time.time()
     p = subprocess.Popen(
         argv, stdin=subprocess.PIPE if stdin else None, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=newenv
     )
     (out, nothing) = p.communicate(stdin)
+    stats.record_command(time.time() - start, len(out))
     out = out.decode("utf-8", "replace")
     return (p.returncode, out.strip())
 
@@ -69,27 +94,689 @@ def run_command(*argv, **kwargs):
     return output
 
 
-def files_touched(git_range):
-    """Run git log --pretty="%H" --raw  git_range.
+def _write_stdin(pipe, data):
+    try:
+        pipe.write(data)
+        pipe.close()
+    except (IOError, OSError):
+        # The command exited without reading all of it
+        pass
+
 
-    Generate a dictionary of files modified by the commits in range
+def stream_command(*argv, **kwargs):
+    """Run a command like run_command, but yield each line of output as it is produced.
+
+    Lines are decoded and have their newline removed. The whole output is
+    never held in memory, so this is for commands whose output can be large.
+    Raises the same exception as run_command once the output has been read if
+    the command failed. If the generator is closed early the command is killed.
     """
-    cmd = "git", "log", "--pretty=%H", "--raw", git_range
-    data = run_command(*cmd)
-    commits = collections.defaultdict(list)
-    commit = None
-    for line in data.splitlines():
-        if SHA1_REGEX.match(line):
-            commit = line
-        elif line.strip():
-            split_line = line.split("\t")
-            filename = split_line[-1]
-            state = split_line[0].split(" ")[-1][0]
-            commits[commit].append(GitFile(filename, state))
-    return commits
+    stdin = kwargs.pop("stdin", None)
+    newenv = os.environ.copy()
+    newenv["LANG"] = "C"
+    newenv["LANGUAGE"] = "C"
+    newenv.update(kwargs)
+    start = time.time()
+    nbytes = 0
+    # Not a pipe, which could fill up and block git while only stdout is read
+    with tempfile.TemporaryFile() as errors:
+        p = subprocess.Popen(
+            argv, stdin=subprocess.PIPE if stdin else None, stdout=subprocess.PIPE, stderr=errors, env=newenv
+        )
+        if stdin:
+            threading.Thread(target=_write_stdin, args=(p.stdin, stdin), daemon=True).start()
+        finished = False
+        try:
+            for line in p.stdout:
+                nbytes += len(line)
+                yield line.decode("utf-8", "replace").rstrip("\n")
+            finished = True
+        finally:
+            p.stdout.close()
+            if not finished:
+                p.kill()
+            p.wait()
+            stats.record_command(time.time() - start, nbytes)
+        if p.returncode != 0:
+            errors.seek(0)
+            print(argv, p.returncode, errors.read().decode("utf-8", "replace").strip())
+            raise Exception("Something went wrong running the command %s %s" % (argv, kwargs))
+
+
+def _format_rfc2822(timestamp, offset):
+    """Format a commit timestamp like git's %cD, offset is a git timezone such as -0700."""
+    minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+    if offset.startswith("-"):
+        minutes = -minutes
+    date = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=int(timestamp), minutes=minutes)
+    return "%s, %d %s %d %02d:%02d:%02d %s" % (
+        ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")[date.weekday()],
+        date.day,
+        ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")[date.month - 1],
+        date.year,
+        date.hour,
+        date.minute,
+        date.second,
+        offset,
+    )
+
+
+def _commit_info_fields(sha, data):
+    """Return the COMMIT_INFO_FORMAT fields of the commit object data."""
+    headers, _, message = data.partition(b"\n\n")
+    fields = {}
+    for line in headers.split(b"\n"):
+        # Lines starting with a space continue a multi-line header (gpgsig, mergetag)
+        if not line.startswith(b" "):
+            key, _, value = line.partition(b" ")
+            fields.setdefault(key.decode("ascii", "replace"), value)
+    encoding = fields.get("encoding", b"utf-8").decode("ascii", "replace")
+    try:
+        message = message.decode(encoding, "replace")
+    except LookupError:
+        message = message.decode("utf-8", "replace")
+    author = fields["author"].decode("utf-8", "replace").rsplit(" ", 2)[0]
+    timestamp, offset = fields["committer"].decode("ascii", "replace").rsplit(" ", 2)[1:]
+    # Like git log, the subject is the first paragraph on one line and the body is the rest
+    paragraphs = message.lstrip("\n").split("\n\n", 1)
+    subject = " ".join(line.strip() for line in paragraphs[0].splitlines())
+    body = paragraphs[1].lstrip("\n") if len(paragraphs) > 1 else ""
+    return [sha, timestamp, _format_rfc2822(timestamp, offset), author, subject, body]
+
+
+class GitSession(object):
+    """Long running git cat-file processes to read objects from.
+
+    A ``git cat-file --batch`` and a ``git cat-file --batch-check`` are
+    started the first time they are needed, then every commit, tree and
+    blob is read over their pipes instead of starting a new git.
+
+    Safe to use from several threads. A process forked from the one that
+    started them starts its own, and so does a process that changed to
+    another directory (possibly another repository) since.
+    """
+
+    # Trees requested at once when listing a tree, small enough that the
+    # requests never fill the pipe while git is blocked writing its answers
+    TREE_BATCH = 64
+
+    def __init__(self):
+        self._processes = {}
+        self._locks = {"--batch": threading.Lock(), "--batch-check": threading.Lock()}
+        self._pid = os.getpid()
+        self._mailmap = None
+
+    @staticmethod
+    def _repository():
+        """Return what git finds the repository from, cheaply."""
+        return os.getcwd(), os.environ.get("GIT_DIR")
+
+    def _process(self, mode):
+        if self._pid != os.getpid():
+            # Forked, the pipes belong to the parent
+            self._processes = {}
+            self._pid = os.getpid()
+        repository = self._repository()
+        process, started_in = self._processes.get(mode, (None, None))
+        if process is not None and started_in != repository:
+            # Reading another repository now
+            self._stop(process)
+            process = None
+        if process is None or process.poll() is not None:
+            env = os.environ.copy()
+            env["LANG"] = "C"
+            env["LANGUAGE"] = "C"
+            process = subprocess.Popen(
+                ("git", "cat-file", mode), stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env
+            )
+            self._processes[mode] = (process, repository)
+        return process
+
+    @staticmethod
+    def _valid_rev(rev):
+        """A rev is sent as one line, one with a line break would be read as several requests."""
+        return "\n" not in rev and "\r" not in rev
+
+    @staticmethod
+    def _read_header(process, rev):
+        header = process.stdout.readline().decode("utf-8", "replace").rstrip("\n")
+        if not header:
+            raise Exception("git cat-file exited while reading %s" % rev)
+        if header.endswith((" missing", " ambiguous")):
+            return None
+        fields = header.split()
+        if len(fields) != 3 or not fields[2].isdigit():
+            raise Exception("Unexpected answer from git cat-file for %s: %s" % (rev, header))
+        return fields[0], fields[1], int(fields[2])
+
+    def _discard(self, mode, process):
+        """Stop process after a protocol error, so it is never used again."""
+        if self._processes.get(mode, (None, None))[0] is process:
+            del self._processes[mode]
+        try:
+            process.kill()
+            process.wait()
+        except (IOError, OSError):
+            pass
+
+    def info(self, rev):
+        """Return the (sha, type, size) of rev, or None if it doesn't exist."""
+        rev = str(rev)
+        if not self._valid_rev(rev):
+            return None
+        with self._locks["--batch-check"]:
+            process = self._process("--batch-check")
+            start = time.time()
+            try:
+                process.stdin.write(rev.encode("utf-8") + b"\n")
+                process.stdin.flush()
+                found = self._read_header(process, rev)
+            except BaseException:
+                self._discard("--batch-check", process)
+                raise
+            stats.record_command(time.time() - start, 0)
+            return found
+
+    def _read_objects(self, revs):
+        """Return (sha, type, data) or None for each of revs, requesting them all at once."""
+        revs = [str(rev) for rev in revs]
+        requested = [rev for rev in revs if self._valid_rev(rev)]
+        process = self._process("--batch")
+        start = time.time()
+        nbytes = 0
+        try:
+            process.stdin.write(b"".join(rev.encode("utf-8") + b"\n" for rev in requested))
+            process.stdin.flush()
+            found = {}
+            for rev in requested:
+                header = self._read_header(process, rev)
+                if header is not None:
+                    sha, object_type, size = header
+                    header = (sha, object_type, process.stdout.read(size + 1)[:-1])
+                    nbytes += size
+                found[rev] = header
+        except BaseException:
+            # Don't leave a half read answer in the pipe for the next caller
+            self._discard("--batch", process)
+            raise
+        stats.record_command(time.time() - start, nbytes)
+        return [found.get(rev) for rev in revs]
+
+    def read(self, rev):
+        """Return the (sha, type, data) of rev, or None if it doesn't exist."""
+        with self._locks["--batch"]:
+            return self._read_objects([rev])[0]
+
+    def resolve(self, rev):
+        """Return the SHA rev names, or None if it doesn't exist."""
+        found = self.info(rev)
+        return found[0] if found else None
+
+    def blob(self, rev):
+        """Return the contents of the blob rev (such as "HEAD:setup.py"), or None if it doesn't exist."""
+        found = self.read(rev)
+        if found is None or found[1] != "blob":
+            return None
+        return found[2]
+
+    @property
+    def uses_mailmap(self):
+        """True if authors have to go through the mailmap, which only git log applies."""
+        repository = self._repository()
+        if self._mailmap is None or self._mailmap[0] != repository:
+            rc, config = run_command_status("git", "config", "--get-regexp", r"^mailmap\.")
+            rc_toplevel, toplevel = run_command_status("git", "rev-parse", "--show-toplevel")
+            self._mailmap = (
+                repository,
+                bool(
+                    (rc == 0 and config)
+                    or (rc_toplevel == 0 and os.path.exists(os.path.join(toplevel, ".mailmap")))
+                    or self.info("HEAD:.mailmap")
+                ),
+            )
+        return self._mailmap[1]
+
+    def commit_info(self, rev):
+        """Return the COMMIT_INFO_FORMAT fields of commit rev, or None if it doesn't exist.
+
+        Authors don't go through the mailmap, see uses_mailmap.
+        """
+        found = self.read(rev)
+        if found is None or found[1] != "commit":
+            return None
+        return _commit_info_fields(found[0], found[2])
+
+    def tree_files(self, tree):
+        """Return every file in tree, like git ls-tree -r --name-only (without quoting)."""
+        files = []
+        pending = [(tree, "")]
+        with self._locks["--batch"]:
+            while pending:
+                batch, pending = pending[: self.TREE_BATCH], pending[self.TREE_BATCH :]
+                for (rev, prefix), found in zip(batch, self._read_objects([rev for rev, _ in batch])):
+                    if found is None or found[1] != "tree":
+                        raise Exception("Not a tree: %s" % rev)
+                    data = found[2]
+                    position = 0
+                    while position < len(data):
+                        space = data.index(b" ", position)
+                        end = data.index(b"\0", space)
+                        name = prefix + data[space + 1 : end].decode("utf-8", "replace")
+                        sha = data[end + 1 : end + 21].hex()
+                        if data[position:space] == b"40000":
+                            pending.append((sha, name + "/"))
+                        else:
+                            files.append(name)
+                        position = end + 21
+        # ls-tree -r sorts by full path
+        return sorted(files, key=lambda name: name.encode("utf-8"))
+
+    def close(self):
+        """Stop the cat-file processes, they are restarted if needed again."""
+        if self._pid != os.getpid():
+            return
+        processes, self._processes = self._processes, {}
+        for process, _ in processes.values():
+            self._stop(process)
+
+    @staticmethod
+    def _stop(process):
+        try:
+            process.stdin.close()
+            process.wait()
+        except (IOError, OSError):
+            pass
+
+
+session = GitSession()
+atexit.register(session.close)
+
+
+class CommitFiles(dict):
+    """Dictionary of the files modified by each commit.
+
+    by_path maps each filename to the (commit, GitFile) pairs that touched
+    it, in the same order as the commits.
+    """
+
+    def __init__(self):
+        super(CommitFiles, self).__init__()
+        self.by_path = collections.defaultdict(list)
+
+    def add(self, commit, git_file):
+        self.setdefault(commit, []).append(git_file)
+        commits = self.by_path[git_file.filename]
+        if not commits or commits[-1][0] != commit:
+            commits.append((commit, git_file))
+
+
+def files_by_path(commit_files):
+    """Return a filename -> [(commit, GitFile)] dictionary for commit_files."""
+    if isinstance(commit_files, CommitFiles):
+        return commit_files.by_path
+    by_path = CommitFiles()
+    for commit, file_list in commit_files.items():
+        for git_file in file_list:
+            by_path.add(commit, git_file)
+    return by_path.by_path
+
+
+def _pathspec(paths):
+    """Return the arguments and environment to limit a git command to paths."""
+    if paths is None:
+        return (), {}
+    # Don't treat special characters in filenames as globs
+    return ("--",) + tuple(paths), {"GIT_LITERAL_PATHSPECS": "1"}
+
+
+class Backend(object, metaclass=abc.ABCMeta):
+    """Where the history of the repository is read from.
+
+    The functions of this module go through the backend picked with
+    set_backend, one of BACKENDS.
+    """
+
+    name = None
+
+    @abc.abstractmethod
+    def resolve(self, rev):
+        """Return the SHA rev names, or None if it doesn't exist."""
+
+    @abc.abstractmethod
+    def resolve_range(self, git_range):
+        """Return git_range with every revision replaced by its SHA, like git rev-parse."""
+
+    @abc.abstractmethod
+    def files_touched(self, git_range, paths=None):
+        """Return the CommitFiles of the commits in git_range, like git log --raw."""
+
+    @abc.abstractmethod
+    def tree_files(self, tree):
+        """Return every file in tree, like git ls-tree -r --name-only."""
+
+    @abc.abstractmethod
+    def commit_info(self, commits):
+        """Return a commit -> COMMIT_INFO_FORMAT fields dictionary for the commits that exist."""
+
+    @abc.abstractmethod
+    def range_patches(self, git_range, paths=None):
+        """Yield the lines of the patches of git_range, like git log --pretty=%H --unified=0 -p."""
+
+    @abc.abstractmethod
+    def commit_patch(self, commit):
+        """Return the patch of commit, like git log -1 --format= -p."""
+
+
+class SubprocessBackend(Backend):
+    """Runs git, and reads objects through the git session."""
+
+    name = "subprocess"
+
+    def resolve(self, rev):
+        return session.resolve(rev)
+
+    def resolve_range(self, git_range):
+        return " ".join(run_command("git", "rev-parse", git_range).split())
+
+    def files_touched(self, git_range, paths=None):
+        commits = CommitFiles()
+        if paths is not None and not paths:
+            return commits
+        pathspec, env = _pathspec(paths)
+        cmd = ("git", "log", "--pretty=%H", "--raw", git_range) + pathspec
+        commit = None
+        for line in stream_command(*cmd, **env):
+            if SHA1_REGEX.match(line):
+                commit = line
+            elif line.strip():
+                commits.add(commit, GitFile.from_raw(line))
+        return commits
+
+    def tree_files(self, tree):
+        return session.tree_files(tree)
+
+    def commit_info(self, commits):
+        if not session.uses_mailmap:
+            info = {}
+            for commit in commits:
+                fields = session.commit_info(commit)
+                if fields is not None:
+                    info[commit] = fields
+            return info
+        cmd = "git", "log", "--no-walk=unsorted", "--stdin", "--format=" + COMMIT_INFO_FORMAT
+        data = run_command(*cmd, stdin="\n".join(commits).encode("utf-8"))
+        records = {}
+        for record in data.split("\x1e"):
+            record = record.strip("\n")
+            if record:
+                fields = record.split("\x1f", 5)
+                # run_command strips the output, and with it the separators of an empty body
+                fields += [""] * (6 - len(fields))
+                records[fields[0]] = fields
+        info = {}
+        for commit in commits:
+            if commit in records:
+                info[commit] = records[commit]
+            else:
+                # Abbreviated hash
+                for sha, fields in records.items():
+                    if sha.startswith(commit):
+                        info[commit] = fields
+                        break
+        return info
+
+    def range_patches(self, git_range, paths=None):
+        pathspec, env = _pathspec(paths)
+        cmd = ("git", "log", "--pretty=%H", "--unified=0", "-p", git_range) + pathspec
+        return stream_command(*cmd, **env)
+
+    def commit_patch(self, commit):
+        return run_command("git", "log", "-1", "--format=", "-p", str(commit))
+
+
+def _file_type(mode):
+    return int(mode, 8) & 0o170000
+
+
+def _raw_files(changes):
+    """Turn ObjectStore.diff_trees changes into GitFiles, like git log --raw.
+
+    Only exact renames are detected, raises objects.Unsupported if there may
+    be others.
+    """
+    deleted = collections.defaultdict(list)
+    for change in changes:
+        if change[1] is None:
+            deleted[change[2]].append(change)
+    renamed = set()
+    for change in changes:
+        if change[0] is None and deleted.get(change[3]) and change[3] != EMPTY_BLOB:
+            renamed.add(deleted[change[3]].pop(0)[4])
+            renamed.add(change[4])
+    unpaired = [change for change in changes if (change[0] is None or change[1] is None) and change[4] not in renamed]
+    if any(change[0] is None for change in unpaired) and any(change[1] is None for change in unpaired):
+        raise objects.Unsupported("Only exact renames are supported")
+    files = []
+    for old_mode, new_mode, old_sha, new_sha, path in changes:
+        if path in renamed:
+            if old_mode is None:
+                files.append(GitFile(path, GitFile.RENAME_EDIT))
+        elif old_mode is None:
+            files.append(GitFile(path, GitFile.ADDED))
+        elif new_mode is None:
+            files.append(GitFile(path, GitFile.DELETED))
+        elif _file_type(old_mode) != _file_type(new_mode):
+            files.append(GitFile(path, GitFile.TYPE))
+        else:
+            files.append(GitFile(path, GitFile.MODIFIED))
+    return files
+
+
+def _in_paths(path, paths):
+    return any(path == p or path.startswith(p.rstrip("/") + "/") for p in paths)
+
+
+class ObjectBackend(SubprocessBackend):
+    """Reads the repository in process with objects.ObjectStore, without starting git.
+
+    Patches are still made by git, whose diff can't be matched exactly, and
+    so is anything the store doesn't support (such as inexact renames, or
+    dates in revisions).
+    """
+
+    name = "objects"
+
+    def __init__(self, git_dir=None, work_tree=None):
+        if git_dir is None:
+            git_dir, work_tree = objects.find_git_dir()
+        self.store = objects.ObjectStore(git_dir, work_tree)
+        self._mailmap = None
+
+    def resolve(self, rev):
+        try:
+            return self.store.resolve(rev)
+        except KeyError:
+            return None
+        except objects.Unsupported:
+            return super(ObjectBackend, self).resolve(rev)
+
+    def _resolve(self, rev):
+        try:
+            return self.store.resolve(rev)
+        except KeyError:
+            raise Exception("Unknown revision %s" % rev)
+
+    def _revisions(self, git_range):
+        """Return the (SHA, excluded) of every revision git_range names, in order."""
+        revisions = []
+        for token in git_range.split():
+            if "..." in token:
+                raise objects.Unsupported("Symmetric differences are not supported")
+            if ".." in token:
+                start, end = token.split("..", 1)
+                revisions += [(self._resolve(end or "HEAD"), False), (self._resolve(start or "HEAD"), True)]
+            elif token.startswith("^"):
+                revisions.append((self._resolve(token[1:]), True))
+            else:
+                revisions.append((self._resolve(token), False))
+        return revisions
+
+    def _range(self, git_range):
+        """Return the commits git_range includes and excludes, as (include, exclude)."""
+        revisions = self._revisions(git_range)
+        include = [self.store.peel(sha, "commit") for sha, excluded in revisions if not excluded]
+        exclude = [self.store.peel(sha, "commit") for sha, excluded in revisions if excluded]
+        return include, exclude
+
+    def resolve_range(self, git_range):
+        try:
+            return " ".join(("^" if excluded else "") + sha for sha, excluded in self._revisions(git_range))
+        except objects.Unsupported:
+            return super(ObjectBackend, self).resolve_range(git_range)
+
+    def files_touched(self, git_range, paths=None):
+        commits = CommitFiles()
+        if paths is not None and not paths:
+            return commits
+        try:
+            include, exclude = self._range(git_range)
+            for sha in self.store.rev_list(include, exclude):
+                commit = self.store.commit(sha)
+                if len(commit.parents) > 1:
+                    if paths is not None:
+                        # git log simplifies the history of paths through merges
+                        raise objects.Unsupported("Path limited history through merges is not supported")
+                    # git log --raw shows no changes for merges
+                    continue
+                parent = self.store.commit(commit.parents[0]).tree if commit.parents else None
+                changes = self.store.diff_trees(parent, commit.tree)
+                if paths is not None:
+                    changes = [change for change in changes if _in_paths(change[4], paths)]
+                for git_file in _raw_files(changes):
+                    commits.add(sha, git_file)
+            return commits
+        except objects.Unsupported as e:
+            log.debug("Running git log --raw for %s: %s", git_range, e)
+            return super(ObjectBackend, self).files_touched(git_range, paths)
+
+    def tree_files(self, tree):
+        try:
+            return self.store.tree_files(tree)
+        except KeyError:
+            raise Exception("Not a tree: %s" % tree)
+
+    @property
+    def uses_mailmap(self):
+        """True if authors have to go through the mailmap, which only git log applies."""
+        if self._mailmap is None:
+            configs = [
+                os.path.join(self.store.common_dir, "config"),
+                os.path.expanduser("~/.gitconfig"),
+                os.path.join(os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config"), "git", "config"),
+            ]
+            mailmap = False
+            for config in configs:
+                if os.path.isfile(config):
+                    with open(config, "rb") as f:
+                        mailmap = mailmap or b"mailmap" in f.read().lower()
+            if self.store.work_tree and os.path.exists(os.path.join(self.store.work_tree, ".mailmap")):
+                mailmap = True
+            try:
+                mailmap = mailmap or bool(self.store.resolve("HEAD:.mailmap"))
+            except (KeyError, objects.Unsupported):
+                pass
+            self._mailmap = mailmap
+        return self._mailmap
+
+    def commit_info(self, commits):
+        if self.uses_mailmap:
+            return super(ObjectBackend, self).commit_info(commits)
+        info = {}
+        for commit in commits:
+            try:
+                sha = self.store.resolve(commit)
+                obj_type, data = self.store.read(sha)
+            except KeyError:
+                continue
+            except objects.Unsupported:
+                info.update(super(ObjectBackend, self).commit_info([commit]))
+                continue
+            if obj_type == "commit":
+                info[commit] = _commit_info_fields(sha, data)
+        return info
+
+
+BACKENDS = {SubprocessBackend.name: SubprocessBackend, ObjectBackend.name: ObjectBackend}
+
+backend = SubprocessBackend()
+
+
+def set_backend(name):
+    """Read the repository with the backend called name (see BACKENDS) from now on."""
+    global backend
+    try:
+        backend = BACKENDS[name]()
+    except objects.Unsupported as e:
+        log.warning("Unable to use the %s backend (%s), running git instead", name, e)
+        backend = SubprocessBackend()
+    return backend
+
+
+def files_touched(git_range, paths=None):
+    """Run git log --pretty="%H" --raw  git_range -- paths.
+
+    Generate a dictionary (CommitFiles) of files modified by the commits in range
+
+    If paths is passed in, only look at those files
+    """
+    return backend.files_touched(git_range, paths)
+
+
+def rename_sources(commits, paths):
+    """Return the old names of the files in paths that commits renamed.
+
+    Runs git diff-tree -M --diff-filter=R over commits, with no pathspec so
+    git can pair each file with the one it was renamed from.
+    """
+    if not commits:
+        return set()
+    cmd = "git", "diff-tree", "--stdin", "-r", "-M", "--diff-filter=R"
+    sources = set()
+    for line in stream_command(*cmd, stdin="".join(commit + "\n" for commit in commits).encode("utf-8")):
+        if line.startswith(":"):
+            fields = line.split("\t")
+            if fields[-1] in paths:
+                sources.add(fields[1])
+    return sources
+
+
+def path_history(git_range, paths):
+    """Return (commit_files, paths) for the history of paths in git_range.
+
+    A pathspec hides the other side of a rename from git, so a file renamed
+    with changes in git_range looks added, and every line of it new. The
+    names such files had before are looked up and added to paths (following
+    chains of renames) until git can see every rename. The paths returned
+    are the ones to read patches with.
+    """
+    paths = set(paths)
+    checked = set()
+    while True:
+        commit_files = files_touched(git_range, paths=sorted(paths))
+        added = [
+            commit
+            for path in paths - checked
+            for commit, git_file in files_by_path(commit_files).get(path, [])
+            if git_file.state == GitFile.ADDED
+        ]
+        checked |= paths
+        sources = rename_sources(sorted(set(added)), checked) - checked
+        if not sources:
+            return commit_files, sorted(paths)
+        paths |= sources
 
 
-def pickaxe(snippet, git_range, filename=None):
+def pickaxe(snippet, git_range, filename=None, patches=None):
     """Run git log -S <snippet> <git_range> <filename>
 
     Use git pickaxe to 'Look for differences that change the number of occurrences of the
@@ -97,57 +784,321 @@ def pickaxe(snippet, git_range, filename=None):
 
     If filename is passed in only look in that file
 
+    If patches (a PatchStore for git_range) is passed in and has the history of
+    filename, look the snippet up in its line index instead of running git
+
     Return list of commits that modified that snippet
     """
+    if patches is not None and patches.covers(filename):
+        return patches.pickaxe(snippet, filename)
     cmd = "git", "log", "-b", "--pretty=%H", "-S", str(snippet), git_range
     if filename:
         cmd = cmd + (
             "--",
             filename,
         )
-    commits = run_command(*cmd).splitlines()
-    commits = [(commit, line_removed(snippet, commit)) for commit in commits]
-    # Couldn't find a good way to POSIX regex escape the code and use regex
-    # pickaxe to match full lines, so filter out partial results here.
-    # Filter out results that aren't a full line
-    commits = [commit for commit in commits if commit[1] is not None]
+    commits = []
+    for commit in stream_command(*cmd):
+        removed = line_removed(snippet, commit)
+        # Couldn't find a good way to POSIX regex escape the code and use regex
+        # pickaxe to match full lines, so filter out partial results here.
+        # Filter out results that aren't a full line
+        if removed is not None:
+            commits.append((commit, removed))
     return commits
 
 
-def line_removed(target_line, commit):
-    """Given a commit tell if target_line was added or removed.
+def normalize_line(line):
+    """Collapse whitespace, so lines compare like git log -b does."""
+    return " ".join(line.split())
 
-    True if line was removed
-    False if added
-    None if target_line wasn't found at all (because not a full line etc.)
+
+def first_line_change(changes, target_line):
+    """Return whether the first of the (text, removed) changes containing target_line removed it.
+
+    None if no changed line contains target_line. Whitespace changes are
+    ignored, so the text of a patch and the normalized text kept by the
+    history index give the same answer.
     """
-    cmd = "git", "log", "-1", "--format=", "-p", str(commit)
-    diff = run_command(*cmd)
-    for diff in whatthepatch.parse_patch(diff):
-        for line in diff.changes:
-            if target_line in line[2]:
+    target_line = normalize_line(target_line)
+    for text, removed in changes:
+        text = normalize_line(text)
+        if text and target_line in text:
+            return bool(removed)
+    return None
+
+
+def count_line_changes(changes, filename=None):
+    """Turn the (commit, path, removed) changes of a line into pickaxe results.
+
+    changes must be in git log order. Like git log -S, a commit only counts if
+    it changed the number of times the line occurs in a file (so moving a line
+    within a file is ignored). Whether it was added or removed is decided by
+    the first change in the commit, as line_removed does.
+    """
+    # commit -> [removed of first change, {path: added - removed}]
+    found = collections.OrderedDict()
+    for commit, path, removed in changes:
+        if commit not in found:
+            found[commit] = [removed, collections.Counter()]
+        if filename is None or path == filename:
+            found[commit][1][path] += -1 if removed else 1
+    return [(commit, removed) for commit, (removed, counts) in found.items() if any(counts.values())]
+
+
+class LineIntervals(object):
+    """A set of line numbers, kept as sorted [start, end) runs and searched with bisect.
+
+    The lines a commit added to a file come in a few runs (its hunks), so
+    this is much smaller than a set of every line number.
+    """
+
+    __slots__ = ("starts", "ends")
+
+    def __init__(self, runs=()):
+        self.starts = []
+        self.ends = []
+        for start, count in runs:
+            self.add(start, count)
+
+    def add(self, start, count=1):
+        """Add the count line numbers from start, merging with the runs they touch."""
+        end = start + count
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def __contains__(self, line_number):
+        if not isinstance(line_number, int):
+            return False
+        i = bisect.bisect_right(self.starts, line_number) - 1
+        return i >= 0 and line_number < self.ends[i]
+
+    def __iter__(self):
+        """Yield the (start, count) of each run."""
+        for start, end in zip(self.starts, self.ends):
+            yield start, end - start
+
+    def matches(self, line_numbers):
+        """Return the line_numbers in the set, searching the runs in one pass from left to right."""
+        if len(line_numbers) > 1:
+            # Later line numbers can't be in the runs before the last match
+            line_numbers = sorted(n for n in line_numbers if isinstance(n, int))
+        found = set()
+        i = 0
+        for line_number in line_numbers:
+            if isinstance(line_number, int):
+                i = bisect.bisect_right(self.starts, line_number, i)
+                if i and line_number < self.ends[i - 1]:
+                    found.add(line_number)
+        return found
+
+
+class Patch(object):
+    """Changes made by a single commit, parsed from its patch.
+
+    Only what line_removed, line_match and the PatchStore line index need is
+    kept: the ordered list of changed lines and the LineIntervals of lines
+    added to each file.
+    """
+
+    __slots__ = ("changes", "added")
+
+    def __init__(self, diff_text):
+        self.changes = []
+        self.added = collections.defaultdict(LineIntervals)
+        for diff in whatthepatch.parse_patch(diff_text):
+            path = diff.header.new_path
+            if path == "/dev/null":
+                path = diff.header.old_path
+            # Pure renames and mode changes have no changes
+            for line in diff.changes or ():
                 if line[0] is None:
                     # Line added
-                    return False
+                    self.changes.append((line[2], False, path))
+                    self.added[diff.header.new_path].add(line[1])
                 elif line[1] is None:
                     # Line removed
-                    return True
-    # target_line matched part of a line instead of a full line
-    return None
+                    self.changes.append((line[2], True, path))
+
+    def line_removed(self, target_line):
+        return first_line_change(((text, removed) for text, removed, path in self.changes), target_line)
+
+    def line_match(self, filename, line_number):
+        return line_number in self.added.get(filename, ())
+
+    def lines_match(self, filename, line_numbers):
+        """Return the line_numbers added to filename."""
+        intervals = self.added.get(filename)
+        return intervals.matches(line_numbers) if intervals is not None else set()
+
+
+class PatchStore(object):
+    """Patches of every commit in a git range.
+
+    The whole range is read with a single ``git log -p`` the first time the
+    store is queried, so line_removed and line_match can be answered from
+    memory instead of running ``git log -1 -p`` for every commit.
+
+    While reading the range every changed line is also added to an inverted
+    index, mapping the normalized line to the commits that added or removed
+    it, and each of its words to the lines it appears in. So pickaxe only
+    looks at the lines sharing a word with the snippet instead of running
+    git.
+
+    If paths is passed in, only the changes to those files are read.
+    """
+
+    def __init__(self, git_range, paths=None):
+        self.git_range = git_range
+        self.paths = None if paths is None else frozenset(paths)
+        self._patches = None
+        self._lines = None
+        self._words = None
+        self._lock = threading.RLock()
+
+    def covers(self, filename):
+        """Return True if the store has the history of filename (None for all files)."""
+        if self.paths is None:
+            return True
+        return filename is not None and filename in self.paths
+
+    def _add_patch(self, commit, diff_text):
+        patch = Patch(diff_text)
+        self._patches[commit] = patch
+        for text, removed, path in patch.changes:
+            key = normalize_line(text)
+            if key:
+                if key not in self._lines:
+                    for word in key.split(" "):
+                        self._words[word].add(key)
+                # Numbered, to merge the changes of several lines back into git log order
+                self._lines[key].append((self._changes, commit, path, removed))
+                self._changes += 1
+
+    def _load(self):
+        with self._lock:
+            if self._patches is None:
+                with stats.phase("read_patches"):
+                    self._read()
+
+    def _read(self):
+        lines = ()
+        if self.paths is None or self.paths:
+            lines = backend.range_patches(self.git_range, sorted(self.paths) if self.paths is not None else None)
+        self._patches = {}
+        self._lines = collections.defaultdict(list)
+        self._words = collections.defaultdict(set)
+        self._changes = 0
+        commit = None
+        diff = []
+        # Only the patch of one commit is held as text at a time
+        for line in lines:
+            if SHA1_REGEX.match(line) and len(line) == 40:
+                if commit:
+                    self._add_patch(commit, "\n".join(diff))
+                commit = line
+                diff = []
+            else:
+                diff.append(line)
+        if commit:
+            self._add_patch(commit, "\n".join(diff))
+
+    def get_patch(self, commit):
+        """Return the Patch for commit, fetching it on its own if outside the range."""
+        self._load()
+        commit = str(commit)
+        if commit not in self._patches:
+            patch = Patch(backend.commit_patch(commit))
+            with self._lock:
+                self._patches.setdefault(commit, patch)
+        return self._patches[commit]
+
+    def line_removed(self, target_line, commit):
+        return self.get_patch(commit).line_removed(target_line)
+
+    def line_match(self, commit, traceback_line):
+        return self.get_patch(commit).line_match(traceback_line.git_filename, traceback_line.line_number)
+
+    def lines_match(self, commit, filename, line_numbers):
+        return self.get_patch(commit).lines_match(filename, line_numbers)
+
+    def pickaxe(self, snippet, filename=None):
+        """Same as the pickaxe function, ignoring whitespace changes.
+
+        Like git log -S, lines containing snippet match too.
+        """
+        self._load()
+        snippet = normalize_line(str(snippet))
+        words = snippet.split(" ")
+        if len(words) > 2:
+            # The words inside the snippet are whole words of every line containing it
+            candidates = min((self._words.get(word, ()) for word in words[1:-1]), key=len)
+        else:
+            # Its last word starts a word (or is part of one) of every line containing it
+            candidates = set()
+            for word, lines in self._words.items():
+                if words[-1] in word:
+                    candidates.update(lines)
+        changes = heapq.merge(*[self._lines[text] for text in candidates if snippet in text])
+        return count_line_changes([change[1:] for change in changes], filename)
+
+
+class RangeHistory(PatchStore):
+    """The files touched and the patches of every commit in a range, read up front.
+
+    Can be passed as the index of api.lookup_stacktrace, so the lookups of
+    many stacktraces (in one process, or in processes forked after it was
+    read) share a single read of the range.
+    """
+
+    def __init__(self, git_range):
+        super(RangeHistory, self).__init__(git_range)
+        self.commit_files = files_touched(git_range)
+        self._load()
+
+    def lookup_range(self, git_range, update=True):
+        """Same as index.HistoryIndex.lookup_range, only for the range that was read."""
+        return self if git_range == self.git_range else None
+
+    def files_touched(self):
+        return self.commit_files
 
 
-def line_match(commit, traceback_line):
+def line_removed(target_line, commit, patches=None):
+    """Given a commit tell if target_line was added or removed.
+
+    True if line was removed
+    False if added
+    None if target_line wasn't found at all (because not a full line etc.)
+
+    If patches (a PatchStore) is passed in, use it instead of running git.
+    """
+    if patches is not None:
+        return patches.line_removed(target_line, commit)
+    return Patch(backend.commit_patch(commit)).line_removed(target_line)
+
+
+def line_match(commit, traceback_line, patches=None):
     """Return true if line_number was added to filename in commit"""
+    if patches is not None:
+        return patches.line_match(commit, traceback_line)
+    return Patch(backend.commit_patch(commit)).line_match(traceback_line.git_filename, traceback_line.line_number)
 
-    cmd = "git", "log", "-1", "--format=", "-p", str(commit)
-    diff = run_command(*cmd)
-    for diff in whatthepatch.parse_patch(diff):
-        if diff.header.new_path == traceback_line.git_filename:
-            for line in diff.changes:
-                if line[0] is None:
-                    if line[1] == traceback_line.line_number:
-                        return True
-    return False
+
+def lines_match(commit, filename, line_numbers, patches=None):
+    """Return the set of line_numbers commit added to filename.
+
+    Same as line_match for each line of filename, but the patch is only
+    looked up once and searched in one pass.
+    """
+    if patches is not None:
+        return patches.lines_match(commit, filename, line_numbers)
+    return Patch(backend.commit_patch(commit)).lines_match(filename, line_numbers)
 
 
 def format_one_commit(commit):
@@ -159,33 +1110,70 @@ def format_one_commit(commit):
     return "\n".join(result)
 
 
-def get_commit_info(commit, color=True):
+# Fields of a commit, separated by unit separators and terminated by a record separator
+COMMIT_INFO_FORMAT = "%H%x1f%ct%x1f%cD%x1f%aN <%aE>%x1f%s%x1f%b%x1e"
+
+# Commits are immutable, so their metadata can be cached for the life of the process
+_commit_info_cache = {}
+
+
+def prefetch_commit_info(commits):
+    """Fetch metadata for every uncached commit from the backend at once."""
+    missing = [str(commit) for commit in commits if str(commit) not in _commit_info_cache]
+    if not missing:
+        return
+    _commit_info_cache.update(backend.commit_info(missing))
+
+
+def get_commits_info(commits, color=True):
+    """Return a dictionary of CommitInfo for commits, running git at most once."""
+    prefetch_commit_info(commits)
     # Only use color if output is a terminal
-    if sys.stdout.isatty() and color:
-        cmd_prefix = "git", "log", "--color", "-1"
-    else:
-        cmd_prefix = "git", "log", "-1"
-    git_format = (
-        "--format=%C(auto,yellow)commit %H%C(auto,reset)%n" "Commit Date: %cD%nAuthor:      %aN <%aE>%nSubject:     %s"
-    )
-    summary = run_command(*(cmd_prefix + (git_format, commit)))
+    color = sys.stdout.isatty() and color
+    info = {}
+    for commit in commits:
+        sha, date, rfc_date, author, subject, body = _commit_info_cache[str(commit)]
+        body = body.strip()
+        if color:
+            summary = "\x1b[33mcommit %s\x1b[m\n" % sha
+        else:
+            summary = "commit %s\n" % sha
+        summary += "Commit Date: %s\nAuthor:      %s\nSubject:     %s" % (rfc_date, author, subject)
+
+        # Find phabricator URL
+        url = None
+        for line in body.splitlines():
+            if line.startswith("Differential Revision:"):
+                url = line.split(" ")[2]
 
-    # Find phabricator URL
-    cmd = "git", "log", "-1", "--pretty=%b", commit
-    body = run_command(*cmd)
-    url = None
-    for line in body.splitlines():
-        if line.startswith("Differential Revision:"):
-            url = line.split(" ")[2]
+        date = datetime.datetime.fromtimestamp(int(date))
+        info[commit] = CommitInfo(summary=summary, subject=subject, body=body, url=url, author=author, date=date)
+    return info
 
-    cmd = "git", "log", "-1", "--format=%ct|%aN <%aE>", str(commit)
-    date, author = run_command(*cmd).split("|", 1)
-    date = datetime.datetime.fromtimestamp(int(date))
 
-    cmd = "git", "log", "-1", "--format=%s", str(commit)
-    subject = run_command(*cmd)
+def get_commit_info(commit, color=True):
+    return get_commits_info([commit], color=color)[commit]
+
+
+# Ranges between two SHAs never change, so whether they have commits is kept
+_valid_ranges = {}
+# (since, branch, branch SHA) -> (time resolved, range), reused for SINCE_CACHE_SECONDS
+# as dates like "1.day" move with the clock
+_since_ranges = {}
+SINCE_CACHE_SECONDS = 60
+RANGE_CACHE_SIZE = 1024
+
 
-    return CommitInfo(summary=summary, subject=subject, body=body, url=url, author=author, date=date)
+def _fixed_range(git_range):
+    """Return True if git_range is made of full SHAs, so always has the same commits."""
+    revs = git_range.split("..")
+    return len(revs) <= 2 and all(SHA1_REGEX.match(rev) and len(rev) == 40 for rev in revs)
+
+
+def _remember(cache, key, value):
+    if len(cache) >= RANGE_CACHE_SIZE:
+        cache.clear()
+    cache[key] = value
 
 
 def valid_range(git_range):
@@ -193,26 +1181,173 @@ def valid_range(git_range):
 
     Returns True or False
     """
-    cmd = "git", "log", "--oneline", git_range
-    data = run_command(*cmd)
-    lines = data.splitlines()
-    return len(lines) > 0
+    if git_range in _valid_ranges:
+        return _valid_ranges[git_range]
+    # git stops after the first commit instead of listing the whole range
+    valid = bool(run_command("git", "rev-list", "--max-count=1", git_range))
+    if _fixed_range(git_range):
+        _remember(_valid_ranges, git_range, valid)
+    return valid
+
+
+def resolve_range(git_range):
+    """Return git_range with every revision replaced by its full SHA."""
+    return backend.resolve_range(git_range)
 
 
 def convert_since(since, branch=None):
-    cmd = "git", "log", "--pretty=%H", "--since=%s" % since
-    if branch:
-        cmd = cmd + (branch,)
-    data = run_command(*cmd)
-    lines = data.splitlines()
-    if len(lines) == 0:
+    """Return the range from the oldest to the newest commit on branch since the date since.
+
+    Results are reused for SINCE_CACHE_SECONDS while branch doesn't move.
+    """
+    if branch is not None and ("\n" in branch or "\r" in branch):
+        raise Exception("Invalid branch name %r" % branch)
+    head = backend.resolve(branch or "HEAD")
+    key = (since, branch, head)
+    cached = _since_ranges.get(key)
+    if head is not None and cached is not None and time.time() - cached[0] < SINCE_CACHE_SECONDS:
+        return cached[1]
+    cmd = "git", "rev-list", "--since=%s" % since, branch or "HEAD"
+    # Only the first and last commits are kept, not the whole list
+    first = last = None
+    for line in stream_command(*cmd):
+        first = first or line
+        last = line
+    if first is None:
         raise Exception("Didn't find any commits in 'since' range, try updating your git repo")
-    return "%s..%s" % (lines[-1], lines[0])
+    git_range = "%s..%s" % (last, first)
+    if head is not None:
+        # Only branches that resolved are remembered, git rev-list validated the rest
+        _remember(_since_ranges, key, (time.time(), git_range))
+    return git_range
 
 
-def files(git_range):
+class TreeListing(object):
+    """All the files in a git tree."""
+
+    def __init__(self, files):
+        self.files = files
+        self._path_index = None
+        self._lock = threading.Lock()
+
+    @property
+    def path_index(self):
+        """paths.PathIndex of the files, built the first time it is needed."""
+        with self._lock:
+            if self._path_index is None:
+                self._path_index = paths.PathIndex(self.files)
+            return self._path_index
+
+
+class TreeCache(object):
+    """LRU cache of tree listings, keyed by tree SHA.
+
+    Trees are immutable, so a listing can be reused for every commit with the
+    same tree. If directory is set, listings are also stored there so they
+    survive between runs, keeping the max_files most recently used ones.
+    """
+
+    def __init__(self, max_size=4, directory=None, max_files=64):
+        self.max_size = max_size
+        self.directory = directory
+        self.max_files = max_files
+        self._trees = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, tree):
+        return os.path.join(self.directory, tree)
+
+    def _read(self, tree):
+        if self.directory:
+            try:
+                with open(self._path(tree), encoding="utf-8") as f:
+                    data = f.read()
+                # The modification time is when the listing was last used, for _prune
+                os.utime(self._path(tree))
+                return data.split("\0") if data else []
+            except (IOError, OSError):
+                pass
+        files = backend.tree_files(tree)
+        if self.directory:
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                # Write to a temporary file first so readers never see a partial listing
+                tmp = "%s.%d.tmp" % (self._path(tree), os.getpid())
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write("\0".join(files))
+                os.replace(tmp, self._path(tree))
+                self._prune()
+            except (IOError, OSError):
+                if log.isEnabledFor(logging.DEBUG):
+                    log.exception("Unable to store tree listing")
+        return files
+
+    def _prune(self):
+        """Remove the least recently used listings from directory, past max_files."""
+        listings = []
+        for name in os.listdir(self.directory):
+            if SHA1_REGEX.match(name) and len(name) == 40:
+                try:
+                    listings.append((os.path.getmtime(self._path(name)), name))
+                except OSError:
+                    # Removed by another process
+                    pass
+        listings.sort(reverse=True)
+        for _, name in listings[self.max_files :]:
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+    def get(self, tree):
+        """Return the TreeListing for tree."""
+        with self._lock:
+            if tree in self._trees:
+                self._trees.move_to_end(tree)
+                return self._trees[tree]
+        listing = TreeListing(self._read(tree))
+        with self._lock:
+            listing = self._trees.setdefault(tree, listing)
+            self._trees.move_to_end(tree)
+            while len(self._trees) > self.max_size:
+                self._trees.popitem(last=False)
+        return listing
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+
+
+tree_cache = TreeCache()
+
+# commit SHA -> tree SHA, commits are immutable
+_commit_trees = {}
+
+
+def resolve_tree(commit):
+    """Return the SHA of the tree of commit."""
+    if commit in _commit_trees:
+        return _commit_trees[commit]
+    tree = backend.resolve("%s^{tree}" % commit)
+    if tree is None:
+        raise Exception("Unknown commit: %s" % commit)
+    if SHA1_REGEX.match(commit) and len(commit) == 40:
+        _commit_trees[commit] = tree
+    return tree
+
+
+def tree_listing(git_range):
+    """Return the TreeListing for the end of git_range."""
     commit = git_range.split(".")[-1]
-    cmd = "git", "ls-tree", "-r", "--name-only", commit
-    data = run_command(*cmd)
-    files = data.splitlines()
-    return files
+    return tree_cache.get(resolve_tree(commit))
+
+
+def files(git_range):
+    """Return every file in the tree at the end of git_range."""
+    return tree_listing(git_range).files
+
+
+def path_index(git_range):
+    """Return a paths.PathIndex of the files in the tree at the end of git_range."""
+    return tree_listing(git_range).path_index
@@ -0,0 +1,254 @@
+"""Persistent index of per-commit facts.
+
+Which files a commit touched, which lines it added or removed and which
+lines of each file it added never change for a given commit SHA, so they are
+stored in a SQLite database under ``.git/`` and only commits that haven't
+been seen before are read from git.
+
+Example usage::
+
+    from git_stacktrace import api
+    from git_stacktrace import index
+
+    history_index = index.HistoryIndex()
+    results = api.lookup_stacktrace(traceback, git_range, index=history_index)
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+
+from git_stacktrace import git
+
+log = logging.getLogger(__name__)
+
+DEFAULT_FILENAME = "git-stacktrace.sqlite"
+TREE_CACHE_DIRNAME = "git-stacktrace-trees"
+
+# Bump when the layout of the tables changes, the index is rebuilt from scratch
+SCHEMA_VERSION = 2
+# Commit lists of resolved ranges kept by a HistoryIndex
+RANGE_CACHE_SIZE = 16
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS commits (sha TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS files (sha TEXT, path TEXT, state TEXT);
+CREATE INDEX IF NOT EXISTS files_sha ON files (sha);
+CREATE TABLE IF NOT EXISTS lines (text TEXT, sha TEXT, path TEXT, removed INTEGER);
+CREATE INDEX IF NOT EXISTS lines_text ON lines (text);
+CREATE INDEX IF NOT EXISTS lines_sha ON lines (sha);
+CREATE TABLE IF NOT EXISTS words (word TEXT, text TEXT, PRIMARY KEY (word, text)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hunks (sha TEXT, path TEXT, start INTEGER, count INTEGER);
+CREATE INDEX IF NOT EXISTS hunks_sha_path ON hunks (sha, path);
+"""
+
+
+def default_path():
+    """Location of the index inside the current repository's .git directory."""
+    git_dir = git.run_command("git", "rev-parse", "--git-dir")
+    return os.path.join(git_dir, DEFAULT_FILENAME)
+
+
+def tree_cache_path():
+    """Directory for git.TreeCache inside the current repository's .git directory."""
+    git_dir = git.run_command("git", "rev-parse", "--git-dir")
+    return os.path.join(git_dir, TREE_CACHE_DIRNAME)
+
+
+def _read_commits(commits):
+    """Yield (commit, [GitFile], Patch) for each commit, using a single git log."""
+    cmd = "git", "log", "--no-walk=unsorted", "--stdin", "--pretty=%H", "--raw", "--unified=0", "-p"
+    commit = None
+    files = []
+    diff = []
+    for line in git.stream_command(*cmd, stdin="\n".join(commits).encode("utf-8")):
+        if git.SHA1_REGEX.match(line) and len(line) == 40:
+            if commit:
+                yield commit, files, git.Patch("\n".join(diff))
+            commit = line
+            files = []
+            diff = []
+        elif line.startswith(":") and "\t" in line and not diff:
+            files.append(git.GitFile.from_raw(line))
+        elif line.strip() or diff:
+            diff.append(line)
+    if commit:
+        yield commit, files, git.Patch("\n".join(diff))
+
+
+class HistoryIndex(object):
+    """SQLite backed index of the commits of a repository."""
+
+    def __init__(self, path=None):
+        if path is None:
+            path = default_path()
+        self.path = path
+        self._lock = threading.Lock()
+        # Held while finding and adding missing commits, so only one thread reads them from git
+        self._update_lock = threading.Lock()
+        # resolved range -> its commits, which never change
+        self._ranges = {}
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            version = self._db.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                for table in ("commits", "files", "lines", "hunks", "words"):
+                    self._db.execute("DROP TABLE IF EXISTS %s" % table)
+                self._db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def _execute(self, query, params=()):
+        with self._lock:
+            return self._db.execute(query, params).fetchall()
+
+    def missing(self, commits):
+        """Return the commits that haven't been indexed yet."""
+        indexed = set()
+        for start in range(0, len(commits), 500):
+            chunk = commits[start : start + 500]
+            query = "SELECT sha FROM commits WHERE sha IN (%s)" % ",".join("?" * len(chunk))
+            indexed.update(row[0] for row in self._execute(query, chunk))
+        return [commit for commit in commits if commit not in indexed]
+
+    def add_commits(self, commits):
+        """Read commits from git and store them in the index.
+
+        Commits that were indexed in the meantime, by another thread or
+        process, are skipped.
+        """
+        if not commits:
+            return
+        log.debug("Indexing %d commits", len(commits))
+        for commit, files, patch in _read_commits(commits):
+            with self._lock, self._db:
+                # Take the write lock before checking, so no one else can add commit in between
+                self._db.execute("BEGIN IMMEDIATE")
+                if self._db.execute("SELECT 1 FROM commits WHERE sha = ?", (commit,)).fetchone():
+                    continue
+                self._db.executemany(
+                    "INSERT INTO files VALUES (?, ?, ?)", [(commit, f.filename, f.state) for f in files]
+                )
+                lines = [
+                    (git.normalize_line(text), commit, path, removed)
+                    for text, removed, path in patch.changes
+                    if git.normalize_line(text)
+                ]
+                self._db.executemany("INSERT INTO lines VALUES (?, ?, ?, ?)", lines)
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO words VALUES (?, ?)",
+                    set((word, text) for text, _, _, _ in lines for word in text.split(" ")),
+                )
+                self._db.executemany(
+                    "INSERT INTO hunks VALUES (?, ?, ?, ?)",
+                    [
+                        (commit, path, start, count)
+                        for path, intervals in patch.added.items()
+                        for start, count in intervals
+                    ],
+                )
+                self._db.execute("INSERT INTO commits VALUES (?)", (commit,))
+
+    def _rev_list(self, git_range):
+        """Return the commits in git_range, listed once per resolved range."""
+        resolved = git.resolve_range(git_range)
+        commits = self._ranges.get(resolved)
+        if commits is None:
+            commits = git.run_command("git", "rev-list", *resolved.split()).splitlines()
+            if len(self._ranges) >= RANGE_CACHE_SIZE:
+                self._ranges.clear()
+            self._ranges[resolved] = commits
+        return commits
+
+    def covers(self, git_range):
+        """Return True if every commit in git_range has been indexed."""
+        return not self.missing(self._rev_list(git_range))
+
+    def lookup_range(self, git_range, update=True):
+        """Return an IndexedRange for git_range.
+
+        If update is True, commits that haven't been indexed yet are added
+        first, otherwise None is returned unless the index covers the range.
+        """
+        commits = self._rev_list(git_range)
+        with self._update_lock:
+            missing = self.missing(commits)
+            if missing:
+                if not update:
+                    return None
+                self.add_commits(missing)
+        return IndexedRange(self, commits)
+
+
+class IndexedRange(object):
+    """The commits of a git range, answered from a HistoryIndex.
+
+    Can be used in place of a git.PatchStore.
+    """
+
+    def __init__(self, history_index, commits):
+        self.index = history_index
+        self.commits = commits
+        self._positions = dict((commit, i) for i, commit in enumerate(commits))
+
+    def covers(self, filename):
+        """The index has the history of every file."""
+        return True
+
+    def files_touched(self):
+        """Same as git.files_touched for the range."""
+        commits = git.CommitFiles()
+        for commit in self.commits:
+            for path, state in self.index._execute(
+                "SELECT path, state FROM files WHERE sha = ? ORDER BY rowid", (commit,)
+            ):
+                commits.add(commit, git.GitFile(path, state))
+        return commits
+
+    def line_removed(self, target_line, commit):
+        """Same as git.PatchStore.line_removed."""
+        rows = self.index._execute("SELECT text, removed FROM lines WHERE sha = ? ORDER BY rowid", (str(commit),))
+        return git.first_line_change(rows, target_line)
+
+    def line_match(self, commit, traceback_line):
+        if not isinstance(traceback_line.line_number, int):
+            # Same as git.Patch, only integer line numbers can match
+            return False
+        rows = self.index._execute(
+            "SELECT 1 FROM hunks WHERE sha = ? AND path = ? AND start <= ? AND start + count > ?",
+            (str(commit), traceback_line.git_filename, traceback_line.line_number, traceback_line.line_number),
+        )
+        return bool(rows)
+
+    def lines_match(self, commit, filename, line_numbers):
+        """Same as git.PatchStore.lines_match."""
+        rows = self.index._execute(
+            "SELECT start, count FROM hunks WHERE sha = ? AND path = ? ORDER BY start", (str(commit), filename)
+        )
+        return git.LineIntervals(rows).matches(line_numbers)
+
+    def pickaxe(self, snippet, filename=None):
+        """Same as git.PatchStore.pickaxe."""
+        snippet = git.normalize_line(str(snippet))
+        words = snippet.split(" ")
+        rows = []
+        if len(words) > 2:
+            # Like git.PatchStore, only lines having the snippet's inner words can contain it. Usually the
+            # snippet is a whole line, so this finds that one text and reads its rows through lines_text.
+            texts = self.index._execute(
+                "SELECT text FROM words WHERE word = ? AND instr(text, ?) > 0", (max(words[1:-1], key=len), snippet)
+            )
+            query = "SELECT rowid, sha, path, removed FROM lines WHERE text = ?"
+            for (text,) in texts:
+                rows.extend(row for row in self.index._execute(query, (text,)) if row[1] in self._positions)
+        else:
+            # Too short to look up, only search the lines of the range
+            query = "SELECT rowid, sha, path, removed FROM lines WHERE sha IN (%s) AND instr(text, ?) > 0"
+            for start in range(0, len(self.commits), 500):
+                chunk = self.commits[start : start + 500]
+                rows.extend(self.index._execute(query % ",".join("?" * len(chunk)), tuple(chunk) + (snippet,)))
+        rows = sorted((self._positions[sha], rowid, sha, path, removed) for rowid, sha, path, removed in rows)
+        return git.count_line_changes([(sha, path, bool(removed)) for _, _, sha, path, removed in rows], filename)
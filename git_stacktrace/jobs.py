@@ -0,0 +1,128 @@
+"""Run lookups in the background and poll for their results.
+
+Used by the server's ``/jobs`` endpoints, so lookups that take longer than
+a proxy's idle timeout don't depend on one long request::
+
+    job_queue = jobs.JobQueue(workers=2, max_pending=16, ttl=600)
+    job = job_queue.submit(lambda job: api.lookup_stacktrace(traceback, git_range, progress=job.update_progress))
+    job.wait(30)
+    print(job.as_dict())
+"""
+
+import concurrent.futures
+import logging
+import threading
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job(object):
+    """A lookup running in a JobQueue."""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self.state = Job.QUEUED
+        self.created = time.time()
+        self.finished = None
+        self.progress = None
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    @property
+    def pending(self):
+        return self.state in (Job.QUEUED, Job.RUNNING)
+
+    def update_progress(self, phase, done, total):
+        """Progress callback for api.lookup_stacktrace."""
+        self.progress = {"phase": phase, "done": done, "total": total}
+
+    def wait(self, timeout=None):
+        """Wait up to timeout seconds for the job to finish, return True if it has."""
+        return self._done.wait(timeout)
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "state": self.state,
+            "created": self.created,
+            "finished": self.finished,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobQueue(object):
+    """Run jobs on a fixed number of threads.
+
+    At most max_pending jobs can be queued or running, submit raises
+    QueueFull beyond that. Finished jobs are forgotten ttl seconds after
+    they finish.
+    """
+
+    def __init__(self, workers=2, max_pending=16, ttl=600):
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+    @property
+    def pending(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.pending)
+
+    def _expire(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished is not None and now - job.finished > self.ttl:
+                del self._jobs[job_id]
+
+    def submit(self, fn):
+        """Queue fn(job) and return its Job, the result of fn becomes job.result."""
+        with self._lock:
+            self._expire()
+            if sum(1 for job in self._jobs.values() if job.pending) >= self.max_pending:
+                raise QueueFull("Too many jobs, %d are already queued or running" % self.max_pending)
+            job = Job(uuid.uuid4().hex)
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn)
+        return job
+
+    def _run(self, job, fn):
+        job.state = Job.RUNNING
+        try:
+            job.result = fn(job)
+            job.state = Job.DONE
+        except Exception as e:
+            log.exception("Job %s failed", job.id)
+            job.error = str(e)
+            job.state = Job.FAILED
+        finally:
+            job.finished = time.time()
+            job._done.set()
+
+    def get(self, job_id):
+        """Return the Job with job_id, or None if it doesn't exist or has expired."""
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,633 @@
+"""Read git objects, refs and history straight from the repository.
+
+Loose objects and packfiles (with version 2 pack indexes) are read in
+process, so no git process has to be started::
+
+    from git_stacktrace import objects
+
+    store = objects.ObjectStore(*objects.find_git_dir())
+    commit = store.commit(store.resolve("HEAD~1"))
+    print(store.tree_files(commit.tree))
+
+Only what git_stacktrace needs is supported. Revisions, repositories and
+histories that use anything else raise Unsupported, so the caller can fall
+back to running git.
+"""
+
+import collections
+import heapq
+import itertools
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+
+class Unsupported(Exception):
+    """The repository or revision uses something this module can't read."""
+
+
+OBJECT_TYPES = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+OFS_DELTA = 6
+REF_DELTA = 7
+
+TREE_MODE = b"40000"
+# mode, name and binary SHA of a tree entry
+TREE_ENTRY_REGEX = re.compile(rb"(\d+) ([^\0]*)\0(.{20})", re.S)
+
+HEX_REGEX = re.compile(r"^[0-9a-f]{4,40}$")
+SHA1_REGEX = re.compile(r"^[0-9a-f]{40}$")
+# A revision name followed by ~N, ^N and ^{type} suffixes
+REVISION_REGEX = re.compile(r"^(?P<name>[^~^:]+)(?P<suffixes>(?:~\d*|\^\d*|\^\{[a-z]*\})*)$")
+SUFFIX_REGEX = re.compile(r"\^\{([a-z]*)\}|~(\d*)|\^(\d*)")
+# Only plain ref names are looked up in the repository, anything else is left to git
+REF_NAME_REGEX = re.compile(r"^(?!/)(?!.*\.\.)(?!.*//)[A-Za-z0-9._/-]+$")
+# Where git looks for a short ref name, in order
+REF_RULES = ("%s", "refs/%s", "refs/tags/%s", "refs/heads/%s", "refs/remotes/%s", "refs/remotes/%s/HEAD")
+
+Commit = collections.namedtuple("Commit", ["sha", "tree", "parents", "date"])
+
+
+def find_git_dir(path="."):
+    """Return the (git_dir, work_tree) of the repository path is in, work_tree is None if bare."""
+    if os.environ.get("GIT_DIR"):
+        return os.path.abspath(os.environ["GIT_DIR"]), os.environ.get("GIT_WORK_TREE")
+    path = os.path.abspath(path)
+    while True:
+        dot_git = os.path.join(path, ".git")
+        if os.path.isdir(dot_git):
+            return dot_git, path
+        if os.path.isfile(dot_git):
+            # Worktrees and submodules point at their git directory
+            with open(dot_git) as f:
+                line = f.read().strip()
+            if line.startswith("gitdir: "):
+                return os.path.normpath(os.path.join(path, line[len("gitdir: ") :])), path
+        if all(os.path.exists(os.path.join(path, name)) for name in ("HEAD", "objects", "refs")):
+            return path, None
+        parent = os.path.dirname(path)
+        if parent == path:
+            raise Unsupported("Not a git repository")
+        path = parent
+
+
+def _read_file(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def _config_value(config, section, key):
+    """Return the value of key in section of the git config file contents config, or None.
+
+    Only plain "key = value" lines are understood, which is enough for the
+    core and extensions settings git writes itself.
+    """
+    current = None
+    value = None
+    for line in config.decode("utf-8", "replace").splitlines():
+        line = line.strip()
+        if line.startswith("["):
+            current = line[1:].split("]", 1)[0].strip().lower()
+        elif current == section and "=" in line:
+            name, _, found = line.partition("=")
+            if name.strip().lower() == key:
+                # The last one wins, like git
+                value = found.split("#", 1)[0].split(";", 1)[0].strip().strip('"')
+    return value
+
+
+def apply_delta(base, delta):
+    """Return the object delta (in git's pack delta format) makes from base."""
+
+    def varint(pos):
+        value = shift = 0
+        while True:
+            byte = delta[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                return value, pos
+
+    base_size, pos = varint(0)
+    if base_size != len(base):
+        raise Unsupported("Delta doesn't apply to its base")
+    size, pos = varint(pos)
+    out = []
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # Copy from base, the bits of op tell which offset and size bytes follow
+            offset = length = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (1 << (4 + i)):
+                    length |= delta[pos] << (8 * i)
+                    pos += 1
+            out.append(base[offset : offset + (length or 0x10000)])
+        elif op:
+            out.append(delta[pos : pos + op])
+            pos += op
+        else:
+            raise Unsupported("Invalid delta instruction")
+    data = b"".join(out)
+    if len(data) != size:
+        raise Unsupported("Delta produced the wrong size")
+    return data
+
+
+class Pack(object):
+    """A packfile and its version 2 index, both memory mapped."""
+
+    # Delta bases kept decoded, most deltas share their base with others
+    CACHE_SIZE = 256
+    CACHE_MAX_OBJECT = 1 << 20
+
+    def __init__(self, path):
+        self.path = path
+        with open(path[: -len(".pack")] + ".idx", "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.idx[:8] != b"\377tOc\0\0\0\2":
+            raise Unsupported("Only version 2 pack indexes are supported")
+        with open(path, "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = self._fanout(255)
+        self._shas = 8 + 256 * 4
+        self._offsets = self._shas + self.count * 24
+        self._large_offsets = self._offsets + self.count * 4
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _fanout(self, byte):
+        """Number of objects whose SHA starts with a byte up to byte."""
+        if byte < 0:
+            return 0
+        return struct.unpack_from(">I", self.idx, 8 + byte * 4)[0]
+
+    def _sha(self, i):
+        return self.idx[self._shas + i * 20 : self._shas + i * 20 + 20]
+
+    def _offset(self, i):
+        offset = struct.unpack_from(">I", self.idx, self._offsets + i * 4)[0]
+        if offset & 0x80000000:
+            offset = struct.unpack_from(">Q", self.idx, self._large_offsets + (offset & 0x7FFFFFFF) * 8)[0]
+        return offset
+
+    def _lower_bound(self, key):
+        lo, hi = self._fanout(key[0] - 1), self._fanout(key[0])
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._sha(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, sha):
+        """Return the offset of the object with the binary SHA sha, or None."""
+        i = self._lower_bound(sha)
+        if i < self.count and self._sha(i) == sha:
+            return self._offset(i)
+        return None
+
+    def expand(self, prefix):
+        """Return the hex SHAs starting with prefix (at least 2 hex digits)."""
+        found = []
+        i = self._lower_bound(bytes.fromhex(prefix[: len(prefix) // 2 * 2]))
+        while i < self.count:
+            sha = self._sha(i).hex()
+            if not sha.startswith(prefix):
+                break
+            found.append(sha)
+            i += 1
+        return found
+
+    def _header(self, offset):
+        byte = self.pack[offset]
+        pos = offset + 1
+        obj_type = (byte >> 4) & 7
+        size = byte & 0x0F
+        shift = 4
+        while byte & 0x80:
+            byte = self.pack[pos]
+            pos += 1
+            size |= (byte & 0x7F) << shift
+            shift += 7
+        return obj_type, size, pos
+
+    def _inflate(self, pos, size):
+        decompressor = zlib.decompressobj()
+        out = []
+        chunk = max(size + 64, 4096)
+        while not decompressor.eof:
+            data = self.pack[pos : pos + chunk]
+            if not data:
+                raise Unsupported("Truncated pack")
+            out.append(decompressor.decompress(data))
+            pos += len(data)
+        return b"".join(out)
+
+    def _cached(self, offset):
+        with self._lock:
+            found = self._cache.get(offset)
+            if found is not None:
+                self._cache.move_to_end(offset)
+            return found
+
+    def _store(self, offset, obj):
+        if len(obj[1]) > self.CACHE_MAX_OBJECT:
+            return
+        with self._lock:
+            self._cache[offset] = obj
+            while len(self._cache) > self.CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+    def read(self, offset, store):
+        """Return the (type, data) of the object at offset, store reads the bases of REF_DELTAs."""
+        deltas = []
+        while True:
+            found = self._cached(offset)
+            if found is not None:
+                obj_type, data = found
+                break
+            pack_type, size, pos = self._header(offset)
+            if pack_type == OFS_DELTA:
+                byte = self.pack[pos]
+                pos += 1
+                distance = byte & 0x7F
+                while byte & 0x80:
+                    byte = self.pack[pos]
+                    pos += 1
+                    distance = ((distance + 1) << 7) | (byte & 0x7F)
+                deltas.append((offset, pos, size))
+                offset -= distance
+            elif pack_type == REF_DELTA:
+                base = self.pack[pos : pos + 20].hex()
+                deltas.append((offset, pos + 20, size))
+                obj_type, data = store.read(base)
+                break
+            elif pack_type in OBJECT_TYPES:
+                obj_type, data = OBJECT_TYPES[pack_type], self._inflate(pos, size)
+                if deltas:
+                    self._store(offset, (obj_type, data))
+                break
+            else:
+                raise Unsupported("Unknown pack object type %d" % pack_type)
+        for delta_offset, pos, size in reversed(deltas):
+            data = apply_delta(data, self._inflate(pos, size))
+            self._store(delta_offset, (obj_type, data))
+        return obj_type, data
+
+
+class ObjectStore(object):
+    """The objects, refs and history of a repository.
+
+    Safe to use from several threads, and from processes forked after it
+    was created.
+    """
+
+    # Commits still walked after only excluded ones are left, in case of clock skew (like git)
+    SLOP = 5
+    # Parsed trees kept, most subtrees don't change between neighbouring commits
+    TREE_CACHE_SIZE = 4096
+
+    def __init__(self, git_dir, work_tree=None):
+        self.git_dir = git_dir
+        self.work_tree = work_tree
+        commondir = _read_file(os.path.join(git_dir, "commondir"))
+        self.common_dir = os.path.normpath(os.path.join(git_dir, commondir.decode().strip())) if commondir else git_dir
+        config = _read_file(os.path.join(self.common_dir, "config")) or b""
+        object_format = _config_value(config, "extensions", "objectformat")
+        if object_format not in (None, "sha1"):
+            raise Unsupported("The %s object format is not supported" % object_format)
+        self.object_dirs = [os.path.join(self.common_dir, "objects")]
+        alternates = _read_file(os.path.join(self.object_dirs[0], "info", "alternates")) or b""
+        for line in alternates.decode("utf-8", "replace").splitlines():
+            if line.strip() and not line.startswith("#"):
+                self.object_dirs.append(os.path.normpath(os.path.join(self.object_dirs[0], line.strip())))
+        shallow = _read_file(os.path.join(self.common_dir, "shallow")) or b""
+        self.shallow = frozenset(shallow.decode().split())
+        self._packs = None
+        self._packs_lock = threading.Lock()
+        self._packed_refs = (None, {})
+        self._commits = {}
+        self._trees = collections.OrderedDict()
+        self._trees_lock = threading.Lock()
+        # Both change which objects git sees
+        replace = os.path.join(self.common_dir, "refs", "replace")
+        if (os.path.isdir(replace) and os.listdir(replace)) or any(
+            name.startswith("refs/replace/") for name in self._packed()
+        ):
+            raise Unsupported("Replace refs are not supported")
+        if os.path.exists(os.path.join(self.common_dir, "info", "grafts")):
+            raise Unsupported("Grafts are not supported")
+
+    # Objects
+
+    def _load_packs(self, reload=False):
+        with self._packs_lock:
+            if self._packs is None or reload:
+                known = dict((pack.path, pack) for pack in self._packs or ())
+                packs = []
+                for object_dir in self.object_dirs:
+                    pack_dir = os.path.join(object_dir, "pack")
+                    for name in sorted(os.listdir(pack_dir)) if os.path.isdir(pack_dir) else ():
+                        path = os.path.join(pack_dir, name)
+                        if name.endswith(".pack") and os.path.exists(path[: -len(".pack")] + ".idx"):
+                            if path not in known:
+                                known[path] = Pack(path)
+                            packs.append(known[path])
+                self._packs = packs
+            return self._packs
+
+    def _read_loose(self, sha):
+        for object_dir in self.object_dirs:
+            data = _read_file(os.path.join(object_dir, sha[:2], sha[2:]))
+            if data is not None:
+                header, _, data = zlib.decompress(data).partition(b"\0")
+                return header.split(b" ")[0].decode("ascii"), data
+        return None
+
+    def read(self, sha):
+        """Return the (type, data) of the object with the hex SHA sha, raise KeyError if it doesn't exist."""
+        found = self._read_loose(sha)
+        if found is not None:
+            return found
+        binary = bytes.fromhex(sha)
+        for reload in (False, True):
+            # A repack can replace the packs while running
+            for pack in self._load_packs(reload):
+                offset = pack.find(binary)
+                if offset is not None:
+                    return pack.read(offset, self)
+            found = self._read_loose(sha)
+            if found is not None:
+                return found
+        raise KeyError(sha)
+
+    def expand(self, prefix):
+        """Return the hex SHAs of the objects starting with prefix."""
+        found = set()
+        for object_dir in self.object_dirs:
+            directory = os.path.join(object_dir, prefix[:2])
+            if os.path.isdir(directory):
+                found.update(prefix[:2] + name for name in os.listdir(directory) if name.startswith(prefix[2:]))
+        for pack in self._load_packs():
+            found.update(pack.expand(prefix))
+        return sorted(found)
+
+    def commit(self, sha):
+        """Return the Commit with SHA sha, raise KeyError if it isn't a commit."""
+        commit = self._commits.get(sha)
+        if commit is None:
+            obj_type, data = self.read(sha)
+            if obj_type != "commit":
+                raise KeyError(sha)
+            tree = None
+            parents = []
+            date = 0
+            for line in data.split(b"\n\n", 1)[0].split(b"\n"):
+                if line.startswith(b"tree "):
+                    tree = line[5:].decode("ascii")
+                elif line.startswith(b"parent "):
+                    parents.append(line[7:].decode("ascii"))
+                elif line.startswith(b"committer "):
+                    date = int(line.rsplit(b" ", 2)[1])
+            if sha in self.shallow:
+                parents = []
+            commit = self._commits.setdefault(sha, Commit(sha, tree, tuple(parents), date))
+        return commit
+
+    def tree_entries(self, sha):
+        """Return the (mode, name, sha) of each entry of a tree, mode and name as bytes."""
+        with self._trees_lock:
+            entries = self._trees.get(sha)
+            if entries is not None:
+                self._trees.move_to_end(sha)
+                return entries
+        obj_type, data = self.read(sha)
+        if obj_type != "tree":
+            raise KeyError(sha)
+        entries = [(mode, name, binary.hex()) for mode, name, binary in TREE_ENTRY_REGEX.findall(data)]
+        with self._trees_lock:
+            self._trees[sha] = entries
+            while len(self._trees) > self.TREE_CACHE_SIZE:
+                self._trees.popitem(last=False)
+        return entries
+
+    def tree_files(self, tree, prefix=""):
+        """Return every file in tree, in the order of git ls-tree -r."""
+        files = []
+        for mode, name, sha in self.tree_entries(tree):
+            path = prefix + name.decode("utf-8", "replace")
+            if mode == TREE_MODE:
+                files.extend(self.tree_files(sha, path + "/"))
+            else:
+                files.append(path)
+        return files
+
+    def diff_trees(self, old, new, prefix=""):
+        """Return the (old_mode, new_mode, old_sha, new_sha, path) of every file that differs.
+
+        old or new can be None for an empty tree. Modes are strings, and
+        None on the side where the file doesn't exist.
+        """
+        old_entries = dict((name, (mode, sha)) for mode, name, sha in self.tree_entries(old)) if old else {}
+        new_entries = dict((name, (mode, sha)) for mode, name, sha in self.tree_entries(new)) if new else {}
+        changes = []
+        for name in sorted(set(old_entries) | set(new_entries)):
+            old_entry = old_entries.get(name)
+            new_entry = new_entries.get(name)
+            if old_entry == new_entry:
+                continue
+            path = prefix + name.decode("utf-8", "replace")
+            old_tree = old_entry is not None and old_entry[0] == TREE_MODE
+            new_tree = new_entry is not None and new_entry[0] == TREE_MODE
+            if old_tree or new_tree:
+                changes.extend(
+                    self.diff_trees(old_entry[1] if old_tree else None, new_entry[1] if new_tree else None, path + "/")
+                )
+                # A file replaced by a directory, or the other way around
+                old_entry = None if old_tree else old_entry
+                new_entry = None if new_tree else new_entry
+                if old_entry is None and new_entry is None:
+                    continue
+            changes.append(
+                (
+                    old_entry[0].decode("ascii") if old_entry else None,
+                    new_entry[0].decode("ascii") if new_entry else None,
+                    old_entry[1] if old_entry else None,
+                    new_entry[1] if new_entry else None,
+                    path,
+                )
+            )
+        # git orders changes by path, files in a directory come where the directory name would
+        return sorted(changes, key=lambda change: change[4].encode("utf-8"))
+
+    # Refs and revisions
+
+    def _packed(self):
+        path = os.path.join(self.common_dir, "packed-refs")
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return {}
+        if self._packed_refs[0] != mtime:
+            refs = {}
+            for line in (_read_file(path) or b"").decode("utf-8", "replace").splitlines():
+                if line and line[0] not in "#^":
+                    sha, _, name = line.partition(" ")
+                    refs[name.strip()] = sha
+            self._packed_refs = (mtime, refs)
+        return self._packed_refs[1]
+
+    def ref(self, name, depth=0):
+        """Return the SHA ref name points at, following symbolic refs, or None."""
+        if not REF_NAME_REGEX.match(name):
+            raise Unsupported("Unsupported ref name %s" % name)
+        value = None
+        for directory in (self.git_dir, self.common_dir):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                value = (_read_file(path) or b"").decode("utf-8", "replace").strip()
+                break
+        else:
+            value = self._packed().get(name)
+        if not value:
+            return None
+        if value.startswith("ref: "):
+            return self.ref(value[len("ref: ") :], depth + 1) if depth < 5 else None
+        return value if SHA1_REGEX.match(value) else None
+
+    def peel(self, sha, obj_type=None):
+        """Follow tags (and commits to their tree for obj_type "tree") until an object of obj_type."""
+        while True:
+            found_type, data = self.read(sha)
+            if found_type == obj_type or (obj_type is None and found_type != "tag"):
+                return sha
+            if found_type == "tag":
+                sha = data[len(b"object ") : len(b"object ") + 40].decode("ascii")
+            elif found_type == "commit" and obj_type == "tree":
+                sha = self.commit(sha).tree
+            else:
+                raise KeyError(sha)
+
+    def _resolve_name(self, name):
+        if name == "@":
+            name = "HEAD"
+        if SHA1_REGEX.match(name):
+            self.read(name)
+            return name
+        for rule in REF_RULES:
+            sha = self.ref(rule % name)
+            if sha is not None:
+                return sha
+        if HEX_REGEX.match(name):
+            found = self.expand(name)
+            if len(found) == 1:
+                return found[0]
+            if len(found) > 1:
+                raise Unsupported("Ambiguous abbreviated SHA %s" % name)
+        raise KeyError(name)
+
+    def resolve(self, rev):
+        """Return the SHA rev names, raise KeyError if it doesn't exist.
+
+        Supports SHAs (full and abbreviated), ref names, the ~N, ^N and
+        ^{type} suffixes and rev:path.
+        """
+        rev, colon, path = rev.partition(":")
+        match = REVISION_REGEX.match(rev)
+        if match is None or "@{" in rev:
+            raise Unsupported("Unsupported revision %s" % rev)
+        sha = self._resolve_name(match.group("name"))
+        for suffix in SUFFIX_REGEX.finditer(match.group("suffixes")):
+            obj_type, first_parents, parent = suffix.groups()
+            if obj_type is not None:
+                if obj_type not in OBJECT_TYPES.values() and obj_type not in ("", "object"):
+                    raise Unsupported("Unsupported revision %s" % rev)
+                if obj_type != "object":
+                    # ^{} peels tags, ^{type} peels until an object of type
+                    sha = self.peel(sha, obj_type or None)
+                continue
+            sha = self.peel(sha, "commit")
+            try:
+                if parent is not None:
+                    if parent != "0":
+                        sha = self.commit(sha).parents[int(parent or 1) - 1]
+                else:
+                    for i in range(int(first_parents or 1)):
+                        sha = self.commit(sha).parents[0]
+            except IndexError:
+                raise KeyError(rev)
+        if colon:
+            sha = self.peel(sha, "tree")
+            for name in path.strip("/").split("/") if path.strip("/") else ():
+                for mode, entry_name, entry_sha in self.tree_entries(sha):
+                    if entry_name == name.encode("utf-8"):
+                        sha = entry_sha
+                        break
+                else:
+                    raise KeyError(path)
+        return sha
+
+    def rev_list(self, include, exclude=()):
+        """Return the commits reachable from include but not from exclude, in git log order.
+
+        Like git, newest commits (by commit date) are visited first, so
+        commits come out in the same order as git log.
+        """
+        counter = itertools.count()
+        queue = []
+        uninteresting = {}
+        visited = set()
+
+        def push(sha, excluded):
+            if sha in uninteresting:
+                if excluded and not uninteresting[sha]:
+                    mark(sha)
+                return
+            uninteresting[sha] = excluded
+            heapq.heappush(queue, (-self.commit(sha).date, next(counter), sha))
+
+        def mark(sha):
+            # Everything reachable from an excluded commit is excluded
+            stack = [sha]
+            uninteresting[sha] = True
+            while stack:
+                sha = stack.pop()
+                if sha in visited:
+                    for parent in self.commit(sha).parents:
+                        if not uninteresting.get(parent):
+                            uninteresting[parent] = True
+                            stack.append(parent)
+
+        for sha in exclude:
+            push(sha, True)
+        for sha in include:
+            push(sha, False)
+        commits = []
+        slop = self.SLOP
+        while queue:
+            sha = heapq.heappop(queue)[2]
+            visited.add(sha)
+            excluded = uninteresting[sha]
+            for parent in self.commit(sha).parents:
+                push(parent, excluded)
+            if not excluded:
+                commits.append(sha)
+                slop = self.SLOP
+            elif all(uninteresting[queued] for date, i, queued in queue):
+                slop -= 1
+                if not slop:
+                    break
+        return [sha for sha in commits if not uninteresting[sha]]
@@ -6,15 +6,27 @@ Currently only supports python stacktraces
 from __future__ import print_function
 
 import abc
+import hashlib
 import logging
 import re
 import traceback
 
+from git_stacktrace import paths
+from git_stacktrace import stats
+
 log = logging.getLogger(__name__)
 
 
 class ParseException(Exception):
-    pass
+    """The stacktrace couldn't be parsed.
+
+    language is the language that failed to parse it, or None if the
+    stacktrace didn't parse as any language.
+    """
+
+    def __init__(self, message="", language=None):
+        super(ParseException, self).__init__(message)
+        self.language = language
 
 
 class Line(object):
@@ -36,14 +48,41 @@ class Line(object):
         return (self.trace_filename, self.line_number, self.function_name, self.code)
 
 
+# Traceback classes parse_trace knows, in the order they are tried
+LANGUAGES = []
+
+# How many lines of a stacktrace are matched against the signatures of each language
+SNIFF_LINES = 20
+
+
+def register(language):
+    """Class decorator adding a Traceback subclass to LANGUAGES."""
+    LANGUAGES.append(language)
+    return language
+
+
 class Traceback(object, metaclass=abc.ABCMeta):
+    # Name of the language, reported in ParseException
+    language = None
+    # Regexes matching the start of lines only found in stacktraces of this language, used by sniff
+    signatures = ()
+    # True if filenames in the stacktrace end with the git path, False if the git path ends with them,
+    # lets longest_file_match search a PathIndex instead of calling file_match
+    trace_ends_with_path = None
+
     def __init__(self, blob):
         self.header = ""
         self.footer = ""
         self.lines = None
-        self.extract_traceback(self.prep_blob(blob))
-
-    def prep_blob(self, blob):
+        try:
+            self.extract_traceback(self.prep_blob(blob))
+        except ParseException as e:
+            if e.language is None:
+                e.language = self.language
+            raise
+
+    @staticmethod
+    def prep_blob(blob):
         """Cleanup input."""
         # remove empty lines
         if isinstance(blob, list):
@@ -77,6 +116,26 @@ class Traceback(object, metaclass=abc.ABCMeta):
     def __str__(self):
         return self.header + self.format_lines() + self.footer
 
+    def fingerprint(self):
+        """Return a hash of the frames of the traceback.
+
+        Tracebacks with the same frames have the same fingerprint, regardless
+        of the exception message or how the text was formatted.
+        """
+        fingerprint = hashlib.sha1(type(self).__name__.encode("utf-8"))
+        for line in self.lines:
+            frame = (
+                line.trace_filename,
+                line.line_number,
+                line.function_name,
+                line.code.strip() if line.code else line.code,
+                line.class_name,
+                line.native_method,
+                line.unknown_source,
+            )
+            fingerprint.update(repr(frame).encode("utf-8"))
+        return fingerprint.hexdigest()
+
     @abc.abstractmethod
     def file_match(self, trace_filename, git_files):
         """How to match a trace_filename to git_files.
@@ -85,10 +144,31 @@ class Traceback(object, metaclass=abc.ABCMeta):
         """
         return
 
+    def longest_file_match(self, trace_filename, git_files):
+        """Return the match with the most directories, or None.
 
+        git_files can be a list or a git_stacktrace.paths.PathIndex
+        """
+        if isinstance(git_files, paths.PathIndex):
+            if self.trace_ends_with_path is True:
+                return git_files.longest_suffix_of(trace_filename)
+            if self.trace_ends_with_path is False:
+                return git_files.longest_ending_with(trace_filename)
+            git_files = git_files.paths
+        matches = self.file_match(trace_filename, git_files)
+        if not matches:
+            return None
+        return max(matches, key=lambda filename: len(filename.split("/")))
+
+
+@register
 class PythonTraceback(Traceback):
     """Parse Traceback string."""
 
+    language = "python"
+    trace_ends_with_path = True
+    signatures = (r"Traceback \(most recent call last\):", r'  File "[^"]*", line \d+, in ')
+
     FILE_LINE_START = '  File "'
 
     def extract_traceback(self, lines):
@@ -147,7 +227,13 @@ class PythonTraceback(Traceback):
         return [f for f in git_files if trace_filename.endswith(f)]
 
 
+@register
 class JavaTraceback(Traceback):
+    language = "java"
+    trace_ends_with_path = False
+    # at package.Class.method(File.java:10)
+    signatures = (r"\s+at [^\s(]+\((?:Native Method|Unknown Source|[^\s():]+:\d+)\)\s*$",)
+
     def extract_traceback(self, lines):
         if not lines[0].startswith("\t"):
             self.header = lines[0] + "\n"
@@ -206,9 +292,15 @@ class JavaTraceback(Traceback):
         return [f for f in git_files if f.endswith(trace_filename)]
 
 
+@register
 class JavaScriptTraceback(Traceback):
     # This class matches a stacktrace that looks similar to https://v8.dev/docs/stack-trace-api
 
+    language = "javascript"
+    trace_ends_with_path = True
+    # at function (file.js:10:5), the column sets it apart from Java
+    signatures = (r"\s+at (?:[^\s(]+ )?\(?\S+:\d+:\d+\)?\s*$",)
+
     def extract_traceback(self, lines):
         if not lines[0].startswith("\t"):
             self.header = lines[0] + "\n"
@@ -243,13 +335,154 @@ class JavaScriptTraceback(Traceback):
         return [f for f in git_files if trace_filename.endswith(f)]
 
 
-def parse_trace(traceback_string):
-    languages = [PythonTraceback, JavaTraceback, JavaScriptTraceback]
+PYTHON_START = "Traceback (most recent call last):"
+# Lines between the tracebacks of chained python exceptions
+PYTHON_CHAINED = (
+    "During handling of the above exception, another exception occurred:",
+    "The above exception was the direct cause of the following exception:",
+)
+# Python 3.11+ points at the failing expression under the code
+PYTHON_CARETS = re.compile(r"^\s+[~^]+\s*$")
+# Java and JavaScript frames, their indentation is often changed to spaces in logs
+FRAME = re.compile(r"^\s+at\s")
+# Java elides the frames a cause shares with the exception it caused
+FRAMES_OMITTED = re.compile(r"^\s+\.\.\. \d+ (more|common frames omitted)$")
+JAVA_CAUSE = ("Caused by:", "Suppressed:")
+
+
+def _parse_lines(lines, languages):
     for language in languages:
         try:
-            return language(traceback_string)
+            return language(lines)
         except ParseException:
             log.debug("Failed to parse as %s", language)
-            # Try next language
-            continue
+    return None
+
+
+def extract_tracebacks(stream, max_lines=10000):
+    """Yield a Traceback for each stacktrace in stream, as soon as it ends.
+
+    stream is an iterable of lines, such as an open log file or sys.stdin.
+    Lines outside of stacktraces are skipped. Chained python exceptions and
+    java causes are part of the Traceback of the exception they lead to.
+
+    Only the stacktrace being read is kept in memory, and only up to
+    max_lines of it, longer stacktraces are skipped.
+    """
+    lines = None  # Of the stacktrace being read
+    languages = None  # [PythonTraceback], or None for Java and JavaScript, which are told apart by sniff
+    overflow = False
+    python_exception = False  # The exception line of a python traceback was read
+    python_chained = False
+    previous = ""  # The header of a Java or JavaScript stacktrace comes before its first frame
+    for line in stream:
+        line = line.rstrip("\r\n")
+        if lines is not None:
+            continued = True
+            append = line
+            if languages is not None:
+                stripped = line.strip()
+                if not python_exception:
+                    if PYTHON_CARETS.match(line):
+                        append = None
+                    elif not line.startswith("  "):
+                        python_exception = bool(stripped)
+                        continued = python_exception
+                elif not stripped:
+                    append = None
+                elif stripped in PYTHON_CHAINED:
+                    python_chained = True
+                elif python_chained and stripped == PYTHON_START:
+                    python_exception = python_chained = False
+                else:
+                    continued = False
+            elif FRAME.match(line):
+                append = "\t" + line.lstrip()
+            elif FRAMES_OMITTED.match(line):
+                append = None
+            elif line.lstrip().startswith(JAVA_CAUSE):
+                append = line.lstrip()
+            else:
+                continued = False
+            if continued:
+                if append is not None:
+                    if len(lines) < max_lines:
+                        lines.append(append)
+                    else:
+                        overflow = True
+                continue
+            if overflow:
+                log.debug("Skipped a stacktrace longer than %d lines", max_lines)
+            else:
+                traceback = _parse_lines(lines, languages or sniff(lines))
+                if traceback is not None:
+                    yield traceback
+            lines = None
+        if PYTHON_START in line:
+            lines = [PYTHON_START]
+            languages = [PythonTraceback]
+            python_exception = python_chained = overflow = False
+        elif FRAME.match(line):
+            lines = [previous, "\t" + line.lstrip()] if previous.strip() else ["\t" + line.lstrip()]
+            languages = None
+            overflow = False
+        previous = line
+    if lines is not None and not overflow:
+        traceback = _parse_lines(lines, languages or sniff(lines))
+        if traceback is not None:
+            yield traceback
+
+
+# The regex built from the signatures of LANGUAGES, rebuilt when a language is registered
+_signature_cache = {}
+
+
+def _signatures():
+    """Return a regex matching the signature of any language, with a group named after each language."""
+    languages = tuple(LANGUAGES)
+    if _signature_cache.get("languages") != languages:
+        pattern = "|".join(
+            "(?P<%s>%s)" % (language.language, "|".join(language.signatures))
+            for language in languages
+            if language.signatures
+        )
+        _signature_cache.update(languages=languages, regex=re.compile(pattern))
+    return _signature_cache["regex"]
+
+
+def sniff(lines):
+    """Return the languages lines should be parsed as.
+
+    Matches the first SNIFF_LINES lines against the signatures of every
+    language at once, the first line that matches decides the language.
+    If no line matches, returns all of LANGUAGES to try in turn.
+    """
+    signatures = _signatures()
+    for line in lines[:SNIFF_LINES]:
+        match = signatures.match(line)
+        if match:
+            return [language for language in LANGUAGES if language.language == match.lastgroup]
+    return LANGUAGES
+
+
+def parse_trace(traceback_string):
+    with stats.phase("parse_trace"):
+        if isinstance(traceback_string, str):
+            # No need to split more than sniff reads
+            languages = sniff(traceback_string.split("\n", SNIFF_LINES)[:SNIFF_LINES])
+        else:
+            try:
+                languages = sniff(Traceback.prep_blob(traceback_string))
+            except ParseException:
+                languages = LANGUAGES
+        if len(languages) == 1:
+            # Raises a ParseException with the language it was sniffed as
+            return languages[0](traceback_string)
+        for language in languages:
+            try:
+                return language(traceback_string)
+            except ParseException:
+                log.debug("Failed to parse as %s", language)
+                # Try next language
+                continue
     raise ParseException("Unable to parse traceback")
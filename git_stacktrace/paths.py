@@ -0,0 +1,163 @@
+"""Match stacktrace filenames to the files in a git tree."""
+
+
+def _key(paths, i):
+    """Sort key to pick the longest path by number of '/', the first one wins ties."""
+    return (paths[i].count("/"), -i)
+
+
+class _Node(object):
+    """Trie node for a shared tail of one or more paths.
+
+    children maps the previous path component to either another _Node or, if
+    only one path continues that way, the index of that path.
+    """
+
+    __slots__ = ("children", "terminal", "best")
+
+    def __init__(self):
+        self.children = {}
+        # index of the path that ends at this node
+        self.terminal = None
+        # index of the longest path in this subtree
+        self.best = None
+
+
+class PathIndex(object):
+    """Index of the files in a git tree, for Traceback.longest_file_match.
+
+    Paths are stored in a trie keyed by their components in reverse order
+    (filename first), so matching a stacktrace filename only walks its own
+    components instead of comparing it with every file in the tree. Both
+    directions are supported: the trace filename ends with the git path
+    (python, javascript) and the git path ends with the trace filename (java).
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self._root = _Node()
+        for i in range(len(self.paths)):
+            self._insert(i)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def _better(self, i, j):
+        if j is None or _key(self.paths, i) > _key(self.paths, j):
+            return i
+        return j
+
+    def _insert(self, i):
+        components = self.paths[i].split("/")[::-1]
+        node = self._root
+        node.best = self._better(i, node.best)
+        depth = 0
+        while True:
+            if depth == len(components):
+                node.terminal = i
+                return
+            component = components[depth]
+            child = node.children.get(component)
+            if child is None:
+                node.children[component] = i
+                return
+            if not isinstance(child, _Node):
+                # Split the leaf, so both paths can continue below it
+                leaf = child
+                child = _Node()
+                child.best = leaf
+                node.children[component] = child
+                leaf_components = self.paths[leaf].split("/")[::-1]
+                if depth + 1 == len(leaf_components):
+                    child.terminal = leaf
+                else:
+                    child.children[leaf_components[depth + 1]] = leaf
+            child.best = self._better(i, child.best)
+            node = child
+            depth += 1
+
+    def _subtree(self, child):
+        if not isinstance(child, _Node):
+            return [child]
+        found = []
+        stack = [child]
+        while stack:
+            node = stack.pop()
+            if node.terminal is not None:
+                found.append(node.terminal)
+            for grandchild in node.children.values():
+                if isinstance(grandchild, _Node):
+                    stack.append(grandchild)
+                else:
+                    found.append(grandchild)
+        return found
+
+    def _suffixes_of(self, filename):
+        components = filename.split("/")[::-1]
+        found = []
+        node = self._root
+        for depth, component in enumerate(components):
+            if depth and node.terminal is not None:
+                found.append(node.terminal)
+            # The first component of the git path only has to be a suffix of the trace's
+            for start in range(1, len(component)):
+                child = node.children.get(component[start:])
+                if child is None:
+                    continue
+                if isinstance(child, _Node):
+                    if child.terminal is not None:
+                        found.append(child.terminal)
+                elif self.paths[child].count("/") == depth:
+                    found.append(child)
+            child = node.children.get(component)
+            if child is None:
+                return found
+            if not isinstance(child, _Node):
+                if filename.endswith(self.paths[child]):
+                    found.append(child)
+                return found
+            node = child
+        if node.terminal is not None:
+            found.append(node.terminal)
+        return found
+
+    def _ending_with(self, filename):
+        components = filename.split("/")[::-1]
+        node = self._root
+        for component in components[:-1]:
+            child = node.children.get(component)
+            if child is None:
+                return []
+            if not isinstance(child, _Node):
+                return [child] if self.paths[child].endswith(filename) else []
+            node = child
+        # The component of the git path before the match only has to end with the trace's
+        return [child for component, child in node.children.items() if component.endswith(components[-1])]
+
+    def suffixes_of(self, filename):
+        """Return the git paths filename ends with."""
+        return [self.paths[i] for i in sorted(self._suffixes_of(filename))]
+
+    def longest_suffix_of(self, filename):
+        """Return the longest git path filename ends with, or None."""
+        found = self._suffixes_of(filename)
+        if not found:
+            return None
+        return self.paths[max(found, key=lambda i: _key(self.paths, i))]
+
+    def ending_with(self, filename):
+        """Return the git paths that end with filename."""
+        found = []
+        for child in self._ending_with(filename):
+            found.extend(self._subtree(child))
+        return [self.paths[i] for i in sorted(found)]
+
+    def longest_ending_with(self, filename):
+        """Return the longest git path that ends with filename, or None."""
+        found = [child.best if isinstance(child, _Node) else child for child in self._ending_with(filename)]
+        if not found:
+            return None
+        return self.paths[max(found, key=lambda i: _key(self.paths, i))]
@@ -1,11 +1,15 @@
+import threading
+
 from git_stacktrace import git
+from git_stacktrace import stats
 
 
 class Result(object):
     """Track matches to stacktrace in a given commit."""
 
-    def __init__(self, commit):
+    def __init__(self, commit, results=None):
         self.__commit = commit
+        self.__results = results
         self.files_modified = set()
         self.files_deleted = set()
         self.files_added = set()
@@ -13,11 +17,18 @@ class Result(object):
         self.lines_removed = set()
         self._line_numbers_matched = 0
         self.__commit_info_fetched = False
+        self.__lock = threading.Lock()
 
     def _lazy_fetch(self):
-        if not self.__commit_info_fetched:
-            self.__info = git.get_commit_info(self.commit, color=False)
-            self.__commit_info_fetched = True
+        if self.__commit_info_fetched:
+            return
+        with self.__lock:
+            if not self.__commit_info_fetched:
+                if self.__results is not None:
+                    # Fetch every commit in the results at once
+                    self.__results.fetch_commit_info()
+                self.__info = git.get_commit_info(self.commit, color=False)
+                self.__commit_info_fetched = True
 
     @property
     def commit(self):
@@ -77,6 +88,7 @@ class Result(object):
         return hash(self.commit)
 
     def __str__(self):
+        self._lazy_fetch()
         result = ""
         result += git.format_one_commit(self.commit) + "\n"
         if len(self.files_added) > 0:
@@ -146,15 +158,27 @@ class Results(object):
 
     def __init__(self):
         self.results = {}
+        # git_stacktrace.stats.Stats of the lookup, if collected
+        self.stats = None
+        self._lock = threading.Lock()
 
     def get_result(self, commit):
-        if commit not in self.results:
-            self.results[commit] = Result(commit)
-        return self.results[commit]
+        with self._lock:
+            if commit not in self.results:
+                self.results[commit] = Result(commit, self)
+            return self.results[commit]
+
+    def fetch_commit_info(self):
+        """Fetch commit information for every result with a single git call."""
+        with self._lock:
+            commits = list(self.results)
+        with stats.phase("get_commit_info"):
+            git.prefetch_commit_info(commits)
 
     def get_sorted_results(self):
         """Return list of results sorted by rank"""
-        results = self.results.values()
+        with self._lock:
+            results = list(self.results.values())
         return sorted(results, reverse=True)
 
     def get_sorted_results_by_dict(self):
@@ -1,11 +1,21 @@
 from __future__ import print_function
 
+import collections
+import concurrent.futures
+import hashlib
 import json
 import logging
 import os
+import threading
+import time
 
 from html import escape, unescape
+from wsgiref import simple_server
 from git_stacktrace import api
+from git_stacktrace import jobs
+from git_stacktrace import metrics
+from git_stacktrace import parse_trace
+from git_stacktrace import stats
 from urllib.parse import parse_qs
 from string import Template
 from datetime import date, datetime
@@ -13,6 +23,9 @@ from datetime import date, datetime
 log = logging.getLogger(__name__)
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
+# git_stacktrace.index.HistoryIndex to answer lookups from, if any
+history_index = None
+
 
 def json_serial(obj):
     """JSON serializer for objects not serializable by default json code"""
@@ -33,6 +46,7 @@ class Args(object):
 
     def __init__(self, params):
         self.params = params
+        self._traceback = None
 
     def _get_field(self, field, default=""):
         val = self.params.get(field, [default])
@@ -81,24 +95,285 @@ class Args(object):
             return "Invalid `type` value. Expected `by-date` or `by-range`."
         return None
 
-    def get_results(self):
+    @property
+    def traceback(self):
+        if self._traceback is None:
+            self._traceback = api.parse_trace(self.trace)
+        return self._traceback
+
+    def cache_key(self):
+        """Key for the results of get_results, or None if there is no trace.
+
+        Made of the frames of the trace and the range resolved to SHAs, so
+        the same trace pasted again gets the same key until the range moves.
+        """
+        if not self.trace:
+            return None
+        return (self.traceback.fingerprint(), api.resolve_range(self.git_range), self.fast)
+
+    def get_results(self, progress=None):
         if self.trace:
-            traceback = api.parse_trace(self.trace)
-            return api.lookup_stacktrace(traceback, self.git_range, fast=self.fast)
+            return api.lookup_stacktrace(
+                self.traceback, self.git_range, fast=self.fast, index=history_index, progress=progress
+            )
         else:
             return None
 
 
+class CachedResults(object):
+    """Results of a lookup, rendered once for every request that shows them."""
+
+    def __init__(self, results):
+        self.results = results
+        self._lock = threading.Lock()
+        self._commits = None
+        self._html = None
+
+    def commits(self):
+        with self._lock:
+            if self._commits is None:
+                self._commits = self.results.get_sorted_results_by_dict()
+            return self._commits
+
+    def html(self):
+        with self._lock:
+            if self._html is None:
+                sorted_results = self.results.get_sorted_results()
+                self._html = "\n<hr/>\n".join(
+                    ["<pre><code>" + escape(str(result)) + "</code></pre>" for result in sorted_results]
+                )
+            return self._html
+
+
+class ResultCache(object):
+    """LRU cache of CachedResults keyed by Args.cache_key()."""
+
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            if self.max_size <= 0:
+                return
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+result_cache = ResultCache()
+
+
+class SingleFlight(object):
+    """Run one call per key at a time.
+
+    Callers that ask for a key while a call for it is running wait for that
+    call and share its result (or exception) instead of running their own.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        """Return (fn(*args), shared), shared is True if another caller ran fn."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._calls)
+
+
+in_flight = SingleFlight()
+
+# Lookups submitted to /jobs
+job_queue = jobs.JobQueue()
+
+# Longest a GET /jobs/<id>?wait= request is held open, in seconds
+MAX_JOB_WAIT = 30
+
+REQUESTS = metrics.REGISTRY.counter(
+    "git_stacktrace_requests_total", "HTTP requests by endpoint, method and status code", ["endpoint", "method", "code"]
+)
+REQUEST_SECONDS = metrics.REGISTRY.histogram(
+    "git_stacktrace_request_duration_seconds", "Time to answer HTTP requests by endpoint", ["endpoint"]
+)
+PHASE_SECONDS = metrics.REGISTRY.histogram(
+    "git_stacktrace_lookup_phase_seconds", "Time spent in each phase of a lookup", ["phase"]
+)
+GIT_COMMANDS = metrics.REGISTRY.counter(
+    "git_stacktrace_git_commands_total", "git subprocesses run, by lookup phase", ["phase"]
+)
+GIT_SECONDS = metrics.REGISTRY.counter(
+    "git_stacktrace_git_seconds_total", "Time spent running git subprocesses, by lookup phase", ["phase"]
+)
+LOOKUPS_IN_FLIGHT = metrics.REGISTRY.gauge("git_stacktrace_lookups_in_flight", "Lookups currently running")
+JOBS_PENDING = metrics.REGISTRY.gauge("git_stacktrace_jobs_pending", "Jobs queued or running")
+JOBS_PENDING.set_function(lambda: job_queue.pending)
+CACHE_HITS = metrics.REGISTRY.counter("git_stacktrace_result_cache_hits_total", "Lookups answered from the cache")
+CACHE_HITS.set_function(lambda: result_cache.hits)
+CACHE_MISSES = metrics.REGISTRY.counter("git_stacktrace_result_cache_misses_total", "Lookups not in the cache")
+CACHE_MISSES.set_function(lambda: result_cache.misses)
+CACHE_HIT_RATIO = metrics.REGISTRY.gauge(
+    "git_stacktrace_result_cache_hit_ratio", "Share of cache lookups that were hits since the server started"
+)
+CACHE_HIT_RATIO.set_function(lambda: float(result_cache.hits) / max(result_cache.hits + result_cache.misses, 1))
+CACHE_SIZE = metrics.REGISTRY.gauge("git_stacktrace_result_cache_size", "Lookups in the cache")
+CACHE_SIZE.set_function(lambda: len(result_cache))
+COALESCED = metrics.REGISTRY.counter(
+    "git_stacktrace_coalesced_requests_total", "Requests that waited for an identical lookup"
+)
+COALESCED.set_function(lambda: in_flight.coalesced)
+PARSE_FAILURES = metrics.REGISTRY.counter(
+    "git_stacktrace_parse_failures_total", "Stacktraces that couldn't be parsed, by language", ["language"]
+)
+
+
+def _record_stats(lookup_stats):
+    """Add the phases and git usage of a lookup to the metrics."""
+    data = lookup_stats.as_dict()
+    git_commands = data["git_commands"]
+    git_seconds = data["git_seconds"]
+    for phase, phase_stats in data["phases"].items():
+        PHASE_SECONDS.observe(phase_stats["seconds"], phase=phase)
+        GIT_COMMANDS.inc(phase_stats["git_commands"], phase=phase)
+        GIT_SECONDS.inc(phase_stats["git_seconds"], phase=phase)
+        git_commands -= phase_stats["git_commands"]
+        git_seconds -= phase_stats["git_seconds"]
+    if git_commands > 0:
+        # Commands run outside of any phase
+        GIT_COMMANDS.inc(git_commands, phase="other")
+        GIT_SECONDS.inc(max(git_seconds, 0), phase="other")
+
+
+def _endpoint(path):
+    """Label for path, unknown paths share one label to bound the number of series."""
+    if path.startswith("/jobs/"):
+        return "/jobs/{id}"
+    if path in ("/", "/cache", "/favicon.ico", "/jobs", "/metrics"):
+        return path
+    return "other"
+
+
 class ResultsOutput(object):
-    def __init__(self, args):
+    def __init__(self, args, if_none_match=None, progress=None):
         self.cwd = os.getcwd()
         self.args = args
+        self.key = None
+        self.etag = None
+        self.cache_hit = False
+        self.shared = False
+        self.not_modified = False
+        self.cached = None
+        with stats.collect() as self.stats:
+            try:
+                self.messages = args.validate()
+                if self.messages is None:
+                    self.key = args.cache_key()
+                if self.key is not None:
+                    etag = json.dumps([self.key, args.params], sort_keys=True).encode("utf-8")
+                    etag = '"%s"' % hashlib.sha1(etag).hexdigest()
+                    # Only successful lookups are cached
+                    self.cached = result_cache.get(self.key)
+                    self.cache_hit = self.cached is not None
+                    if self.cache_hit and if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+                        # The client already has the results for this trace and range
+                        self.etag = etag
+                        self.not_modified = True
+                        self.results = None
+                        return
+                if self.cached is None:
+                    if self.key is None:
+                        self.cached = self._lookup(args, None, progress)
+                    else:
+                        # Identical requests that arrive while this one is running wait for it
+                        self.cached, self.shared = in_flight.do(self.key, self._lookup, args, self.key, progress)
+                self.results = self.cached.results if self.cached else None
+                if self.cached is not None and self.key is not None:
+                    # Failed lookups get no ETag, so they are never revalidated
+                    self.etag = etag
+            except Exception as e:
+                if isinstance(e, parse_trace.ParseException):
+                    PARSE_FAILURES.inc(language=e.language or "unknown")
+                self.messages = str(e)
+                self.results = None
+
+    @staticmethod
+    def _lookup(args, key, progress):
+        LOOKUPS_IN_FLIGHT.inc()
         try:
-            self.messages = args.validate()
-            self.results = args.get_results()
-        except Exception as e:
-            self.messages = str(e)
-            self.results = None
+            results = args.get_results(progress=progress)
+        finally:
+            LOOKUPS_IN_FLIGHT.dec()
+        if results is None:
+            return None
+        cached = CachedResults(results)
+        if key is not None:
+            result_cache.put(key, cached)
+        return cached
+
+    def cache_headers(self):
+        """ETag and X-Cache headers of the response."""
+        headers = []
+        if self.etag is not None:
+            headers.append(("ETag", self.etag))
+            if self.cache_hit:
+                headers.append(("X-Cache", "HIT"))
+            elif self.shared:
+                headers.append(("X-Cache", "SHARED"))
+            else:
+                headers.append(("X-Cache", "MISS"))
+        return headers
 
     def results_as_json(self):
         if self.results is None:
@@ -106,6 +381,7 @@ class ResultsOutput(object):
                 {
                     "errors": self.messages,
                     "commits": [],
+                    "timings": self.stats.as_dict(),
                 }
             ).encode()
         elif len(self.results.results) == 0:
@@ -113,23 +389,24 @@ class ResultsOutput(object):
                 {
                     "errors": "No matches found",
                     "commits": [],
+                    "timings": self.stats.as_dict(),
                 }
             ).encode()
         else:
+            with stats.collect(self.stats):
+                commits = self.cached.commits()
             return json.dumps(
                 {
                     "errors": None,
-                    "commits": self.results.get_sorted_results_by_dict(),
+                    "commits": commits,
+                    "timings": self.stats.as_dict(),
                 },
                 default=json_serial,
             ).encode()
 
     def results_as_html(self):
         if self.results and self.results.results:
-            sorted_results = self.results.get_sorted_results()
-            return "\n<hr/>\n".join(
-                ["<pre><code>" + escape(str(result)) + "</code></pre>" for result in sorted_results]
-            )
+            return self.cached.html()
         else:
             return "\n<hr/>\n<pre><code>No results found.</code></pre>\n"
 
@@ -168,26 +445,45 @@ class GitStacktraceApplication(object):
         self.environ = environ
         self.start_response = start_response
         self.path = environ["PATH_INFO"]
+        self.code = None
+        # ResultsOutput of the request, if any
+        self.output = None
 
     def __iter__(self):
+        start = time.time()
         method = self.environ["REQUEST_METHOD"]
-        if method == "GET":
-            yield self.do_GET() or b""
-        elif method == "POST":
-            yield self.do_POST() or b""
-        elif method == "HEAD":
-            self._set_headers()
-            yield b""
-        else:
-            self._set_headers(500)
-            yield b""
-
-    def _set_headers(self, code=200, content_type="text/html"):
+        try:
+            if method == "GET":
+                yield self.do_GET() or b""
+            elif method == "POST":
+                yield self.do_POST() or b""
+            elif method == "HEAD":
+                self._set_headers()
+                yield b""
+            else:
+                self._set_headers(500)
+                yield b""
+        finally:
+            endpoint = _endpoint(self.path)
+            REQUEST_SECONDS.observe(time.time() - start, endpoint=endpoint)
+            if method not in ("GET", "POST", "HEAD"):
+                method = "other"
+            REQUESTS.inc(endpoint=endpoint, method=method, code=self.code or 500)
+            if self.output is not None:
+                _record_stats(self.output.stats)
+
+    def _set_headers(self, code=200, content_type="text/html", headers=()):
         codes = {
             200: "200 OK",
+            202: "202 Accepted",
+            304: "304 Not Modified",
             404: "404 Not Found",
+            503: "503 Service Unavailable",
         }
-        self.start_response(codes.get(code, "500 Internal Server Error"), [("Content-type", content_type)])
+        self.code = code if code in codes else 500
+        self.start_response(
+            codes.get(code, "500 Internal Server Error"), [("Content-type", content_type)] + list(headers)
+        )
 
     def _request_body(self):
         content_length = int(self.environ["CONTENT_LENGTH"], 0)
@@ -196,11 +492,25 @@ class GitStacktraceApplication(object):
     def do_GET(self):
         if self.path == "/favicon.ico":
             self._set_headers()
+        elif self.path == "/cache":
+            self._set_headers(200, "application/json")
+            return json.dumps(
+                dict(result_cache.as_dict(), in_flight=len(in_flight), coalesced=in_flight.coalesced)
+            ).encode()
+        elif self.path == "/metrics":
+            self._set_headers(200, metrics.CONTENT_TYPE)
+            return metrics.REGISTRY.expose().encode("utf-8")
+        elif self.path.startswith("/jobs/"):
+            return self.get_job(self.path[len("/jobs/") :])
         elif self.path == "/":
             try:
                 args = Args.from_qs(self.environ["QUERY_STRING"])
-                out = ResultsOutput(args).render_page()
-                self._set_headers()
+                output = self.output = ResultsOutput(args, if_none_match=self.environ.get("HTTP_IF_NONE_MATCH"))
+                if output.not_modified:
+                    self._set_headers(304, headers=output.cache_headers())
+                    return None
+                out = output.render_page()
+                self._set_headers(headers=output.cache_headers())
                 return out
             except Exception:
                 log.exception("Unable to render trace page as html")
@@ -208,12 +518,55 @@ class GitStacktraceApplication(object):
         else:
             self._set_headers(404)
 
+    def get_job(self, job_id):
+        job = job_queue.get(job_id)
+        if job is None:
+            self._set_headers(404, "application/json")
+            return json.dumps({"error": "No job '%s', it may have expired" % job_id}).encode()
+        try:
+            wait = float(parse_qs(self.environ["QUERY_STRING"]).get("wait", [0])[0])
+        except ValueError:
+            wait = 0
+        if wait > 0:
+            # Long poll, return as soon as the job finishes
+            job.wait(min(wait, MAX_JOB_WAIT))
+        self._set_headers(200, "application/json")
+        return json.dumps(job.as_dict()).encode()
+
+    def post_job(self):
+        args = Args.from_json_body(self._request_body())
+
+        def run(job):
+            output = ResultsOutput(args, progress=job.update_progress)
+            payload = json.loads(output.results_as_json())
+            _record_stats(output.stats)
+            return payload
+
+        try:
+            job = job_queue.submit(run)
+        except jobs.QueueFull as e:
+            self._set_headers(503, "application/json")
+            return json.dumps({"error": str(e)}).encode()
+        self._set_headers(202, "application/json", [("Location", "/jobs/%s" % job.id)])
+        return json.dumps({"id": job.id, "state": job.state, "url": "/jobs/%s" % job.id}).encode()
+
     def do_POST(self):
-        if self.path == "/":
+        if self.path == "/jobs":
+            try:
+                return self.post_job()
+            except Exception as e:
+                log.exception("Unable to submit job")
+                self._set_headers(500, "application/json")
+                return json.dumps({"error": str(e)}).encode()
+        elif self.path == "/":
             try:
                 args = Args.from_json_body(self._request_body())
-                out = ResultsOutput(args).results_as_json()
-                self._set_headers(200, "application/json")
+                output = self.output = ResultsOutput(args, if_none_match=self.environ.get("HTTP_IF_NONE_MATCH"))
+                if output.not_modified:
+                    self._set_headers(304, "application/json", output.cache_headers())
+                    return None
+                out = output.results_as_json()
+                self._set_headers(200, "application/json", output.cache_headers())
                 return out
             except Exception as e:
                 log.exception("Unable to load trace results as json")
@@ -224,3 +577,39 @@ class GitStacktraceApplication(object):
 
 
 application = GitStacktraceApplication
+
+
+class ThreadPoolWSGIServer(simple_server.WSGIServer):
+    """WSGIServer that handles requests on a pool of worker threads.
+
+    A slow lookup only ties up one worker, the other requests are served
+    by the rest of the pool.
+    """
+
+    def __init__(self, server_address, handler_class, workers):
+        simple_server.WSGIServer.__init__(self, server_address, handler_class)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        simple_server.WSGIServer.server_close(self)
+        self.executor.shutdown(wait=False)
+
+
+def make_server(host, port, app=application, workers=1):
+    """Return a WSGI server for app, handling up to workers requests at once."""
+    if workers <= 1:
+        return simple_server.make_server(host, port, app)
+    httpd = ThreadPoolWSGIServer((host, port), simple_server.WSGIRequestHandler, workers)
+    httpd.set_app(app)
+    return httpd
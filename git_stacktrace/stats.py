@@ -0,0 +1,187 @@
+"""Measure where the time of a lookup goes.
+
+Statistics are collected for the code running inside a ``collect()`` block
+(in the same thread, or in threads started with ``run_in_context``)::
+
+    from git_stacktrace import api
+    from git_stacktrace import stats
+
+    with stats.collect() as lookup_stats:
+        traceback = api.parse_trace(traceback_string)
+        results = api.lookup_stacktrace(traceback, git_range)
+    print(lookup_stats)
+"""
+
+import collections
+import contextlib
+import contextvars
+import threading
+import time
+
+_current = contextvars.ContextVar("git_stacktrace_stats", default=None)
+_current_phase = contextvars.ContextVar("git_stacktrace_phase", default=None)
+
+
+class Phase(object):
+    """Time and git usage of one step of a lookup."""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.git_commands = 0
+        self.git_seconds = 0.0
+        self.git_bytes = 0
+
+    def as_dict(self):
+        return {
+            "seconds": self.seconds,
+            "calls": self.calls,
+            "git_commands": self.git_commands,
+            "git_seconds": self.git_seconds,
+            "git_bytes": self.git_bytes,
+        }
+
+
+class Stats(object):
+    """Wall time per phase, git invocations and peak counts of a lookup."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.phases = collections.OrderedDict()
+        # git usage outside of any phase is kept under None
+        self.git = Phase()
+        self.counts = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def seconds(self):
+        return (self.finished or time.time()) - self.started
+
+    def _phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = Phase()
+        return self.phases[name]
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            phase = self._phase(name)
+            phase.seconds += seconds
+            phase.calls += 1
+
+    def record_command(self, seconds, nbytes, phase_name=None):
+        with self._lock:
+            phases = [self.git]
+            if phase_name is not None:
+                phases.append(self._phase(phase_name))
+            for phase in phases:
+                phase.git_commands += 1
+                phase.git_seconds += seconds
+                phase.git_bytes += nbytes
+
+    def record_count(self, name, count):
+        with self._lock:
+            self.counts[name] = max(count, self.counts.get(name, 0))
+
+    def merge(self, data):
+        """Add the phases, git usage and counts of data, the as_dict() of Stats collected elsewhere.
+
+        The wall time of this Stats is kept.
+        """
+        with self._lock:
+            phases = [(self.git, data)]
+            for name, phase_data in data["phases"].items():
+                phase = self._phase(name)
+                phase.seconds += phase_data["seconds"]
+                phase.calls += phase_data["calls"]
+                phases.append((phase, phase_data))
+            for phase, phase_data in phases:
+                phase.git_commands += phase_data["git_commands"]
+                phase.git_seconds += phase_data["git_seconds"]
+                phase.git_bytes += phase_data["git_bytes"]
+            for name, count in data["counts"].items():
+                self.counts[name] = max(count, self.counts.get(name, 0))
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "seconds": self.seconds,
+                "git_commands": self.git.git_commands,
+                "git_seconds": self.git.git_seconds,
+                "git_bytes": self.git.git_bytes,
+                "phases": collections.OrderedDict((name, phase.as_dict()) for name, phase in self.phases.items()),
+                "counts": collections.OrderedDict(self.counts),
+            }
+
+    def __str__(self):
+        data = self.as_dict()
+        result = "Total: %.3fs, %d git commands (%.3fs, %d bytes)\n" % (
+            data["seconds"],
+            data["git_commands"],
+            data["git_seconds"],
+            data["git_bytes"],
+        )
+        for name, phase in data["phases"].items():
+            result += "    %-16s %8.3fs %4d calls %4d git commands %10d bytes\n" % (
+                name,
+                phase["seconds"],
+                phase["calls"],
+                phase["git_commands"],
+                phase["git_bytes"],
+            )
+        for name, count in data["counts"].items():
+            result += "    %-16s %8d\n" % (name, count)
+        return result
+
+
+def current():
+    """Return the Stats being collected, or None."""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def collect(lookup_stats=None):
+    """Collect Stats for everything run inside the block."""
+    if lookup_stats is None:
+        lookup_stats = Stats()
+    token = _current.set(lookup_stats)
+    try:
+        yield lookup_stats
+    finally:
+        _current.reset(token)
+        lookup_stats.finished = time.time()
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time the block as phase name, if Stats are being collected."""
+    lookup_stats = _current.get()
+    if lookup_stats is None:
+        yield
+        return
+    token = _current_phase.set(name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        lookup_stats.add_phase(name, time.time() - start)
+        _current_phase.reset(token)
+
+
+def record_command(seconds, nbytes):
+    """Record a git command run in the current phase."""
+    lookup_stats = _current.get()
+    if lookup_stats is not None:
+        lookup_stats.record_command(seconds, nbytes, _current_phase.get())
+
+
+def record_count(name, count):
+    """Record count, only the largest count for name is kept."""
+    lookup_stats = _current.get()
+    if lookup_stats is not None:
+        lookup_stats.record_count(name, count)
+
+
+def run_in_context(executor, fn, *args):
+    """Submit fn to executor, keeping the Stats and phase of the caller."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
@@ -1,3 +1,6 @@
+import os
+import subprocess
+
 import fixtures
 import testtools
 
@@ -9,3 +12,87 @@ class TestCase(testtools.TestCase):
         self.useFixture(fixtures.MonkeyPatch("sys.stdout", stdout))
         stderr = self.useFixture(fixtures.StringStream("stderr")).stream
         self.useFixture(fixtures.MonkeyPatch("sys.stderr", stderr))
+
+
+class GitRepository(fixtures.Fixture):
+    """A temporary git repository, made the current directory."""
+
+    def git(self, *argv, **env):
+        environ = dict(os.environ, GIT_AUTHOR_DATE="1468963088 -0700", GIT_COMMITTER_DATE="1468963088 -0700")
+        environ.update(env)
+        return subprocess.check_output(("git",) + argv, cwd=self.path, env=environ).decode("utf-8")
+
+    def write(self, filename, text):
+        path = os.path.join(self.path, filename)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(text)
+
+    def _setUp(self):
+        self.path = self.useFixture(fixtures.TempDir()).path
+        self.git("init", "-q")
+        self.git("config", "user.name", "Jane Doe")
+        self.git("config", "user.email", "jane@example.com")
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.path)
+
+
+class GitHistory(GitRepository):
+    """A GitRepository with merges, renames, tags, and both packed and loose objects."""
+
+    def commit(self, message, **env):
+        self.date += 60
+        date = "%d +0200" % self.date
+        env = dict({"GIT_AUTHOR_DATE": date, "GIT_COMMITTER_DATE": date}, **env)
+        self.git("add", "-A")
+        self.git("commit", "-q", "--allow-empty", "-m", message, **env)
+        return self.git("rev-parse", "HEAD").strip()
+
+    def _setUp(self):
+        super(GitHistory, self)._setUp()
+        self.date = 1468963088
+        self.write("setup.py", "import setuptools\n")
+        self.write("pkg/a/mod.py", "x = 1\n")
+        self.write("pkg/a-b.py", "y = 2\n")
+        self.write("pkg/a0.py", "z = 3\n")
+        self.write("pkg/empty.py", "")
+        self.write("big.py", "".join("line_%d = %d\n" % (i, i) for i in range(200)))
+        self.commit("first")
+        self.write("pkg/a/mod.py", "x = 2\n")
+        self.write("big.py", "".join("line_%d = %d\n" % (i, i * 2) for i in range(200)))
+        self.write("docs/x.md", "# Docs\n")
+        self.commit("second")
+        self.git("mv", "pkg/a0.py", "pkg/b0.py")
+        self.commit("rename")
+        self.git("tag", "-a", "v1", "-m", "version 1")
+        # Pack the history so far, with big.py as a delta
+        self.git("repack", "-q", "-a", "-d")
+        self.git("pack-refs", "--all")
+        self.branch = self.git("symbolic-ref", "--short", "HEAD").strip()
+        self.git("checkout", "-q", "-b", "side")
+        self.write("pkg/a-b.py", "y = 3\n")
+        self.commit("side")
+        os.remove(os.path.join(self.path, "docs/x.md"))
+        # Older than its parent, like a rebased commit
+        self.commit("skewed", GIT_COMMITTER_DATE="1468963000 +0000")
+        self.git("checkout", "-q", self.branch)
+        self.write("setup.py", "import setuptools\nsetuptools.setup()\n")
+        self.commit("main")
+        self.date += 60
+        date = "%d +0200" % self.date
+        self.git("merge", "-q", "--no-ff", "-m", "merge", "side", GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date)
+        self.git("tag", "merge")
+        os.chmod(os.path.join(self.path, "setup.py"), 0o755)
+        os.remove(os.path.join(self.path, "pkg/empty.py"))
+        os.symlink("a-b.py", os.path.join(self.path, "pkg/empty.py"))
+        self.commit("mode and type")
+        self.git("rm", "-q", "-r", "pkg/a")
+        self.write("pkg/a", "not a directory\n")
+        self.write("pkg/a0.py", "z = 3\n")
+        self.commit("directory to file, copy")
+        self.git("tag", "light")
+        os.rename(os.path.join(self.path, "big.py"), os.path.join(self.path, "large.py"))
+        with open(os.path.join(self.path, "large.py"), "a") as f:
+            f.write("more = 1\n")
+        self.commit("rename with changes")
@@ -1,8 +1,12 @@
+import time
+
+import fixtures
 import mock
 
 from git_stacktrace.tests import base
 from git_stacktrace import api
 from git_stacktrace import git
+from git_stacktrace import paths
 
 
 class TestApi(base.TestCase):
@@ -33,15 +37,15 @@ class TestApi(base.TestCase):
 
     def setup_mocks(self, mock_files, mock_files_touched):
         mock_files_touched.return_value = {"hash2": [git.GitFile("common/utils/geo_utils.py", "M")]}
-        mock_files.return_value = ["common/utils/geo_utils.py"]
+        mock_files.return_value = paths.PathIndex(["common/utils/geo_utils.py"])
 
     @mock.patch("git_stacktrace.git.pickaxe")
     @mock.patch("git_stacktrace.git.files_touched")
-    @mock.patch("git_stacktrace.git.files")
-    @mock.patch("git_stacktrace.git.line_match")
-    def test_lookup_stacktrace_python(self, mock_line_match, mock_files, mock_files_touched, mock_pickaxe):
+    @mock.patch("git_stacktrace.git.path_index")
+    @mock.patch("git_stacktrace.git.lines_match")
+    def test_lookup_stacktrace_python(self, mock_lines_match, mock_files, mock_files_touched, mock_pickaxe):
         mock_files_touched.return_value = True
-        mock_line_match.return_value = False
+        mock_lines_match.return_value = set()
         traceback = self.get_traceback()
         self.setup_mocks(mock_files, mock_files_touched)
         self.assertEqual(
@@ -52,13 +56,13 @@ class TestApi(base.TestCase):
 
     @mock.patch("git_stacktrace.git.pickaxe")
     @mock.patch("git_stacktrace.git.files_touched")
-    @mock.patch("git_stacktrace.git.files")
-    @mock.patch("git_stacktrace.git.line_match")
-    def test_lookup_stacktrace_java(self, mock_line_match, mock_files, mock_files_touched, mock_pickaxe):
+    @mock.patch("git_stacktrace.git.path_index")
+    @mock.patch("git_stacktrace.git.lines_match")
+    def test_lookup_stacktrace_java(self, mock_lines_match, mock_files, mock_files_touched, mock_pickaxe):
         mock_files_touched.return_value = True
-        mock_line_match.return_value = True
+        mock_lines_match.side_effect = lambda commit, filename, line_numbers, patches=None: set(line_numbers)
         traceback = self.get_traceback(java=True)
-        mock_files.return_value = ["devdaily/src/main/java/com/devdaily/tests/ExceptionTest.java"]
+        mock_files.return_value = paths.PathIndex(["devdaily/src/main/java/com/devdaily/tests/ExceptionTest.java"])
         mock_files_touched.return_value = {
             "hash2": [git.GitFile("devdaily/src/main/java/com/devdaily/tests/ExceptionTest.java", "M")]
         }
@@ -70,9 +74,9 @@ class TestApi(base.TestCase):
 
     @mock.patch("git_stacktrace.git.pickaxe")
     @mock.patch("git_stacktrace.git.files_touched")
-    @mock.patch("git_stacktrace.git.files")
-    @mock.patch("git_stacktrace.git.line_match")
-    def test_lookup_stacktrace_fast(self, mock_line_match, mock_files, mock_files_touched, mock_pickaxe):
+    @mock.patch("git_stacktrace.git.path_index")
+    @mock.patch("git_stacktrace.git.lines_match")
+    def test_lookup_stacktrace_fast(self, mock_lines_match, mock_files, mock_files_touched, mock_pickaxe):
         mock_files_touched.return_value = True
         traceback = self.get_traceback()
         self.setup_mocks(mock_files, mock_files_touched)
@@ -81,11 +85,11 @@ class TestApi(base.TestCase):
 
     @mock.patch("git_stacktrace.git.pickaxe")
     @mock.patch("git_stacktrace.git.files_touched")
-    @mock.patch("git_stacktrace.git.files")
-    @mock.patch("git_stacktrace.git.line_match")
-    def test_lookup_stacktrace_line_match(self, mock_line_match, mock_files, mock_files_touched, mock_pickaxe):
+    @mock.patch("git_stacktrace.git.path_index")
+    @mock.patch("git_stacktrace.git.lines_match")
+    def test_lookup_stacktrace_line_match(self, mock_lines_match, mock_files, mock_files_touched, mock_pickaxe):
         mock_files_touched.return_value = True
-        mock_line_match.return_value = True
+        mock_lines_match.side_effect = lambda commit, filename, line_numbers, patches=None: set(line_numbers)
         traceback = self.get_traceback()
         self.setup_mocks(mock_files, mock_files_touched)
         self.assertEqual(
@@ -93,3 +97,131 @@ class TestApi(base.TestCase):
             api.lookup_stacktrace(traceback, "hash1..hash3", fast=False).get_sorted_results()[0]._line_numbers_matched,
         )
         self.assertEqual(3, mock_pickaxe.call_count)
+
+    @mock.patch("git_stacktrace.git.pickaxe")
+    @mock.patch("git_stacktrace.git.files_touched")
+    @mock.patch("git_stacktrace.git.path_index")
+    @mock.patch("git_stacktrace.git.lines_match")
+    def test_lookup_stacktrace_index(self, mock_lines_match, mock_files, mock_files_touched, mock_pickaxe):
+        mock_lines_match.return_value = set()
+        traceback = self.get_traceback()
+        mock_files.return_value = paths.PathIndex(["common/utils/geo_utils.py"])
+        history_index = mock.Mock()
+        indexed_range = history_index.lookup_range.return_value
+        indexed_range.files_touched.return_value = {"hash2": [git.GitFile("common/utils/geo_utils.py", "M")]}
+        results = api.lookup_stacktrace(traceback, "hash1..hash3", index=history_index)
+        self.assertEqual(["hash2"], [r.commit for r in results.get_sorted_results()])
+        self.assertEqual(0, mock_files_touched.call_count)
+        history_index.lookup_range.assert_called_once_with("hash1..hash3")
+        for call in mock_pickaxe.call_args_list:
+            self.assertIs(indexed_range, call[1]["patches"])
+
+    @mock.patch("git_stacktrace.git.pickaxe")
+    @mock.patch("git_stacktrace.git.files_touched")
+    @mock.patch("git_stacktrace.git.path_index")
+    @mock.patch("git_stacktrace.git.lines_match")
+    def test_lookup_stacktrace_index_fails(self, mock_lines_match, mock_files, mock_files_touched, mock_pickaxe):
+        mock_lines_match.return_value = set()
+        traceback = self.get_traceback()
+        self.setup_mocks(mock_files, mock_files_touched)
+        history_index = mock.Mock()
+        history_index.lookup_range.side_effect = Exception("database is locked")
+        results = api.lookup_stacktrace(traceback, "hash1..hash3", index=history_index)
+        self.assertEqual(["hash2"], [r.commit for r in results.get_sorted_results()])
+        mock_files_touched.assert_called_once_with("hash1..hash3", paths=["common/utils/geo_utils.py"])
+
+    @mock.patch("git_stacktrace.git.pickaxe")
+    @mock.patch("git_stacktrace.git.files_touched")
+    @mock.patch("git_stacktrace.git.path_index")
+    @mock.patch("git_stacktrace.git.lines_match")
+    def test_lookup_stacktrace_jobs(self, mock_lines_match, mock_files, mock_files_touched, mock_pickaxe):
+        mock_lines_match.return_value = set()
+        self.setup_mocks(mock_files, mock_files_touched)
+
+        def pickaxe(code, git_range, filename, patches=None):
+            if filename:
+                # Finish after the other lines
+                time.sleep(0.05)
+                return [("hash2", False)]
+            return [("hash%d" % len(code), True), ("hash2", True)]
+
+        mock_pickaxe.side_effect = pickaxe
+        serial = api.lookup_stacktrace(self.get_traceback(), "hash1..hash3").get_sorted_results()
+        progress = mock.Mock()
+        parallel = api.lookup_stacktrace(
+            self.get_traceback(), "hash1..hash3", jobs=4, progress=progress
+        ).get_sorted_results()
+        self.assertEqual(6, mock_pickaxe.call_count)
+        self.assertEqual(
+            [
+                mock.call("files", 0, 1),
+                mock.call("match_files", 0, 1),
+                mock.call("files_touched", 0, 1),
+                mock.call("line_match", 0, 1),
+                mock.call("pickaxe", 0, 3),
+                mock.call("pickaxe", 1, 3),
+                mock.call("pickaxe", 2, 3),
+                mock.call("pickaxe", 3, 3),
+            ],
+            progress.call_args_list,
+        )
+        self.assertEqual([r.commit for r in serial], [r.commit for r in parallel])
+        for expected, r in zip(serial, parallel):
+            self.assertEqual(expected.lines_added, r.lines_added)
+            self.assertEqual(expected.lines_removed, r.lines_removed)
+            self.assertEqual(expected.files_modified, r.files_modified)
+
+    @mock.patch("git_stacktrace.git.pickaxe")
+    @mock.patch("git_stacktrace.git.files_touched")
+    @mock.patch("git_stacktrace.git.path_index")
+    @mock.patch("git_stacktrace.git.lines_match")
+    def test_lookup_stacktraces(self, mock_lines_match, mock_files, mock_files_touched, mock_pickaxe):
+        mock_lines_match.return_value = set()
+        self.setup_mocks(mock_files, mock_files_touched)
+        mock_pickaxe.side_effect = lambda code, git_range, filename, patches=None: [("hash%d" % len(code), False)]
+        single = api.lookup_stacktrace(self.get_traceback(), "hash1..hash3")
+        mock_files_touched.reset_mock()
+        mock_pickaxe.reset_mock()
+        mock_files.reset_mock()
+
+        tracebacks = [self.get_traceback(), self.get_traceback(java=True), self.get_traceback()]
+        batch = api.lookup_stacktraces(tracebacks, "hash1..hash3")
+        self.assertEqual(3, len(batch))
+        mock_files.assert_called_once_with("hash1..hash3")
+        mock_files_touched.assert_called_once_with("hash1..hash3", paths=["common/utils/geo_utils.py"])
+        # The lines of the second python traceback were already searched for
+        self.assertEqual(3, mock_pickaxe.call_count)
+        self.assertEqual([], batch[1].get_sorted_results())
+        for results in (batch[0], batch[2]):
+            self.assertEqual(
+                [(r.commit, r.lines_added, r.files_modified) for r in single.get_sorted_results()],
+                [(r.commit, r.lines_added, r.files_modified) for r in results.get_sorted_results()],
+            )
+        self.assertIs(batch[0].stats, batch[1].stats)
+
+
+class TestApiHistory(base.TestCase):
+    def setUp(self):
+        super(TestApiHistory, self).setUp()
+        self.repo = self.useFixture(base.GitHistory())
+        session = git.GitSession()
+        self.addCleanup(session.close)
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.git.session", session))
+
+    def test_renamed_with_changes(self):
+        traceback = api.parse_trace(
+            [
+                "Traceback (most recent call last):\n",
+                '  File "large.py", line 5, in <module>\n',
+                "    line_4 = 8\n",
+                '  File "large.py", line 201, in <module>\n',
+                "    more = 1\n",
+                "ValueError: test\n",
+            ]
+        )
+        results = api.lookup_stacktrace(traceback, "light..HEAD", fast=True)
+        head = self.repo.git("rev-parse", "HEAD").strip()
+        result = results.get_result(head)
+        # Only the appended line is new, the rest came from big.py
+        self.assertEqual({"large.py", "large.py:201"}, result.files_modified)
+        self.assertEqual(set(), result.files_added)
@@ -0,0 +1,92 @@
+import io
+import json
+import os
+
+import fixtures
+import mock
+
+from git_stacktrace.tests import base
+from git_stacktrace import cmd
+from git_stacktrace import result
+from git_stacktrace import stats
+
+
+class TestBatch(base.TestCase):
+    def setUp(self):
+        super(TestBatch, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.cmd._batch", {}))
+        self.history = self.useFixture(fixtures.MockPatch("git_stacktrace.git.RangeHistory")).mock
+        self.path_index = self.useFixture(fixtures.MockPatch("git_stacktrace.git.path_index")).mock
+        self.prefetch = self.useFixture(fixtures.MockPatch("git_stacktrace.git.prefetch_commit_info")).mock
+        self.lookup = self.useFixture(fixtures.MockPatch("git_stacktrace.api.lookup_stacktrace")).mock
+        self.lookup.return_value = result.Results()
+        with open("git_stacktrace/tests/examples/python3.trace") as f:
+            self.trace = f.read()
+
+    def run_batch(self, lines, jobs=1, history_index=None):
+        output = io.StringIO()
+        cmd.run_batch(
+            io.StringIO("\n".join(lines) + "\n"),
+            "hash1..hash3",
+            fast=True,
+            jobs=jobs,
+            output=output,
+            history_index=history_index,
+        )
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_run_batch(self):
+        self.history.return_value.files_touched.return_value = {"hash2": []}
+        lines = [json.dumps({"id": "first", "trace": self.trace}), "", json.dumps(self.trace)]
+        results = self.run_batch(lines)
+        self.assertEqual(
+            [{"id": 3, "errors": None, "commits": []}, {"id": "first", "errors": None, "commits": []}],
+            sorted(results, key=lambda r: str(r["id"])),
+        )
+        # The range is only read once, for every trace
+        self.history.assert_called_once_with("hash1..hash3")
+        self.path_index.assert_called_once_with("hash1..hash3")
+        self.prefetch.assert_called_once_with(["hash2"])
+        self.assertEqual(2, self.lookup.call_count)
+        for call in self.lookup.call_args_list:
+            self.assertEqual(("hash1..hash3",), call[0][1:])
+            self.assertEqual({"fast": True, "index": self.history.return_value}, call[1])
+
+    def test_run_batch_errors(self):
+        results = self.run_batch(["not json", json.dumps({"id": 7, "trace": "no traceback here"})])
+        self.assertEqual([1, 7], [r["id"] for r in results])
+        for r in results:
+            self.assertTrue(r["errors"])
+            self.assertEqual([], r["commits"])
+        self.assertEqual(0, self.lookup.call_count)
+
+    def test_run_batch_index(self):
+        history_index = mock.Mock(path="/repo/.git/git-stacktrace.sqlite")
+        history_index.lookup_range.return_value.files_touched.return_value = {"hash2": []}
+        results = self.run_batch([json.dumps(self.trace)], history_index=history_index)
+        self.assertEqual([{"id": 1, "errors": None, "commits": []}], results)
+        self.assertEqual(0, self.history.call_count)
+        history_index.lookup_range.assert_called_once_with("hash1..hash3")
+        self.prefetch.assert_called_once_with(["hash2"])
+        self.assertEqual({"fast": True, "index": history_index}, self.lookup.call_args[1])
+
+    @mock.patch("git_stacktrace.index.HistoryIndex")
+    def test_forked_worker_opens_index(self, mock_history_index):
+        cmd._batch.update(history=mock.sentinel.parent_index, index_path="/repo/index", pid=os.getpid())
+        self.assertIs(mock.sentinel.parent_index, cmd._batch_history())
+        cmd._batch["pid"] = -1
+        self.assertIs(mock_history_index.return_value, cmd._batch_history())
+        self.assertIs(mock_history_index.return_value, cmd._batch_history())
+        mock_history_index.assert_called_once_with("/repo/index")
+
+    def test_run_batch_stats(self):
+        def lookup(*args, **kwargs):
+            stats.record_command(1.0, 10)
+            return result.Results()
+
+        self.lookup.side_effect = lookup
+        self.history.return_value.files_touched.return_value = {}
+        with stats.collect() as batch_stats:
+            self.run_batch([json.dumps(self.trace)] * 3, jobs=2)
+        self.assertEqual(3, batch_stats.git.git_commands)
+        self.assertEqual(30, batch_stats.git.git_bytes)
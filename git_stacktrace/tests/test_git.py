@@ -1,8 +1,15 @@
+import io
+import os
+import subprocess
+import sys
+
+import fixtures
 import mock
 
 from git_stacktrace.tests import base
 from git_stacktrace import git
 from git_stacktrace import parse_trace
+from git_stacktrace import stats
 
 
 class TestGitFile(base.TestCase):
@@ -26,42 +33,144 @@ class TestGitFile(base.TestCase):
 
 
 class TestGit(base.TestCase):
-    @mock.patch("git_stacktrace.git.run_command")
+    def setUp(self):
+        super(TestGit, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.git._since_ranges", {}))
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.git._valid_ranges", {}))
+
+    @mock.patch("git_stacktrace.git.stream_command")
     def test_convert_since_fail(self, mocked_command):
-        mocked_command.return_value = ""
+        mocked_command.return_value = []
         self.assertRaises(Exception, git.convert_since, "1.day")
 
-    @mock.patch("git_stacktrace.git.run_command")
+    @mock.patch("git_stacktrace.git.stream_command")
     def test_convert_since(self, mocked_command):
-        mocked_command.return_value = "\n".join(
-            [
-                "de75c8dd27af30daef012a9902af4c39c4728710",
-                "04a13ace3a3e490a5e1a74aae740f45fee6562c3",
-                "c0497475799306eebcfd014657150daa9af9c488",
-                "f301b355050f64ebc2e83ebffc583713113aee9b",
-                "32eba9e2c389c427c5b7b2288353eaf0903d52c0",
-            ]
-        )
+        mocked_command.return_value = [
+            "de75c8dd27af30daef012a9902af4c39c4728710",
+            "04a13ace3a3e490a5e1a74aae740f45fee6562c3",
+            "c0497475799306eebcfd014657150daa9af9c488",
+            "f301b355050f64ebc2e83ebffc583713113aee9b",
+            "32eba9e2c389c427c5b7b2288353eaf0903d52c0",
+        ]
+        resolve = self.useFixture(fixtures.MockPatchObject(git.backend, "resolve")).mock
+        resolve.return_value = "de75c8dd27af30daef012a9902af4c39c4728710"
         expected = "32eba9e2c389c427c5b7b2288353eaf0903d52c0..de75c8dd27af30daef012a9902af4c39c4728710"
         self.assertEqual(expected, git.convert_since("1.day"))
+        mocked_command.assert_called_once_with("git", "rev-list", "--since=1.day", "HEAD")
+        # Reused while HEAD doesn't move
+        self.assertEqual(expected, git.convert_since("1.day"))
+        self.assertEqual(1, mocked_command.call_count)
+        resolve.return_value = "1ca8dd2b178ef8f308849bac2b0eaecaf91abc70"
+        git.convert_since("1.day")
+        self.assertEqual(2, mocked_command.call_count)
+        git.convert_since("1.day", branch="origin/master")
+        mocked_command.assert_called_with("git", "rev-list", "--since=1.day", "origin/master")
+        resolve.assert_called_with("origin/master")
+        # Until it expires
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.git.SINCE_CACHE_SECONDS", 0))
+        git.convert_since("1.day")
+        self.assertEqual(4, mocked_command.call_count)
+
+    @mock.patch("git_stacktrace.git.stream_command")
+    def test_convert_since_branch(self, mocked_command):
+        resolve = self.useFixture(fixtures.MockPatchObject(git.backend, "resolve")).mock
+        self.assertRaises(Exception, git.convert_since, "1.day", branch="master\nHEAD~1")
+        self.assertEqual(0, resolve.call_count)
+        self.assertEqual(0, mocked_command.call_count)
+        # A branch that doesn't resolve is left to git, and not remembered
+        resolve.return_value = None
+        mocked_command.return_value = ["de75c8dd27af30daef012a9902af4c39c4728710"]
+        git.convert_since("1.day", branch="nothere")
+        git.convert_since("1.day", branch="nothere")
+        self.assertEqual(2, mocked_command.call_count)
+        self.assertEqual({}, git._since_ranges)
 
     @mock.patch("git_stacktrace.git.run_command")
-    def test_files_touched(self, mocked_command):
-        mocked_command.return_value = "\n".join(
-            [
-                "1ca8dd2b178ef8f308849bac2b0eaecaf91abc70",
-                "",
-                ":100644 100644 bcd1234... 0123456... M	file0",
-                ":100644 100644 abcd123... 1234567... C68	file1	file2",
-                ":100644 100644 abcd123... 1234567... R86	file1	file3",
-                ":000000 100644 0000000... 1234567... A	file4 space/log",
-                ":100644 100644 f9731ae1d4... 6dc2860... M       test/file"
-                ":100644 000000 1234567... 0000000... D	file5",
-            ]
+    def test_valid_range(self, mocked_command):
+        mocked_command.return_value = "de75c8dd27af30daef012a9902af4c39c4728710"
+        git_range = "32eba9e2c389c427c5b7b2288353eaf0903d52c0..de75c8dd27af30daef012a9902af4c39c4728710"
+        self.assertTrue(git.valid_range(git_range))
+        mocked_command.assert_called_once_with("git", "rev-list", "--max-count=1", git_range)
+        self.assertTrue(git.valid_range(git_range))
+        self.assertEqual(1, mocked_command.call_count)
+        # Ranges of names can change, so aren't kept
+        mocked_command.return_value = ""
+        self.assertFalse(git.valid_range("v1.0..master"))
+        self.assertFalse(git.valid_range("v1.0..master"))
+        self.assertEqual(3, mocked_command.call_count)
+
+    @mock.patch("git_stacktrace.git.run_command")
+    def test_resolve_range(self, mocked_command):
+        mocked_command.return_value = (
+            "de75c8dd27af30daef012a9902af4c39c4728710\n^32eba9e2c389c427c5b7b2288353eaf0903d52c0\n"
         )
+        self.assertEqual(
+            "de75c8dd27af30daef012a9902af4c39c4728710 ^32eba9e2c389c427c5b7b2288353eaf0903d52c0",
+            git.resolve_range("32eba9e..master"),
+        )
+        mocked_command.assert_called_once_with("git", "rev-parse", "32eba9e..master")
+
+    @mock.patch("git_stacktrace.git.stream_command")
+    def test_files_touched(self, mocked_command):
+        mocked_command.return_value = [
+            "1ca8dd2b178ef8f308849bac2b0eaecaf91abc70",
+            "",
+            ":100644 100644 bcd1234... 0123456... M	file0",
+            ":100644 100644 abcd123... 1234567... C68	file1	file2",
+            ":100644 100644 abcd123... 1234567... R86	file1	file3",
+            ":000000 100644 0000000... 1234567... A	file4 space/log",
+            ":100644 100644 f9731ae1d4... 6dc2860... M       test/file" ":100644 000000 1234567... 0000000... D	file5",
+        ]
         expected = {"1ca8dd2b178ef8f308849bac2b0eaecaf91abc70": ["file0", "file2", "file3", "file4 space/log", "file5"]}
         self.assertEqual(expected, git.files_touched("A..B"))
 
+    @mock.patch("git_stacktrace.git.stream_command")
+    def test_files_touched_paths(self, mocked_command):
+        mocked_command.return_value = [
+            "1ca8dd2b178ef8f308849bac2b0eaecaf91abc70",
+            "",
+            ":100644 100644 bcd1234... 0123456... M\tfile0",
+        ]
+        self.assertEqual(
+            {"1ca8dd2b178ef8f308849bac2b0eaecaf91abc70": ["file0"]}, git.files_touched("A..B", paths=["file0", "f*"])
+        )
+        mocked_command.assert_called_once_with(
+            "git", "log", "--pretty=%H", "--raw", "A..B", "--", "file0", "f*", GIT_LITERAL_PATHSPECS="1"
+        )
+        self.assertEqual({}, git.files_touched("A..B", paths=[]))
+        self.assertEqual(1, mocked_command.call_count)
+
+    @mock.patch("git_stacktrace.git.stream_command")
+    def test_path_history(self, mocked_command):
+        sha = "1ca8dd2b178ef8f308849bac2b0eaecaf91abc70"
+        mocked_command.side_effect = [
+            # With only its new name git sees the renamed file as added
+            [sha, "", ":000000 100644 0000000... 0123456... A\tlarge.py"],
+            [
+                ":100644 100644 bcd1234 0123456 R090\tbig.py\tlarge.py",
+                ":100644 100644 1234567 7654321 R100\tx.py\ty.py",
+            ],
+            [sha, "", ":100644 100644 bcd1234... 0123456... R090\tbig.py\tlarge.py"],
+        ]
+        commit_files, paths = git.path_history("A..B", ["large.py"])
+        self.assertEqual(["big.py", "large.py"], paths)
+        self.assertEqual([("large.py", "R")], [(f.filename, f.state) for f in commit_files[sha]])
+        mocked_command.assert_called_with(
+            "git", "log", "--pretty=%H", "--raw", "A..B", "--", "big.py", "large.py", GIT_LITERAL_PATHSPECS="1"
+        )
+        self.assertEqual(3, mocked_command.call_count)
+
+    @mock.patch("git_stacktrace.git.stream_command")
+    def test_path_history_no_renames(self, mocked_command):
+        mocked_command.return_value = [
+            "1ca8dd2b178ef8f308849bac2b0eaecaf91abc70",
+            "",
+            ":100644 100644 bcd1234... 0123456... M\tfile0",
+        ]
+        self.assertEqual(["file0"], git.path_history("A..B", ["file0"])[1])
+        # Files that weren't added only need one look at the history
+        self.assertEqual(1, mocked_command.call_count)
+
     @mock.patch("git_stacktrace.git.run_command")
     def test_line_match(self, mocked_command):
         mocked_command.return_value = "\n".join(
@@ -89,9 +198,9 @@ class TestGit(base.TestCase):
         line.line_number = 5
         self.assertFalse(git.line_match("hash1", line))
 
-    @mock.patch("git_stacktrace.git.run_command")
+    @mock.patch("git_stacktrace.git.stream_command")
     def test_pickaxe(self, mocked_command):
-        mocked_command.return_value = ""
+        mocked_command.return_value = []
 
         git.pickaxe("for f in sorted(self.files_added):", "hash1..hash2")
         expected = ("git", "log", "-b", "--pretty=%H", "-S", "for f in sorted(self.files_added):", "hash1..hash2")
@@ -114,3 +223,635 @@ class TestGit(base.TestCase):
             "filename",
         )
         mocked_command.assert_called_with(*expected)
+
+
+class TestStreamCommand(base.TestCase):
+    def test_lines(self):
+        with stats.collect() as lookup_stats:
+            lines = git.stream_command(sys.executable, "-c", "print('a'); print(''); print('b\\r')")
+            self.assertEqual(["a", "", "b\r"], list(lines))
+        self.assertEqual(1, lookup_stats.git.git_commands)
+        self.assertEqual(6, lookup_stats.git.git_bytes)
+
+    def test_stdin(self):
+        script = "import sys; sys.stdout.write(sys.stdin.read().upper())"
+        self.assertEqual(["A", "B"], list(git.stream_command(sys.executable, "-c", script, stdin=b"a\nb")))
+
+    def test_failure(self):
+        lines = git.stream_command(sys.executable, "-c", "import sys; print('a'); sys.exit('failed')")
+        self.assertEqual("a", next(lines))
+        self.assertRaises(Exception, next, lines)
+
+    def test_close(self):
+        lines = git.stream_command(sys.executable, "-c", "while True: print('a' * 1000)")
+        self.assertEqual("a" * 1000, next(lines))
+        # Kills the command instead of waiting for it
+        lines.close()
+
+
+class TestLineIntervals(base.TestCase):
+    def test_runs(self):
+        self.assertEqual([], list(git.LineIntervals()))
+        intervals = git.LineIntervals()
+        for line_number in (10, 2, 1, 3, 7, 9):
+            intervals.add(line_number)
+        self.assertEqual([(1, 3), (7, 1), (9, 2)], list(intervals))
+        # Joins the runs it overlaps or touches
+        intervals.add(4, 3)
+        self.assertEqual([(1, 7), (9, 2)], list(intervals))
+        self.assertEqual([(1, 10)], list(git.LineIntervals([(9, 2), (1, 3), (2, 8)])))
+
+    def test_contains(self):
+        intervals = git.LineIntervals([(5, 2), (11, 1)])
+        self.assertEqual([5, 6, 11], [n for n in range(20) if n in intervals])
+        self.assertNotIn(None, intervals)
+        self.assertNotIn("5", intervals)
+
+    def test_matches(self):
+        intervals = git.LineIntervals([(5, 2), (11, 1)])
+        self.assertEqual({5, 6, 11}, intervals.matches([20, 11, 6, None, 5, 4, 5]))
+        self.assertEqual(set(), intervals.matches([]))
+        self.assertEqual(set(), git.LineIntervals().matches([1, 2]))
+
+
+class TestPatchStore(base.TestCase):
+    range_log = [
+        "1ca8dd2b178ef8f308849bac2b0eaecaf91abc70",
+        "",
+        "diff --git a/file1.py b/file1.py",
+        "index 73e79d1..884b953 100644",
+        "--- a/file1.py",
+        "+++ b/file1.py",
+        "@@ -4,0 +5,2 @@ def foo():",
+        "+    x = 1",
+        "+    return x",
+        "@@ -10 +11,0 @@ def bar():",
+        "-    pass",
+        "de75c8dd27af30daef012a9902af4c39c4728710",
+        "",
+        "diff --git a/file2.py b/file2.py",
+        "index 73e79d1..884b953 100644",
+        "--- a/file2.py",
+        "+++ b/file2.py",
+        "@@ -1 +1 @@",
+        "-import os",
+        "+import sys",
+    ]
+
+    @mock.patch("git_stacktrace.git.stream_command")
+    def test_single_git_call(self, mocked_command):
+        mocked_command.return_value = self.range_log
+        patches = git.PatchStore("hash1..hash2")
+        line = parse_trace.Line("file1.py", 5, None, None)
+        line.git_filename = "file1.py"
+        self.assertTrue(patches.line_match("1ca8dd2b178ef8f308849bac2b0eaecaf91abc70", line))
+        self.assertFalse(patches.line_match("de75c8dd27af30daef012a9902af4c39c4728710", line))
+        line.line_number = 11
+        self.assertFalse(patches.line_match("1ca8dd2b178ef8f308849bac2b0eaecaf91abc70", line))
+        self.assertEqual(
+            {5, 6}, patches.lines_match("1ca8dd2b178ef8f308849bac2b0eaecaf91abc70", "file1.py", [4, 5, 6, 11])
+        )
+        self.assertEqual(set(), patches.lines_match("1ca8dd2b178ef8f308849bac2b0eaecaf91abc70", "file2.py", [1]))
+        self.assertTrue(patches.line_removed("pass", "1ca8dd2b178ef8f308849bac2b0eaecaf91abc70"))
+        self.assertFalse(patches.line_removed("return x", "1ca8dd2b178ef8f308849bac2b0eaecaf91abc70"))
+        # Whitespace changes are ignored
+        self.assertFalse(patches.line_removed("return  x", "1ca8dd2b178ef8f308849bac2b0eaecaf91abc70"))
+        self.assertIsNone(patches.line_removed("import os", "1ca8dd2b178ef8f308849bac2b0eaecaf91abc70"))
+        self.assertTrue(patches.line_removed("import os", "de75c8dd27af30daef012a9902af4c39c4728710"))
+        self.assertFalse(patches.line_removed("import sys", "de75c8dd27af30daef012a9902af4c39c4728710"))
+        mocked_command.assert_called_once_with("git", "log", "--pretty=%H", "--unified=0", "-p", "hash1..hash2")
+
+    @mock.patch("git_stacktrace.git.stream_command")
+    def test_pickaxe(self, mocked_command):
+        mocked_command.return_value = self.range_log
+        patches = git.PatchStore("hash1..hash2")
+        self.assertEqual(
+            [("de75c8dd27af30daef012a9902af4c39c4728710", True)],
+            git.pickaxe("import os", "hash1..hash2", patches=patches),
+        )
+        self.assertEqual(
+            [("1ca8dd2b178ef8f308849bac2b0eaecaf91abc70", False)],
+            git.pickaxe("return  x", "hash1..hash2", "file1.py", patches=patches),
+        )
+        self.assertEqual([], git.pickaxe("return x", "hash1..hash2", "file2.py", patches=patches))
+        # Like git log -S, lines containing the snippet match too
+        self.assertEqual(
+            [("1ca8dd2b178ef8f308849bac2b0eaecaf91abc70", False)],
+            git.pickaxe("return", "hash1..hash2", patches=patches),
+        )
+        # but only if the number of times it occurs changed
+        self.assertEqual([], git.pickaxe("import", "hash1..hash2", patches=patches))
+        # Even where the snippet starts or ends inside a word
+        for snippet in ("x = 1", "x =", "rt sy", "t s", "mpor", "ass", "= 1", "s", "nothere", "x = 2"):
+            expected = git.count_line_changes(
+                [
+                    (commit, path, removed)
+                    for commit in [line for line in self.range_log if git.SHA1_REGEX.match(line)]
+                    for text, removed, path in patches.get_patch(commit).changes
+                    if snippet in git.normalize_line(text)
+                ]
+            )
+            self.assertEqual(expected, patches.pickaxe(snippet))
+        self.assertEqual(1, mocked_command.call_count)
+
+    @mock.patch("git_stacktrace.git.stream_command")
+    def test_paths(self, mocked_command):
+        mocked_command.side_effect = [self.range_log, []]
+        patches = git.PatchStore("hash1..hash2", paths=["file2.py", "file1.py"])
+        self.assertTrue(patches.covers("file1.py"))
+        self.assertFalse(patches.covers("file3.py"))
+        self.assertFalse(patches.covers(None))
+        self.assertEqual(
+            [("de75c8dd27af30daef012a9902af4c39c4728710", True)],
+            git.pickaxe("import os", "hash1..hash2", "file2.py", patches=patches),
+        )
+        mocked_command.assert_called_once_with(
+            "git",
+            "log",
+            "--pretty=%H",
+            "--unified=0",
+            "-p",
+            "hash1..hash2",
+            "--",
+            "file1.py",
+            "file2.py",
+            GIT_LITERAL_PATHSPECS="1",
+        )
+        # Files outside of paths fall back to git
+        self.assertEqual([], git.pickaxe("import os", "hash1..hash2", patches=patches))
+        mocked_command.assert_called_with("git", "log", "-b", "--pretty=%H", "-S", "import os", "hash1..hash2")
+
+    @mock.patch("git_stacktrace.git.stream_command")
+    def test_pickaxe_moved_line(self, mocked_command):
+        mocked_command.return_value = [
+            "1ca8dd2b178ef8f308849bac2b0eaecaf91abc70",
+            "",
+            "diff --git a/file1.py b/file1.py",
+            "index 73e79d1..884b953 100644",
+            "--- a/file1.py",
+            "+++ b/file1.py",
+            "@@ -2 +1,0 @@",
+            "-    pass",
+            "@@ -8,0 +8 @@",
+            "+    pass",
+        ]
+        patches = git.PatchStore("hash1..hash2")
+        self.assertEqual([], patches.pickaxe("pass"))
+
+    @mock.patch("git_stacktrace.git.files_touched")
+    @mock.patch("git_stacktrace.git.stream_command")
+    def test_range_history(self, mocked_command, mock_files_touched):
+        mocked_command.return_value = self.range_log
+        mock_files_touched.return_value = {"de75c8dd27af30daef012a9902af4c39c4728710": [git.GitFile("file2.py", "M")]}
+        history = git.RangeHistory("hash1..hash2")
+        # Everything is read up front, before any worker is forked
+        self.assertEqual(1, mocked_command.call_count)
+        mock_files_touched.assert_called_once_with("hash1..hash2")
+        self.assertIs(history, history.lookup_range("hash1..hash2"))
+        self.assertIsNone(history.lookup_range("hash1..hash3"))
+        self.assertEqual(mock_files_touched.return_value, history.files_touched())
+        self.assertEqual(
+            [("de75c8dd27af30daef012a9902af4c39c4728710", True)],
+            git.pickaxe("import os", "hash1..hash2", patches=history),
+        )
+        self.assertEqual(1, mocked_command.call_count)
+
+
+class TestCommitInfo(base.TestCase):
+    log_output = (
+        "1ca8dd2b178ef8f308849bac2b0eaecaf91abc70\x1f1468963088\x1fTue, 19 Jul 2016 14:18:08 -0700\x1f"
+        "John Doe <johndoe@example.com>\x1fbreak interest resource\x1fSummary: foo\n\n"
+        "Differential Revision: https://example.com/D1000\n\x1e\n"
+        "de75c8dd27af30daef012a9902af4c39c4728710\x1f1468963000\x1fTue, 19 Jul 2016 14:16:40 -0700\x1f"
+        "Jane Doe <janedoe@example.com>\x1fno body\x1f\x1e"
+    )
+
+    def setUp(self):
+        super(TestCommitInfo, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.git._commit_info_cache", {}))
+        # Authors go through the mailmap, so commits are read with git log
+        self.useFixture(fixtures.MockPatch("git_stacktrace.git.session")).mock.uses_mailmap = True
+
+    @mock.patch("git_stacktrace.git.run_command")
+    def test_get_commits_info(self, mocked_command):
+        mocked_command.return_value = self.log_output
+        commits = ["1ca8dd2b178ef8f308849bac2b0eaecaf91abc70", "de75c8dd"]
+        info = git.get_commits_info(commits, color=False)
+        self.assertEqual(1, mocked_command.call_count)
+        self.assertEqual(b"1ca8dd2b178ef8f308849bac2b0eaecaf91abc70\nde75c8dd", mocked_command.call_args[1]["stdin"])
+        first = info["1ca8dd2b178ef8f308849bac2b0eaecaf91abc70"]
+        self.assertEqual(
+            "commit 1ca8dd2b178ef8f308849bac2b0eaecaf91abc70\n"
+            "Commit Date: Tue, 19 Jul 2016 14:18:08 -0700\n"
+            "Author:      John Doe <johndoe@example.com>\n"
+            "Subject:     break interest resource",
+            first.summary,
+        )
+        self.assertEqual("break interest resource", first.subject)
+        self.assertEqual("Summary: foo\n\nDifferential Revision: https://example.com/D1000", first.body)
+        self.assertEqual("https://example.com/D1000", first.url)
+        self.assertEqual("John Doe <johndoe@example.com>", first.author)
+        second = info["de75c8dd"]
+        self.assertEqual("no body", second.subject)
+        self.assertEqual("", second.body)
+        self.assertIsNone(second.url)
+
+    @mock.patch("git_stacktrace.git.run_command")
+    def test_commit_info_cached(self, mocked_command):
+        mocked_command.return_value = self.log_output
+        git.prefetch_commit_info(
+            ["1ca8dd2b178ef8f308849bac2b0eaecaf91abc70", "de75c8dd27af30daef012a9902af4c39c4728710"]
+        )
+        git.get_commit_info("1ca8dd2b178ef8f308849bac2b0eaecaf91abc70")
+        git.format_one_commit("de75c8dd27af30daef012a9902af4c39c4728710")
+        self.assertEqual(1, mocked_command.call_count)
+
+    @mock.patch("git_stacktrace.git.run_command")
+    def test_session(self, mocked_command):
+        git.session.uses_mailmap = False
+        git.session.commit_info.return_value = ["1ca8dd2b", "1468963088", "", "John Doe <j@example.com>", "foo", ""]
+        self.assertEqual("foo", git.get_commit_info("1ca8dd2b").subject)
+        git.get_commit_info("1ca8dd2b")
+        git.session.commit_info.assert_called_once_with("1ca8dd2b")
+        self.assertEqual(0, mocked_command.call_count)
+
+    @mock.patch("git_stacktrace.git.run_command")
+    def test_empty_body_stripped(self, mocked_command):
+        # run_command strips \x1f and \x1e too, as they are whitespace
+        mocked_command.return_value = self.log_output.strip()
+        info = git.get_commit_info("de75c8dd27af30daef012a9902af4c39c4728710", color=False)
+        self.assertEqual("no body", info.subject)
+        self.assertEqual("", info.body)
+
+
+class TestTreeCache(base.TestCase):
+    tree1 = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+    tree2 = "5c4a0b6f2a4f7e8f3e9ecb0a0e6a6b0c9a5e1f21"
+
+    def setUp(self):
+        super(TestTreeCache, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.git.tree_cache", git.TreeCache(max_size=1)))
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.git._commit_trees", {}))
+        self.session = self.useFixture(fixtures.MockPatch("git_stacktrace.git.session")).mock
+        self.session.resolve.side_effect = lambda rev: self.tree1 if rev.startswith("1ca8dd2b") else self.tree2
+        self.session.tree_files.side_effect = lambda tree: {self.tree1: ["file1", "dir/file2"], self.tree2: ["file3"]}[
+            tree
+        ]
+
+    def calls(self):
+        return self.session.resolve.call_count + self.session.tree_files.call_count
+
+    def test_files_cached(self):
+        git_range = "de75c8dd27af30daef012a9902af4c39c4728710..1ca8dd2b178ef8f308849bac2b0eaecaf91abc70"
+        self.assertEqual(["file1", "dir/file2"], git.files(git_range))
+        self.session.resolve.assert_called_once_with("1ca8dd2b178ef8f308849bac2b0eaecaf91abc70^{tree}")
+        self.assertEqual(2, self.calls())
+        self.assertEqual(["file1", "dir/file2"], git.files(git_range))
+        self.assertEqual(["dir/file2"], git.path_index(git_range).ending_with("file2"))
+        self.assertIs(git.path_index(git_range), git.path_index(git_range))
+        self.assertEqual(2, self.calls())
+
+    def test_eviction(self):
+        self.assertEqual(["file1", "dir/file2"], git.files("HEAD~1..1ca8dd2b"))
+        self.assertEqual(["file3"], git.files("HEAD~1..HEAD"))
+        self.assertEqual(4, self.calls())
+        # Symbolic names always have to be resolved, the listing is evicted
+        self.assertEqual(["file1", "dir/file2"], git.files("HEAD~1..1ca8dd2b"))
+        self.assertEqual(6, self.calls())
+
+    def test_unknown_commit(self):
+        self.session.resolve.side_effect = None
+        self.session.resolve.return_value = None
+        self.assertRaises(Exception, git.files, "HEAD~1..nothere")
+
+    def test_directory(self):
+        directory = self.useFixture(fixtures.TempDir()).path
+        self.assertEqual(["file1", "dir/file2"], git.TreeCache(directory=directory).get(self.tree1).files)
+        self.assertEqual(1, self.calls())
+        self.assertEqual(["file1", "dir/file2"], git.TreeCache(directory=directory).get(self.tree1).files)
+        self.assertEqual(1, self.calls())
+
+    def test_directory_pruned(self):
+        directory = self.useFixture(fixtures.TempDir()).path
+        git.TreeCache(directory=directory, max_files=1).get(self.tree1)
+        os.utime(os.path.join(directory, self.tree1), (0, 0))
+        # A read marks the listing as used
+        git.TreeCache(directory=directory, max_files=1).get(self.tree1)
+        self.assertGreater(os.path.getmtime(os.path.join(directory, self.tree1)), 0)
+        os.utime(os.path.join(directory, self.tree1), (0, 0))
+        git.TreeCache(directory=directory, max_files=1).get(self.tree2)
+        self.assertEqual([self.tree2], os.listdir(directory))
+        self.assertEqual(2, self.calls())
+
+
+class TestGitSession(base.TestCase):
+    """Compare what the session reads with what git itself outputs, in a temporary repository."""
+
+    def setUp(self):
+        super(TestGitSession, self).setUp()
+        repo = self.useFixture(base.GitRepository())
+        self.git = repo.git
+        self.write = repo.write
+        self.write("setup.py", "import setuptools\n")
+        self.write("pkg/a/mod.py", "x = 1\n")
+        self.write("pkg/a-b.py", "y = 2\n")
+        self.write("pkg/a0.py", "z = 3\n")
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "first\nline\n\nSummary: body\n\nDifferential Revision: https://x/D1")
+        self.write("pkg/a/mod.py", "x = 2\n")
+        self.git("commit", "-q", "-a", "-m", "no body", GIT_COMMITTER_DATE="1462000000 +0530")
+        self.session = git.GitSession()
+        self.addCleanup(self.session.close)
+
+    def test_commit_info(self):
+        for commit in self.git("rev-list", "HEAD").split():
+            expected = self.git("log", "--no-walk", "--format=" + git.COMMIT_INFO_FORMAT, commit)
+            expected = expected.rstrip("\n").rstrip("\x1e").split("\x1f", 5)
+            self.assertEqual(expected, self.session.commit_info(commit))
+        self.assertEqual(
+            self.session.commit_info("HEAD"), self.session.commit_info(self.git("rev-parse", "--short", "HEAD").strip())
+        )
+        self.assertIsNone(self.session.commit_info("HEAD:setup.py"))
+        self.assertIsNone(self.session.commit_info("nothere"))
+
+    def test_tree_files(self):
+        tree = self.git("rev-parse", "HEAD^{tree}").strip()
+        self.assertEqual(tree, self.session.resolve("HEAD^{tree}"))
+        expected = self.git("ls-tree", "-r", "-z", "--name-only", tree).split("\0")[:-1]
+        self.assertEqual(expected, self.session.tree_files(tree))
+        self.assertRaises(Exception, self.session.tree_files, "HEAD:setup.py")
+        # The session is still usable after an error
+        self.assertEqual(expected, self.session.tree_files(tree))
+
+    def test_blob(self):
+        self.assertEqual(b"import setuptools\n", self.session.blob("HEAD:setup.py"))
+        self.assertIsNone(self.session.blob("HEAD:nothere.py"))
+        self.assertIsNone(self.session.blob("HEAD"))
+        self.assertEqual("blob", self.session.info("HEAD:setup.py")[1])
+
+    def test_mailmap(self):
+        self.assertFalse(self.session.uses_mailmap)
+        self.write(".mailmap", "Jane Smith <jane@example.com>\n")
+        self.assertTrue(git.GitSession().uses_mailmap)
+
+    def test_other_repository(self):
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.git.session", self.session))
+        first = os.getcwd()
+        head = self.git("rev-parse", "HEAD").strip()
+        self.assertEqual(head, git.SubprocessBackend().resolve("HEAD"))
+        other = self.useFixture(base.GitRepository())
+        other.write("other.py", "import os\n")
+        other.git("add", ".")
+        other.git("commit", "-q", "-m", "other")
+        self.assertEqual(other.git("rev-parse", "HEAD").strip(), git.SubprocessBackend().resolve("HEAD"))
+        self.assertEqual(["other.py"], self.session.tree_files(self.session.resolve("HEAD^{tree}")))
+        self.write(".mailmap", "Jane Smith <jane@example.com>\n")
+        self.assertFalse(self.session.uses_mailmap)
+        os.chdir(first)
+        self.assertEqual(head, git.SubprocessBackend().resolve("HEAD"))
+        self.assertTrue(self.session.uses_mailmap)
+
+    def test_line_break(self):
+        head = self.git("rev-parse", "HEAD").strip()
+        parent = self.git("rev-parse", "HEAD~1").strip()
+        self.assertIsNone(self.session.resolve("HEAD\nHEAD~1"))
+        self.assertIsNone(self.session.read("HEAD\r"))
+        self.assertEqual([None, self.session.read(parent)], self.session._read_objects(["HEAD\nx", parent]))
+        # Still one answer per request
+        self.assertEqual(head, self.session.resolve("HEAD"))
+        self.assertEqual("commit", self.session.read("HEAD")[1])
+        self.assertEqual("tree", self.session.info("HEAD^{tree}")[1])
+
+    def test_spaces(self):
+        self.assertIsNone(self.session.info("a b"))
+        self.assertIsNone(self.session.read("a b"))
+        self.assertEqual(self.git("rev-parse", "HEAD").strip(), self.session.resolve("HEAD"))
+
+    def test_protocol_error(self):
+        self.session.resolve("HEAD")
+        process = self.session._processes["--batch-check"][0]
+        self.addCleanup(process.stdout.close)
+        process.stdout = io.BytesIO(b"not an answer\n")
+        self.assertRaises(Exception, self.session.resolve, "HEAD")
+        self.assertNotIn("--batch-check", self.session._processes)
+        self.assertIsNotNone(process.returncode)
+        self.assertEqual(self.git("rev-parse", "HEAD").strip(), self.session.resolve("HEAD"))
+
+    def test_stats(self):
+        with stats.collect() as lookup_stats:
+            self.session.resolve("HEAD")
+            self.session.blob("HEAD:setup.py")
+        self.assertEqual(2, lookup_stats.git.git_commands)
+        self.assertEqual(len(b"import setuptools\n"), lookup_stats.git.git_bytes)
+
+    def test_one_process(self):
+        commits = self.git("rev-list", "HEAD").split()
+        with mock.patch("subprocess.Popen", wraps=subprocess.Popen) as popen:
+            for commit in commits:
+                self.session.commit_info(commit)
+            self.session.tree_files(self.session.resolve("HEAD^{tree}"))
+            self.session.blob("HEAD:setup.py")
+        self.assertEqual(
+            [("git", "cat-file", "--batch"), ("git", "cat-file", "--batch-check")],
+            [call[0][0] for call in popen.call_args_list],
+        )
+
+
+class TestCommitFiles(base.TestCase):
+    def test_by_path(self):
+        commit_files = git.CommitFiles()
+        commit_files.add("hash1", git.GitFile("file1", "M"))
+        commit_files.add("hash1", git.GitFile("file2", "A"))
+        commit_files.add("hash2", git.GitFile("file1", "D"))
+        self.assertEqual({"hash1": ["file1", "file2"], "hash2": ["file1"]}, commit_files)
+        self.assertEqual(
+            [("hash1", git.GitFile.MODIFIED), ("hash2", git.GitFile.DELETED)],
+            [(commit, f.state) for commit, f in commit_files.by_path["file1"]],
+        )
+        self.assertIs(commit_files.by_path, git.files_by_path(commit_files))
+
+    def test_files_by_path_dict(self):
+        by_path = git.files_by_path({"hash1": [git.GitFile("file1", "M")], "hash2": [git.GitFile("file1", "A")]})
+        self.assertEqual(["hash1", "hash2"], [commit for commit, f in by_path["file1"]])
+        self.assertNotIn("file2", by_path)
+
+
+class BackendConformance(object):
+    """Compare what a backend reads with what the git command line outputs, in a GitHistory.
+
+    Mixed into a test case for each backend, which sets backend_class.
+    """
+
+    backend_class = None
+
+    def setUp(self):
+        super(BackendConformance, self).setUp()
+        self.repo = self.useFixture(base.GitHistory())
+        session = git.GitSession()
+        self.addCleanup(session.close)
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.git.session", session))
+        self.backend = self.backend_class()
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.git.backend", self.backend))
+
+    def rev_parse(self, rev):
+        rc, output = git.run_command_status("git", "rev-parse", "--verify", "-q", rev)
+        return output if rc == 0 else None
+
+    def raw_history(self, git_range, paths=None):
+        pathspec = () if paths is None else ("--",) + tuple(paths)
+        history = []
+        for line in self.repo.git("log", "--pretty=%H", "--raw", git_range, *pathspec).splitlines():
+            if line.startswith(":"):
+                history[-1][1].append((line.split("\t")[-1], line.split("\t")[0].split(" ")[4][0]))
+            elif line:
+                history.append((line, []))
+        return [(commit, files) for commit, files in history if files]
+
+    def test_resolve(self):
+        revs = [
+            "HEAD",
+            "@",
+            "HEAD~2",
+            "HEAD^",
+            "HEAD^0",
+            "merge^2",
+            "merge^2~1",
+            "merge~1^{tree}",
+            "v1",
+            "v1^{}",
+            "v1^{commit}",
+            "v1^{tree}",
+            "v1:pkg/b0.py",
+            "HEAD:pkg",
+            "HEAD:",
+            "side",
+            "light",
+            "refs/heads/side",
+            "refs/tags/v1",
+            self.repo.branch,
+            self.repo.git("rev-parse", "--short", "HEAD~1").strip(),
+            self.repo.git("rev-parse", "HEAD:setup.py").strip(),
+            "nothere",
+            "HEAD~100",
+            "HEAD^3",
+            "HEAD:nothere",
+            "HEAD:setup.py/nothere",
+            "v1:big.py^{tree}",
+        ]
+        for rev in revs:
+            self.assertEqual(self.rev_parse(rev), self.backend.resolve(rev), rev)
+
+    def test_resolve_range(self):
+        for git_range in ("HEAD~3..HEAD", "v1..HEAD", "v1..", "..side", "side", "light...HEAD"):
+            expected = " ".join(self.repo.git("rev-parse", git_range).split())
+            self.assertEqual(expected, self.backend.resolve_range(git_range), git_range)
+        self.assertRaises(Exception, self.backend.resolve_range, "nothere..HEAD")
+
+    def test_files_touched(self):
+        for git_range in ("HEAD", "v1..HEAD", "v1..merge", "merge..HEAD~1", "side..HEAD", "v1..side", "light..HEAD"):
+            for paths in (None, ["pkg/a-b.py"], ["pkg"], ["pkg/", "docs/x.md"], ["setup.py"]):
+                commit_files = self.backend.files_touched(git_range, paths)
+                self.assertEqual(
+                    self.raw_history(git_range, paths),
+                    [(commit, [(f.filename, f.state) for f in files]) for commit, files in commit_files.items()],
+                    (git_range, paths),
+                )
+        self.assertEqual({}, self.backend.files_touched("HEAD", []))
+        self.assertRaises(Exception, self.backend.files_touched, "nothere..HEAD")
+
+    def test_path_history(self):
+        # large.py was renamed from big.py with a line appended
+        commit_files, paths = git.path_history("light..HEAD", ["large.py"])
+        self.assertEqual(["big.py", "large.py"], paths)
+        self.assertEqual([("large.py", "R")], [(f.filename, f.state) for f in commit_files[self.rev_parse("HEAD")]])
+        patches = git.PatchStore("light..HEAD", paths=paths)
+        patch = patches.get_patch(self.rev_parse("HEAD"))
+        self.assertEqual([201], [n for n in range(1, 203) if patch.line_match("large.py", n)])
+        # Files that weren't renamed only need one look at the history
+        with mock.patch("git_stacktrace.git.files_touched", wraps=git.files_touched) as files_touched:
+            self.assertEqual(["setup.py"], git.path_history("v1..HEAD", ["setup.py"])[1])
+        self.assertEqual(1, files_touched.call_count)
+
+    def test_convert_since(self):
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.git._since_ranges", {}))
+        for since, branch in (
+            ("2016-07-19 21:20:00 +0000", None),
+            ("2016-07-19 21:20:00 +0000", "side"),
+            ("1.year", None),
+        ):
+            log = self.repo.git("log", "--pretty=%H", "--since=" + since, *([branch] if branch else [])).split()
+            if log:
+                self.assertEqual("%s..%s" % (log[-1], log[0]), git.convert_since(since, branch=branch))
+                self.assertEqual(
+                    bool(self.raw_history("%s..%s" % (log[-1], log[0]))), git.valid_range("%s..%s" % (log[-1], log[0]))
+                )
+            else:
+                self.assertRaises(Exception, git.convert_since, since, branch=branch)
+
+    def test_tree_files(self):
+        for commit in self.repo.git("rev-list", "--all").split():
+            tree = self.rev_parse(commit + "^{tree}")
+            expected = self.repo.git("ls-tree", "-r", "-z", "--name-only", tree).split("\0")[:-1]
+            self.assertEqual(expected, self.backend.tree_files(tree))
+        self.assertRaises(Exception, self.backend.tree_files, self.rev_parse("HEAD:setup.py"))
+
+    def test_commit_info(self):
+        commits = self.repo.git("rev-list", "--all").split()
+        short = self.repo.git("rev-parse", "--short", "HEAD").strip()
+        info = self.backend.commit_info(commits + [short, "nothere"])
+        for commit in commits:
+            expected = self.repo.git("log", "--no-walk", "--format=" + git.COMMIT_INFO_FORMAT, commit)
+            self.assertEqual(expected.rstrip("\n").rstrip("\x1e").split("\x1f", 5), info[commit])
+        self.assertEqual(info[commits[0]], info[short])
+        self.assertNotIn("nothere", info)
+
+    def test_patches(self):
+        self.assertEqual(
+            self.repo.git("log", "--pretty=%H", "--unified=0", "-p", "v1..HEAD", "--", "pkg").strip(),
+            "\n".join(self.backend.range_patches("v1..HEAD", ["pkg"])),
+        )
+        self.assertEqual(
+            self.repo.git("log", "-1", "--format=", "-p", "HEAD~1").strip(), self.backend.commit_patch("HEAD~1")
+        )
+
+
+class TestSubprocessBackend(BackendConformance, base.TestCase):
+    backend_class = git.SubprocessBackend
+
+
+class TestObjectBackend(BackendConformance, base.TestCase):
+    backend_class = git.ObjectBackend
+
+    def test_no_processes(self):
+        with mock.patch("subprocess.Popen") as popen:
+            self.backend.resolve("merge~1^{tree}")
+            self.backend.resolve_range("v1..HEAD")
+            self.backend.files_touched("v1..HEAD~2")
+            self.backend.files_touched("merge..HEAD~2", ["pkg"])
+            self.backend.tree_files(self.backend.resolve("HEAD^{tree}"))
+            self.backend.commit_info([self.backend.resolve("HEAD")])
+        self.assertEqual(0, popen.call_count)
+
+    def test_fallback(self):
+        with mock.patch("git_stacktrace.git.stream_command", wraps=git.stream_command) as stream_command:
+            # An inexact rename
+            self.backend.files_touched("light..HEAD")
+            # Path limited history through a merge
+            self.backend.files_touched("v1..HEAD", ["pkg"])
+        self.assertEqual(2, stream_command.call_count)
+        with mock.patch("git_stacktrace.git.run_command", wraps=git.run_command) as run_command:
+            self.backend.resolve_range("light...HEAD")
+        self.assertEqual(1, run_command.call_count)
+
+    def test_mailmap(self):
+        self.repo.write(".mailmap", "Janet Doe <jane@example.com>\n")
+        head = self.rev_parse("HEAD")
+        self.assertEqual("Janet Doe <jane@example.com>", git.ObjectBackend().commit_info([head])[head][3])
+
+    def test_set_backend(self):
+        self.assertIsInstance(git.set_backend("objects"), git.ObjectBackend)
+        self.assertIsInstance(git.backend, git.ObjectBackend)
+        with fixtures.TempDir() as tmp:
+            os.chdir(tmp.path)
+            self.assertIsInstance(git.set_backend("objects"), git.SubprocessBackend)
+            os.chdir(self.repo.path)
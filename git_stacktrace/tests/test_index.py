@@ -0,0 +1,118 @@
+import os
+import threading
+
+import mock
+
+from git_stacktrace.tests import base
+from git_stacktrace import git
+from git_stacktrace import index
+from git_stacktrace import parse_trace
+
+
+class TestHistoryIndex(base.TestCase):
+    def setUp(self):
+        super(TestHistoryIndex, self).setUp()
+        self.repo = self.useFixture(base.GitRepository())
+        self.commit({"mod.py": "import os\n\n\ndef foo():\n    return 1\n"})
+        self.commit({"mod.py": "import os\n\n\ndef foo():\n    x = None\n    return x.bar\n", "other.py": "y = 2\n"})
+        self.commit({"other.py": None, "mod.py": "import sys\n\n\ndef foo():\n    x = None\n    return x.bar\n"})
+
+    def commit(self, files):
+        for filename, content in files.items():
+            if content is None:
+                self.repo.git("rm", "-q", filename)
+            else:
+                self.repo.write(filename, content)
+                self.repo.git("add", filename)
+        self.repo.git("commit", "-q", "-m", "change")
+
+    def test_lookup_range(self):
+        history_index = index.HistoryIndex()
+        self.assertEqual(os.path.join(".git", index.DEFAULT_FILENAME), history_index.path)
+        self.assertFalse(history_index.covers("HEAD~2..HEAD"))
+        self.assertIsNone(history_index.lookup_range("HEAD~2..HEAD", update=False))
+        indexed_range = history_index.lookup_range("HEAD~2..HEAD")
+        self.assertTrue(history_index.covers("HEAD~2..HEAD"))
+        self.assertFalse(history_index.covers("HEAD"))
+        self.assertEqual(git.files_touched("HEAD~2..HEAD"), indexed_range.files_touched())
+
+        patches = git.PatchStore("HEAD~2..HEAD")
+        snippets = ("return x.bar", "import os", "y = 2", "x = None", "return 1", "import", "return", "x", "bar")
+        for snippet in snippets + ("x = No", "= Non", "n x.b", "t o", "urn"):
+            for filename in (None, "mod.py", "other.py"):
+                self.assertEqual(patches.pickaxe(snippet, filename), indexed_range.pickaxe(snippet, filename))
+        for commit in indexed_range.commits:
+            for snippet in ("import os", "return  x.bar", "x", ""):
+                self.assertEqual(patches.line_removed(snippet, commit), indexed_range.line_removed(snippet, commit))
+            for line_number in range(1, 8):
+                line = parse_trace.Line("mod.py", line_number, None, None)
+                line.git_filename = "mod.py"
+                self.assertEqual(patches.line_match(commit, line), indexed_range.line_match(commit, line))
+            self.assertEqual(
+                patches.lines_match(commit, "mod.py", range(1, 8)),
+                indexed_range.lines_match(commit, "mod.py", range(1, 8)),
+            )
+
+    def test_pickaxe_other_commits(self):
+        history_index = index.HistoryIndex()
+        history_index.lookup_range("HEAD")
+        indexed_range = history_index.lookup_range("HEAD~1..HEAD")
+        patches = git.PatchStore("HEAD~1..HEAD")
+        for snippet in ("def foo():", "x = None", "import os", "return 1", "return"):
+            self.assertEqual(patches.pickaxe(snippet), indexed_range.pickaxe(snippet))
+        with mock.patch.object(history_index, "_execute", wraps=history_index._execute) as execute:
+            indexed_range.pickaxe("x = None")
+            indexed_range.pickaxe("return")
+        for call in execute.call_args_list:
+            plan = history_index._db.execute("EXPLAIN QUERY PLAN " + call[0][0], call[0][1]).fetchall()
+            self.assertNotIn("SCAN", " ".join(row[-1] for row in plan))
+
+    def test_incremental(self):
+        history_index = index.HistoryIndex()
+        history_index.lookup_range("HEAD~1..HEAD")
+        self.assertEqual(
+            git.run_command("git", "rev-list", "HEAD~1").splitlines(),
+            history_index.missing(git.run_command("git", "rev-list", "HEAD").splitlines()),
+        )
+        history_index.close()
+        # Reopen the index from disk
+        history_index = index.HistoryIndex()
+        self.assertEqual(1, len(history_index.missing(git.run_command("git", "rev-list", "HEAD~2..HEAD").splitlines())))
+
+    def test_range_listed_once(self):
+        history_index = index.HistoryIndex()
+        with mock.patch("git_stacktrace.git.run_command", wraps=git.run_command) as run_command:
+            first = history_index.lookup_range("HEAD~2..HEAD")
+            self.assertEqual(first.commits, history_index.lookup_range("HEAD~2..HEAD").commits)
+            self.assertTrue(history_index.covers("HEAD~2..HEAD"))
+            self.assertEqual(1, [call[0][1] for call in run_command.call_args_list].count("rev-list"))
+            # HEAD moved, so the range is listed again
+            self.commit({"other.py": "z = 3\n"})
+            self.assertEqual(
+                git.run_command("git", "rev-parse", "HEAD"), history_index.lookup_range("HEAD~2..HEAD").commits[0]
+            )
+            self.assertEqual(2, [call[0][1] for call in run_command.call_args_list].count("rev-list"))
+
+    def count_rows(self, history_index):
+        return [
+            history_index._execute("SELECT COUNT(*) FROM %s" % table)[0][0] for table in ("files", "lines", "hunks")
+        ]
+
+    def test_concurrent_lookup(self):
+        expected = index.HistoryIndex(os.path.join(self.repo.path, "expected.sqlite"))
+        expected.lookup_range("HEAD~2..HEAD")
+        history_index = index.HistoryIndex()
+        threads = [threading.Thread(target=history_index.lookup_range, args=("HEAD~2..HEAD",)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.count_rows(expected), self.count_rows(history_index))
+
+    def test_add_indexed_commits(self):
+        history_index = index.HistoryIndex()
+        history_index.lookup_range("HEAD~2..HEAD")
+        rows = self.count_rows(history_index)
+        # Like another process that found the same commits missing
+        history_index.add_commits(git.run_command("git", "rev-list", "HEAD~2..HEAD").splitlines())
+        self.assertEqual(rows, self.count_rows(history_index))
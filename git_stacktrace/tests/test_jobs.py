@@ -0,0 +1,55 @@
+import threading
+
+import mock
+
+from git_stacktrace.tests import base
+from git_stacktrace import jobs
+
+
+class TestJobQueue(base.TestCase):
+    def setUp(self):
+        super(TestJobQueue, self).setUp()
+        self.job_queue = jobs.JobQueue(workers=1, max_pending=2, ttl=60)
+        self.addCleanup(self.job_queue.shutdown)
+
+    def test_result(self):
+        def run(job):
+            job.update_progress("pickaxe", 1, 2)
+            return {"commits": []}
+
+        job = self.job_queue.submit(run)
+        self.assertTrue(job.wait(5))
+        self.assertEqual(jobs.Job.DONE, job.state)
+        self.assertEqual({"commits": []}, job.result)
+        self.assertEqual({"phase": "pickaxe", "done": 1, "total": 2}, job.as_dict()["progress"])
+        self.assertIs(job, self.job_queue.get(job.id))
+
+    def test_failed(self):
+        def run(job):
+            raise ValueError("bad range")
+
+        job = self.job_queue.submit(run)
+        self.assertTrue(job.wait(5))
+        self.assertEqual(jobs.Job.FAILED, job.state)
+        self.assertEqual("bad range", job.error)
+
+    def test_queue_full(self):
+        release = threading.Event()
+        first = self.job_queue.submit(lambda job: release.wait(5))
+        second = self.job_queue.submit(lambda job: release.wait(5))
+        self.assertRaises(jobs.QueueFull, self.job_queue.submit, lambda job: None)
+        self.assertEqual(2, self.job_queue.pending)
+        release.set()
+        self.assertTrue(first.wait(5))
+        self.assertTrue(second.wait(5))
+        self.assertTrue(self.job_queue.submit(lambda job: None).wait(5))
+
+    def test_expire(self):
+        job = self.job_queue.submit(lambda job: None)
+        self.assertTrue(job.wait(5))
+        with mock.patch("git_stacktrace.jobs.time.time", return_value=job.finished + 61):
+            self.assertIsNone(self.job_queue.get(job.id))
+        self.assertEqual(0, len(self.job_queue))
+
+    def test_unknown(self):
+        self.assertIsNone(self.job_queue.get("nope"))
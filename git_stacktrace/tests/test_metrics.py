@@ -0,0 +1,58 @@
+from git_stacktrace.tests import base
+from git_stacktrace import metrics
+
+
+class TestMetrics(base.TestCase):
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter("requests_total", "Requests", ["endpoint"])
+        counter.inc(endpoint="/")
+        counter.inc(2, endpoint="/")
+        counter.inc(endpoint='/a"b')
+        self.assertEqual(3, counter.value(endpoint="/"))
+        self.assertRaises(ValueError, counter.inc, -1, endpoint="/")
+        self.assertRaises(ValueError, counter.inc, code=200)
+        self.assertEqual(
+            "# HELP requests_total Requests\n"
+            "# TYPE requests_total counter\n"
+            'requests_total{endpoint="/"} 3\n'
+            'requests_total{endpoint="/a\\"b"} 1\n',
+            counter.expose(),
+        )
+
+    def test_gauge(self):
+        gauge = self.registry.gauge("in_flight", "Running")
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(1, gauge.value())
+        self.assertIn("\nin_flight 1\n", gauge.expose())
+        gauge.set_function(lambda: 0.5)
+        self.assertIn("\nin_flight 0.5\n", gauge.expose())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram("seconds", "Time", ["phase"], buckets=[1, 0.1])
+        histogram.observe(0.05, phase="files")
+        histogram.observe(0.5, phase="files")
+        histogram.observe(5, phase="files")
+        self.assertEqual(3, histogram.count(phase="files"))
+        self.assertEqual(
+            "# HELP seconds Time\n"
+            "# TYPE seconds histogram\n"
+            'seconds_bucket{phase="files",le="0.1"} 1\n'
+            'seconds_bucket{phase="files",le="1.0"} 2\n'
+            'seconds_bucket{phase="files",le="+Inf"} 3\n'
+            'seconds_sum{phase="files"} 5.55\n'
+            'seconds_count{phase="files"} 3\n',
+            histogram.expose(),
+        )
+
+    def test_registry(self):
+        self.registry.counter("a_total", "A")
+        self.registry.gauge("b", "B")
+        self.assertRaises(ValueError, self.registry.counter, "a_total", "A")
+        exposed = self.registry.expose()
+        self.assertLess(exposed.index("a_total"), exposed.index("# TYPE b gauge"))
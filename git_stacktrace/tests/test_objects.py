@@ -0,0 +1,123 @@
+import os
+import subprocess
+
+import fixtures
+
+from git_stacktrace.tests import base
+from git_stacktrace import objects
+
+
+class TestApplyDelta(base.TestCase):
+    def test_apply_delta(self):
+        # Copy 5 bytes from offset 6 of the base, then insert 4 bytes
+        delta = bytes([11, 9, 0x91, 6, 5, 4]) + b", hi"
+        self.assertEqual(b"world, hi", objects.apply_delta(b"hello world", delta))
+
+    def test_wrong_base(self):
+        self.assertRaises(objects.Unsupported, objects.apply_delta, b"hello", bytes([11, 0]))
+
+
+class TestObjectStore(base.TestCase):
+    def setUp(self):
+        super(TestObjectStore, self).setUp()
+        self.repo = self.useFixture(base.GitHistory())
+        self.store = objects.ObjectStore(*objects.find_git_dir())
+
+    def test_find_git_dir(self):
+        os.chdir(os.path.join(self.repo.path, "pkg"))
+        self.assertEqual((os.path.join(self.repo.path, ".git"), self.repo.path), objects.find_git_dir())
+
+    def test_read(self):
+        count = dict(line.split(": ") for line in self.repo.git("count-objects", "-v").splitlines())
+        # Both loose and packed objects are read
+        self.assertNotEqual("0", count["count"])
+        self.assertNotEqual("0", count["in-pack"])
+        listing = self.repo.git("cat-file", "--batch-all-objects", "--batch-check=%(objectname) %(objecttype)")
+        for line in listing.splitlines():
+            sha, obj_type = line.split()
+            data = subprocess.check_output(("git", "cat-file", obj_type, sha))
+            self.assertEqual((obj_type, data), self.store.read(sha))
+        self.assertRaises(KeyError, self.store.read, "0" * 40)
+
+    def test_expand(self):
+        head = self.repo.git("rev-parse", "HEAD").strip()
+        first = self.repo.git("rev-parse", "HEAD~3").strip()
+        self.assertEqual([head], self.store.expand(head[:7]))
+        self.assertEqual([first], self.store.expand(first[:7]))
+        self.assertEqual([], self.store.expand("0000000"))
+
+    def test_rev_list(self):
+        for include, exclude in (
+            (["HEAD"], []),
+            (["HEAD"], ["v1"]),
+            (["side"], ["HEAD~2"]),
+            (["v1", "side"], ["merge^1"]),
+        ):
+            expected = self.repo.git("rev-list", *(include + ["^" + rev for rev in exclude])).split()
+            self.assertEqual(
+                expected,
+                self.store.rev_list(
+                    [self.store.resolve(rev + "^{commit}") for rev in include],
+                    [self.store.resolve(rev + "^{commit}") for rev in exclude],
+                ),
+            )
+
+    def test_diff_trees(self):
+        for commit in self.repo.git("rev-list", "--no-merges", "HEAD").split():
+            expected = []
+            raw = self.repo.git("diff-tree", "-r", "--root", "--no-renames", "--no-commit-id", commit)
+            for line in raw.splitlines():
+                modes, path = line.split("\t")
+                old_mode, new_mode, old_sha, new_sha, status = modes[1:].split()
+                expected.append((old_mode, new_mode, old_sha, new_sha, path))
+            parents = self.store.commit(commit).parents
+            changes = self.store.diff_trees(
+                self.store.commit(parents[0]).tree if parents else None, self.store.commit(commit).tree
+            )
+            self.assertEqual(
+                expected,
+                [
+                    (old_mode or "000000", new_mode or "000000", old_sha or "0" * 40, new_sha or "0" * 40, path)
+                    for old_mode, new_mode, old_sha, new_sha, path in changes
+                ],
+            )
+
+    def test_refs(self):
+        # v1 is only in packed-refs, side is a loose ref
+        self.assertFalse(os.path.exists(".git/refs/tags/v1"))
+        self.assertTrue(os.path.exists(".git/refs/heads/side"))
+        for name in ("refs/tags/v1", "refs/heads/side", "HEAD"):
+            self.assertEqual(self.repo.git("rev-parse", name).strip(), self.store.ref(name))
+        # A loose ref overrides a packed one
+        self.repo.git("update-ref", "refs/tags/v1", "HEAD")
+        self.assertEqual(self.repo.git("rev-parse", "HEAD").strip(), self.store.ref("refs/tags/v1"))
+        self.assertIsNone(self.store.ref("refs/heads/nothere"))
+        self.assertRaises(objects.Unsupported, self.store.ref, "refs/../config")
+
+    def test_unsupported_revisions(self):
+        for rev in ("HEAD@{1}", "@{upstream}", "HEAD^{/merge}", ":/merge", "HEAD^!"):
+            self.assertRaises(objects.Unsupported, self.store.resolve, rev)
+
+    def test_unsupported_repositories(self):
+        self.repo.git("replace", "HEAD~1", "HEAD~2")
+        self.assertRaises(objects.Unsupported, objects.ObjectStore, *objects.find_git_dir())
+        self.repo.git("replace", "-d", "HEAD~1")
+        objects.ObjectStore(*objects.find_git_dir())
+        with open(".git/info/grafts", "w") as f:
+            f.write(self.repo.git("rev-parse", "HEAD"))
+        self.assertRaises(objects.Unsupported, objects.ObjectStore, *objects.find_git_dir())
+
+    def test_sha256(self):
+        path = self.useFixture(fixtures.TempDir()).path
+        self.repo.git("init", "-q", "--object-format=sha256", path)
+        # Its object IDs are longer than this module reads
+        self.assertRaises(objects.Unsupported, objects.ObjectStore, *objects.find_git_dir(path))
+
+    def test_worktree(self):
+        path = os.path.join(self.repo.path, "worktree")
+        self.repo.git("worktree", "add", "-q", path, "side")
+        os.chdir(path)
+        store = objects.ObjectStore(*objects.find_git_dir())
+        self.assertEqual(path, store.work_tree)
+        self.assertEqual(self.repo.git("rev-parse", "side").strip(), store.resolve("HEAD"))
+        self.assertEqual(self.repo.git("rev-parse", "v1").strip(), store.resolve("v1"))
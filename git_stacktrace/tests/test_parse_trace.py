@@ -1,7 +1,13 @@
 import glob
+import io
+import os
+import re
+
+import mock
 
 from git_stacktrace.tests import base
 from git_stacktrace import parse_trace
+from git_stacktrace import paths
 
 
 class TestParsePythonStacktrace(base.TestCase):
@@ -53,11 +59,56 @@ class TestParsePythonStacktrace(base.TestCase):
         with open("git_stacktrace/tests/examples/java1.trace") as f:
             self.assertRaises(parse_trace.ParseException, parse_trace.PythonTraceback, f.readlines())
 
+    def test_exception_language(self):
+        e = self.assertRaises(parse_trace.ParseException, parse_trace.PythonTraceback, "NOT A TRACEBACK")
+        self.assertEqual("python", e.language)
+        e = self.assertRaises(parse_trace.ParseException, parse_trace.parse_trace, "NOT A TRACEBACK")
+        self.assertIsNone(e.language)
+        # Sniffed as python, so the other languages aren't tried
+        e = self.assertRaises(
+            parse_trace.ParseException,
+            parse_trace.parse_trace,
+            'Traceback (most recent call last):\n  File "a.py", line 1, in f\n    x\n  y',
+        )
+        self.assertEqual("python", e.language)
+
+    def test_fingerprint(self):
+        trace = self.get_trace()
+        with open("git_stacktrace/tests/examples/python3.trace") as f:
+            # Same frames with a different exception message
+            lines = [line.replace("error", "socket.error: illegal IP address") for line in f.readlines()]
+        other = parse_trace.PythonTraceback(lines)
+        self.assertNotEqual(str(trace), str(other))
+        self.assertEqual(trace.fingerprint(), other.fingerprint())
+        self.assertNotEqual(trace.fingerprint(), self.get_trace(number=5).fingerprint())
+
     def test_file_match(self):
         trace = self.get_trace()
         self.assertTrue(trace.file_match(trace.lines[0].trace_filename, ["common/utils/geo_utils.py"]))
         self.assertFalse(trace.file_match(trace.lines[0].trace_filename, ["common/utils/fake.py"]))
 
+    def test_longest_file_match(self):
+        trace = self.get_trace()
+        git_files = ["utils/geo_utils.py", "common/utils/geo_utils.py", "common/utils/fake.py"]
+        for files in (git_files, paths.PathIndex(git_files)):
+            self.assertEqual(
+                "common/utils/geo_utils.py", trace.longest_file_match(trace.lines[0].trace_filename, files)
+            )
+            self.assertIsNone(trace.longest_file_match(trace.lines[1].trace_filename, files))
+
+    def test_longest_file_match_subclass(self):
+        class BasenameTraceback(parse_trace.PythonTraceback):
+            trace_ends_with_path = None
+
+            def file_match(self, trace_filename, git_files):
+                return [f for f in git_files if os.path.basename(f) == os.path.basename(trace_filename)]
+
+        with open("git_stacktrace/tests/examples/python3.trace") as f:
+            trace = BasenameTraceback(f.readlines())
+        git_files = ["other/geo_utils.py", "common/utils/fake.py"]
+        for files in (git_files, paths.PathIndex(git_files)):
+            self.assertEqual("other/geo_utils.py", trace.longest_file_match(trace.lines[0].trace_filename, files))
+
 
 class TestParseJavaStacktrace(base.TestCase):
     def get_trace(self):
@@ -97,6 +148,19 @@ class TestParseJavaStacktrace(base.TestCase):
             trace.file_match(trace.lines[2].trace_filename, ["src/main/java/com/devdaily/tests/Fake.java"])
         )
 
+    def test_longest_file_match(self):
+        trace = self.get_trace()
+        git_files = [
+            "java/com/devdaily/tests/ExceptionTest.java",
+            "src/main/java/com/devdaily/tests/ExceptionTest.java",
+        ]
+        for files in (git_files, paths.PathIndex(git_files)):
+            self.assertEqual(
+                "src/main/java/com/devdaily/tests/ExceptionTest.java",
+                trace.longest_file_match(trace.lines[2].trace_filename, files),
+            )
+            self.assertIsNone(trace.longest_file_match(trace.lines[1].trace_filename, files))
+
 
 class TestLine(base.TestCase):
     def test_line(self):
@@ -107,6 +171,30 @@ class TestLine(base.TestCase):
 
 
 class TestParseTrace(base.TestCase):
+    def test_sniff(self):
+        expected = {
+            "python": [parse_trace.PythonTraceback],
+            "java": [parse_trace.JavaTraceback],
+            "javascript": [parse_trace.JavaScriptTraceback],
+        }
+        for filename in glob.glob("git_stacktrace/tests/examples/*.trace"):
+            with open(filename) as f:
+                lines = parse_trace.Traceback.prep_blob(f.readlines())
+            language = re.match(r"[a-z]+", os.path.basename(filename)).group()
+            self.assertEqual(expected[language], parse_trace.sniff(lines), filename)
+
+    def test_sniff_unknown(self):
+        self.assertEqual(parse_trace.LANGUAGES, parse_trace.sniff(["NOT A TRACEBACK"]))
+        lines = ["Error"] * parse_trace.SNIFF_LINES + ["\tat com.example.App.main(App.java:5)"]
+        self.assertEqual(parse_trace.LANGUAGES, parse_trace.sniff(lines))
+
+    @mock.patch("git_stacktrace.parse_trace.PythonTraceback.extract_traceback")
+    def test_parse_trace_sniffed(self, mock_extract):
+        with open("git_stacktrace/tests/examples/java1.trace") as f:
+            traceback = parse_trace.parse_trace(f.readlines())
+        self.assertIsInstance(traceback, parse_trace.JavaTraceback)
+        self.assertEqual(0, mock_extract.call_count)
+
     def test_parse_trace(self):
         for filename in glob.glob("git_stacktrace/tests/examples/*.trace"):
             with open(filename) as f:
@@ -114,3 +202,76 @@ class TestParseTrace(base.TestCase):
                     parse_trace.parse_trace(f.readlines())
                 except Exception:
                     self.fail("Failed to parse '%s'" % filename)
+
+
+class TestExtractTracebacks(base.TestCase):
+    log = "\n".join(
+        [
+            "2024-01-01 INFO starting",
+            "Traceback (most recent call last):",
+            '  File "app/views.py", line 10, in handle',
+            "    load()",
+            '  File "app/models.py", line 20, in load',
+            '    raise KeyError("x")',
+            "    ^^^^^^^^^^^^^^^^^^^",
+            "KeyError: 'x'",
+            "",
+            "During handling of the above exception, another exception occurred:",
+            "",
+            "Traceback (most recent call last):",
+            '  File "app/views.py", line 12, in handle',
+            '    raise ValueError("y")',
+            "ValueError: y",
+            "2024-01-01 INFO next",
+            '2024-01-01 ERROR Exception in thread "main" java.lang.RuntimeException: boom',
+            "    at com.example.App.run(App.java:10)",
+            "\tat com.example.App.main(App.java:5)",
+            "Caused by: java.lang.NullPointerException",
+            "\tat com.example.Db.get(Db.java:42)",
+            "\t... 2 more",
+            "2024-01-01 INFO node",
+            "TypeError: Cannot read property 'x' of undefined",
+            "    at routes (webpack:///app/Main.js:170:58)",
+        ]
+    )
+
+    def test_extract_tracebacks(self):
+        tracebacks = list(parse_trace.extract_tracebacks(io.StringIO(self.log)))
+        self.assertEqual(
+            [parse_trace.PythonTraceback, parse_trace.JavaTraceback, parse_trace.JavaScriptTraceback],
+            [type(t) for t in tracebacks],
+        )
+        python, java, javascript = tracebacks
+        self.assertEqual(
+            [("app/views.py", 10), ("app/models.py", 20), ("app/views.py", 12)],
+            [(line.trace_filename, line.line_number) for line in python.lines],
+        )
+        self.assertEqual("ValueError: y\n", python.footer)
+        self.assertEqual(
+            ["com/example/App.java", "com/example/App.java", "com/example/Db.java"],
+            [line.trace_filename for line in java.lines],
+        )
+        self.assertIn("java.lang.RuntimeException: boom", java.header)
+        self.assertEqual(["webpack:///app/Main.js"], [line.trace_filename for line in javascript.lines])
+
+    def test_examples(self):
+        for filename in sorted(glob.glob("git_stacktrace/tests/examples/*.trace")):
+            if filename.endswith(("python1.trace", "python7.trace")):
+                # Escaped newlines and no "Traceback" line, not as they would be logged
+                continue
+            with open(filename) as f:
+                expected = parse_trace.parse_trace(f.readlines())
+            with open(filename) as f:
+                extracted = list(parse_trace.extract_tracebacks(f))
+            self.assertEqual([expected.fingerprint()], [t.fingerprint() for t in extracted], filename)
+
+    def test_streaming(self):
+        lines = iter(self.log.split("\n"))
+        tracebacks = parse_trace.extract_tracebacks(lines)
+        self.assertIsInstance(next(tracebacks), parse_trace.PythonTraceback)
+        # The python traceback is yielded as soon as the line after it is read
+        self.assertEqual('2024-01-01 ERROR Exception in thread "main" java.lang.RuntimeException: boom', next(lines))
+
+    def test_max_lines(self):
+        tracebacks = list(parse_trace.extract_tracebacks(io.StringIO(self.log), max_lines=4))
+        self.assertEqual([parse_trace.JavaScriptTraceback], [type(t) for t in tracebacks])
@@ -0,0 +1,51 @@
+from git_stacktrace.tests import base
+from git_stacktrace import paths
+
+
+class TestPathIndex(base.TestCase):
+    files = [
+        "utils.py",
+        "common/utils/geo_utils.py",
+        "common/utils/utils.py",
+        "lib/common/utils/geo_utils.py",
+        "src/main/java/com/devdaily/tests/ExceptionTest.java",
+        "test/java/com/devdaily/tests/ExceptionTest.java",
+        "src/main/java/com/devdaily/tests/MyExceptionTest.java",
+    ]
+
+    def setUp(self):
+        super(TestPathIndex, self).setUp()
+        self.index = paths.PathIndex(self.files)
+
+    def test_suffixes_of(self):
+        trace_filename = "/mnt/app/lib/common/utils/geo_utils.py"
+        expected = [f for f in self.files if trace_filename.endswith(f)]
+        self.assertEqual(expected, self.index.suffixes_of(trace_filename))
+        self.assertEqual("lib/common/utils/geo_utils.py", self.index.longest_suffix_of(trace_filename))
+        self.assertEqual(["utils.py", "common/utils/utils.py"], self.index.suffixes_of("../common/utils/utils.py"))
+        self.assertEqual([], self.index.suffixes_of("fake.py"))
+        self.assertIsNone(self.index.longest_suffix_of("fake.py"))
+
+    def test_ending_with(self):
+        trace_filename = "com/devdaily/tests/ExceptionTest.java"
+        expected = [f for f in self.files if f.endswith(trace_filename)]
+        self.assertEqual(expected, self.index.ending_with(trace_filename))
+        self.assertEqual(
+            "src/main/java/com/devdaily/tests/ExceptionTest.java", self.index.longest_ending_with(trace_filename)
+        )
+        self.assertEqual(
+            ["src/main/java/com/devdaily/tests/MyExceptionTest.java"],
+            self.index.ending_with("devdaily/tests/MyExceptionTest.java"),
+        )
+        self.assertEqual([], self.index.ending_with("com/devdaily/tests/Fake.java"))
+        self.assertIsNone(self.index.longest_ending_with("com/devdaily/tests/Fake.java"))
+
+    def test_same_as_list(self):
+        trace_filenames = ["utils.py", "s.py", "geo_utils.py", "/utils.py", "ExceptionTest.java", "java", ""]
+        for trace_filename in trace_filenames:
+            self.assertEqual(
+                [f for f in self.files if trace_filename.endswith(f)], self.index.suffixes_of(trace_filename)
+            )
+            self.assertEqual(
+                [f for f in self.files if f.endswith(trace_filename)], self.index.ending_with(trace_filename)
+            )
@@ -1,3 +1,6 @@
+import concurrent.futures
+import time
+
 import mock
 import testtools
 
@@ -161,8 +164,9 @@ class TestResults(base.TestCase):
         expected = [commit1, commit2]
         self.assertEqual(expected, results.get_sorted_results())
 
+    @mock.patch("git_stacktrace.git.prefetch_commit_info")
     @mock.patch("git_stacktrace.git.get_commit_info")
-    def test_get_sorted_results_by_dict(self, mocked_git_info):
+    def test_get_sorted_results_by_dict(self, mocked_git_info, mocked_prefetch):
         mocked_git_info.return_value = fake_commit_info
         results = result.Results()
         commit2 = results.get_result("hash2")
@@ -170,3 +174,25 @@ class TestResults(base.TestCase):
         commit1.add_file(git.GitFile("file1", "M"))
         expected = [dict(commit1), dict(commit2)]
         self.assertEqual(expected, results.get_sorted_results_by_dict())
+
+    @mock.patch("git_stacktrace.git.prefetch_commit_info")
+    @mock.patch("git_stacktrace.git.get_commit_info")
+    def test_fetch_commit_info(self, mocked_git_info, mocked_prefetch):
+        mocked_git_info.return_value = fake_commit_info
+        results = result.Results()
+        commit1 = results.get_result("hash1")
+        results.get_result("hash2")
+        self.assertEqual("summary", commit1.summary)
+        mocked_prefetch.assert_called_once_with(["hash1", "hash2"])
+
+    @mock.patch("git_stacktrace.git.prefetch_commit_info")
+    @mock.patch("git_stacktrace.git.get_commit_info")
+    def test_fetch_commit_info_threads(self, mocked_git_info, mocked_prefetch):
+        mocked_git_info.return_value = fake_commit_info
+        mocked_prefetch.side_effect = lambda commits: time.sleep(0.05)
+        results = result.Results()
+        commit1 = results.get_result("hash1")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            summaries = list(executor.map(lambda i: commit1.summary, range(4)))
+        self.assertEqual(["summary"] * 4, summaries)
+        self.assertEqual(1, mocked_prefetch.call_count)
@@ -1,7 +1,18 @@
+import io
+import json
+import threading
+import time
+import urllib.request
+
+import fixtures
 import mock
 
 from git_stacktrace.tests import base
-from git_stacktrace.server import Args
+from git_stacktrace import jobs
+from git_stacktrace import metrics
+from git_stacktrace import result
+from git_stacktrace import server
+from git_stacktrace.server import Args, ResultsOutput
 
 
 class TestApi(base.TestCase):
@@ -83,3 +94,279 @@ class TestApi(base.TestCase):
         mock_valid_range.return_value = True
         args = Args({"option-type": "by-range"})
         self.assertIsNone(args.validate())
+
+    @mock.patch("git_stacktrace.server.api.resolve_range")
+    @mock.patch("git_stacktrace.server.api.valid_range")
+    @mock.patch("git_stacktrace.server.api.lookup_stacktrace")
+    def test_results_as_json_timings(self, mock_lookup_stacktrace, mock_valid_range, mock_resolve_range):
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.server.result_cache", server.ResultCache()))
+        mock_valid_range.return_value = True
+        mock_resolve_range.return_value = "hash2 ^hash1"
+        mock_lookup_stacktrace.return_value = result.Results()
+        with open("git_stacktrace/tests/examples/python3.trace") as f:
+            args = Args({"option-type": "by-range", "range": "hash1..hash2", "trace": f.read()})
+        out = json.loads(ResultsOutput(args).results_as_json())
+        self.assertEqual("No matches found", out["errors"])
+        self.assertIn("parse_trace", out["timings"]["phases"])
+        self.assertEqual(0, out["timings"]["git_commands"])
+
+
+class TestThreadPoolWSGIServer(base.TestCase):
+    def test_concurrent_requests(self):
+        # Both requests have to be in the app at the same time to get past the barrier
+        barrier = threading.Barrier(2, timeout=5)
+
+        def app(environ, start_response):
+            barrier.wait()
+            start_response("200 OK", [("Content-type", "text/plain")])
+            return [b"ok"]
+
+        httpd = server.make_server("127.0.0.1", 0, app, workers=2)
+        self.assertIsInstance(httpd, server.ThreadPoolWSGIServer)
+        self.addCleanup(httpd.server_close)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(httpd.shutdown)
+
+        url = "http://127.0.0.1:%d/" % httpd.server_port
+        bodies = []
+
+        def get():
+            with urllib.request.urlopen(url, timeout=10) as response:
+                bodies.append(response.read())
+
+        clients = [threading.Thread(target=get) for i in range(2)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        self.assertEqual([b"ok", b"ok"], bodies)
+
+    def test_single_worker(self):
+        httpd = server.make_server("127.0.0.1", 0, workers=1)
+        self.addCleanup(httpd.server_close)
+        self.assertNotIsInstance(httpd, server.ThreadPoolWSGIServer)
+
+
+class TestResultCache(base.TestCase):
+    def setUp(self):
+        super(TestResultCache, self).setUp()
+        self.cache = server.ResultCache(max_size=2)
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.server.result_cache", self.cache))
+        self.useFixture(fixtures.MockPatch("git_stacktrace.server.api.valid_range", return_value=True))
+        self.resolve_range = self.useFixture(
+            fixtures.MockPatch("git_stacktrace.server.api.resolve_range", return_value="hash2 ^hash1")
+        ).mock
+        self.lookup_stacktrace = self.useFixture(
+            fixtures.MockPatch("git_stacktrace.server.api.lookup_stacktrace", return_value=result.Results())
+        ).mock
+        with open("git_stacktrace/tests/examples/python3.trace") as f:
+            self.trace = f.read()
+
+    def args(self, trace=None):
+        return Args({"option-type": "by-range", "range": "hash1..master", "trace": trace or self.trace})
+
+    def test_lru(self):
+        self.cache.put("a", 1)
+        self.cache.put("b", 2)
+        self.assertEqual(1, self.cache.get("a"))
+        self.cache.put("c", 3)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(1, self.cache.get("a"))
+        self.assertEqual(3, self.cache.get("c"))
+        self.assertEqual({"size": 2, "max_size": 2, "hits": 3, "misses": 1}, self.cache.as_dict())
+
+    def test_disabled(self):
+        self.cache.max_size = 0
+        self.cache.put("a", 1)
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_same_frames_hit(self):
+        first = ResultsOutput(self.args())
+        self.assertFalse(first.cache_hit)
+        # Same frames with another exception message
+        second = ResultsOutput(self.args(self.trace.replace("error", "socket.error: 1.2.3.4")))
+        self.assertTrue(second.cache_hit)
+        self.assertIs(first.results, second.results)
+        self.assertEqual(first.etag, ResultsOutput(self.args()).etag)
+        self.assertEqual(1, self.lookup_stacktrace.call_count)
+        self.assertEqual({"size": 1, "max_size": 2, "hits": 2, "misses": 1}, self.cache.as_dict())
+
+    def test_range_moved_miss(self):
+        ResultsOutput(self.args())
+        self.resolve_range.return_value = "hash3 ^hash1"
+        self.assertFalse(ResultsOutput(self.args()).cache_hit)
+        self.assertEqual(2, self.lookup_stacktrace.call_count)
+
+    def request(self, method, path="/", if_none_match=None, query_string=""):
+        body = json.dumps(self.args().params).encode()
+        environ = {
+            "REQUEST_METHOD": method,
+            "PATH_INFO": path,
+            "QUERY_STRING": query_string,
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": io.BytesIO(body),
+        }
+        if if_none_match:
+            environ["HTTP_IF_NONE_MATCH"] = if_none_match
+        response = {}
+
+        def start_response(status, headers):
+            response["status"] = status
+            response["headers"] = dict(headers)
+
+        response["body"] = b"".join(server.application(environ, start_response))
+        return response
+
+    def test_etag(self):
+        response = self.request("POST")
+        self.assertEqual("200 OK", response["status"])
+        self.assertEqual("MISS", response["headers"]["X-Cache"])
+        etag = response["headers"]["ETag"]
+        response = self.request("POST", if_none_match=etag)
+        self.assertEqual("304 Not Modified", response["status"])
+        self.assertEqual(b"", response["body"])
+        response = self.request("POST", if_none_match='"other"')
+        self.assertEqual("200 OK", response["status"])
+        self.assertEqual("HIT", response["headers"]["X-Cache"])
+        self.assertEqual(1, self.lookup_stacktrace.call_count)
+
+    def test_etag_failed_lookup(self):
+        self.lookup_stacktrace.side_effect = Exception("fatal: bad object")
+        response = self.request("POST")
+        self.assertEqual("200 OK", response["status"])
+        self.assertNotIn("ETag", response["headers"])
+        self.lookup_stacktrace.side_effect = None
+        etag = self.request("POST")["headers"]["ETag"]
+        self.assertEqual("304 Not Modified", self.request("POST", if_none_match=etag)["status"])
+        # Once the results are gone they are looked up again
+        self.cache.clear()
+        response = self.request("POST", if_none_match=etag)
+        self.assertEqual("200 OK", response["status"])
+        self.assertEqual(etag, response["headers"]["ETag"])
+        self.assertEqual(3, self.lookup_stacktrace.call_count)
+
+    def test_cache_stats(self):
+        self.request("POST")
+        self.request("POST")
+        response = self.request("GET", "/cache")
+        self.assertEqual(
+            {"size": 1, "max_size": 2, "hits": 1, "misses": 1, "in_flight": 0, "coalesced": 0},
+            json.loads(response["body"]),
+        )
+
+    def test_metrics(self):
+        requests = server.REQUESTS.value(endpoint="/", method="POST", code="200")
+        self.request("POST")
+        self.assertEqual(requests + 1, server.REQUESTS.value(endpoint="/", method="POST", code="200"))
+        response = self.request("GET", "/metrics")
+        self.assertEqual("200 OK", response["status"])
+        self.assertEqual(metrics.CONTENT_TYPE, response["headers"]["Content-type"])
+        body = response["body"].decode("utf-8")
+        self.assertIn('git_stacktrace_request_duration_seconds_count{endpoint="/"}', body)
+        self.assertIn('git_stacktrace_lookup_phase_seconds_count{phase="parse_trace"}', body)
+        self.assertIn("git_stacktrace_result_cache_hit_ratio 0.0\n", body)
+
+    def test_metrics_parse_failures(self):
+        failures = server.PARSE_FAILURES.value(language="unknown")
+        output = ResultsOutput(self.args("not a stacktrace"))
+        self.assertEqual("Unable to parse traceback", output.messages)
+        self.assertEqual(failures + 1, server.PARSE_FAILURES.value(language="unknown"))
+
+    def test_jobs(self):
+        job_queue = jobs.JobQueue(workers=1, max_pending=1)
+        self.addCleanup(job_queue.shutdown)
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.server.job_queue", job_queue))
+        response = self.request("POST", "/jobs")
+        self.assertEqual("202 Accepted", response["status"])
+        job_id = json.loads(response["body"])["id"]
+        self.assertEqual("/jobs/%s" % job_id, response["headers"]["Location"])
+
+        response = self.request("GET", "/jobs/%s" % job_id, query_string="wait=5")
+        self.assertEqual("200 OK", response["status"])
+        job = json.loads(response["body"])
+        self.assertEqual("done", job["state"])
+        self.assertEqual("No matches found", job["result"]["errors"])
+        self.assertIsNotNone(self.lookup_stacktrace.call_args[1]["progress"])
+
+        self.assertEqual("404 Not Found", self.request("GET", "/jobs/unknown")["status"])
+
+    def test_jobs_queue_full(self):
+        job_queue = jobs.JobQueue(workers=1, max_pending=0)
+        self.addCleanup(job_queue.shutdown)
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.server.job_queue", job_queue))
+        response = self.request("POST", "/jobs")
+        self.assertEqual("503 Service Unavailable", response["status"])
+        self.assertIn("Too many jobs", json.loads(response["body"])["error"])
+
+    def test_concurrent_identical_requests(self):
+        in_flight = server.SingleFlight()
+        self.useFixture(fixtures.MonkeyPatch("git_stacktrace.server.in_flight", in_flight))
+        started = threading.Event()
+        release = threading.Event()
+
+        def lookup_stacktrace(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return result.Results()
+
+        self.lookup_stacktrace.side_effect = lookup_stacktrace
+        outputs = []
+        first = threading.Thread(target=lambda: outputs.append(ResultsOutput(self.args())))
+        first.start()
+        started.wait(5)
+        second = threading.Thread(target=lambda: outputs.append(ResultsOutput(self.args())))
+        second.start()
+        for i in range(500):
+            if in_flight.coalesced:
+                break
+            time.sleep(0.01)
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual(1, self.lookup_stacktrace.call_count)
+        self.assertIs(outputs[0].results, outputs[1].results)
+        self.assertEqual([False, True], sorted(output.shared for output in outputs))
+        self.assertEqual(0, len(in_flight))
+
+
+class TestSingleFlight(base.TestCase):
+    def test_not_shared(self):
+        in_flight = server.SingleFlight()
+        self.assertEqual((1, False), in_flight.do("a", lambda: 1))
+        self.assertEqual((2, False), in_flight.do("a", lambda: 2))
+        self.assertEqual(0, in_flight.coalesced)
+
+    def test_exception_shared(self):
+        in_flight = server.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise ValueError("lookup failed")
+
+        errors = []
+
+        def call():
+            try:
+                in_flight.do("a", fail)
+            except ValueError as e:
+                errors.append(str(e))
+
+        first = threading.Thread(target=call)
+        first.start()
+        started.wait(5)
+        second = threading.Thread(target=call)
+        second.start()
+        for i in range(500):
+            if in_flight.coalesced:
+                break
+            time.sleep(0.01)
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual(["lookup failed", "lookup failed"], errors)
+        self.assertEqual(0, len(in_flight))
@@ -0,0 +1,76 @@
+import concurrent.futures
+
+import mock
+
+from git_stacktrace.tests import base
+from git_stacktrace import git
+from git_stacktrace import stats
+
+
+class TestStats(base.TestCase):
+    def test_not_collecting(self):
+        self.assertIsNone(stats.current())
+        with stats.phase("files"):
+            stats.record_command(1.0, 10)
+            stats.record_count("files", 10)
+        self.assertIsNone(stats.current())
+
+    def test_collect(self):
+        with stats.collect() as lookup_stats:
+            self.assertIs(lookup_stats, stats.current())
+            stats.record_command(0.5, 10)
+            with stats.phase("files"):
+                stats.record_command(1.0, 20)
+                stats.record_command(1.0, 30)
+            with stats.phase("files"):
+                pass
+            stats.record_count("files", 10)
+            stats.record_count("files", 5)
+        self.assertIsNone(stats.current())
+        data = lookup_stats.as_dict()
+        self.assertEqual(3, data["git_commands"])
+        self.assertEqual(60, data["git_bytes"])
+        self.assertEqual(2.5, data["git_seconds"])
+        self.assertEqual(["files"], list(data["phases"]))
+        self.assertEqual(2, data["phases"]["files"]["calls"])
+        self.assertEqual(2, data["phases"]["files"]["git_commands"])
+        self.assertEqual(50, data["phases"]["files"]["git_bytes"])
+        self.assertEqual({"files": 10}, data["counts"])
+        self.assertIn("files", str(lookup_stats))
+
+    def test_merge(self):
+        with stats.collect() as other_stats:
+            stats.record_command(0.5, 10)
+            with stats.phase("files"):
+                stats.record_command(1.0, 20)
+            stats.record_count("files", 10)
+        with stats.collect() as lookup_stats:
+            with stats.phase("files"):
+                stats.record_command(1.0, 30)
+            stats.record_count("files", 5)
+            lookup_stats.merge(other_stats.as_dict())
+        data = lookup_stats.as_dict()
+        self.assertEqual(3, data["git_commands"])
+        self.assertEqual(60, data["git_bytes"])
+        self.assertEqual(2, data["phases"]["files"]["calls"])
+        self.assertEqual(2, data["phases"]["files"]["git_commands"])
+        self.assertEqual({"files": 10}, data["counts"])
+
+    def test_run_in_context(self):
+        with stats.collect() as lookup_stats:
+            with stats.phase("pickaxe"):
+                with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                    futures = [stats.run_in_context(executor, stats.record_command, 1.0, 1) for i in range(4)]
+                    [future.result() for future in futures]
+        self.assertEqual(4, lookup_stats.phases["pickaxe"].git_commands)
+
+    @mock.patch("subprocess.Popen")
+    def test_run_command(self, mocked_popen):
+        mocked_popen.return_value.communicate.return_value = (b"output\n", None)
+        mocked_popen.return_value.returncode = 0
+        with stats.collect() as lookup_stats:
+            with stats.phase("files"):
+                self.assertEqual("output", git.run_command("git", "ls-tree", "HEAD"))
+        self.assertEqual(1, lookup_stats.git.git_commands)
+        self.assertEqual(7, lookup_stats.git.git_bytes)
+        self.assertEqual(1, lookup_stats.phases["files"].git_commands)